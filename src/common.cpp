@@ -151,6 +151,7 @@ string ium_reads = "";
 string sam_header = "";
 string sam_readgroup_id = "";
 string zpacker = "";
+int bam_compression_level = -1;
 string samtools_path = "samtools_0.1.18";
 
 bool solexa_quals = false;
@@ -340,7 +341,8 @@ enum
     OPT_BOWTIE2_READ_GAP_CONT,
     OPT_BOWTIE2_REF_GAP_OPEN,
     OPT_BOWTIE2_REF_GAP_CONT,
-    OPT_BOWTIE2_SCOREFLT 
+    OPT_BOWTIE2_SCOREFLT,
+    OPT_BAM_COMPRESSION
   };
 
 static struct option long_options[] = {
@@ -390,6 +392,7 @@ static struct option long_options[] = {
 {"max-insertion-length", required_argument, 0, OPT_MAX_INSERTION_LENGTH},
 {"num-threads", required_argument, 0, OPT_NUM_THREADS},
 {"zpacker", required_argument, 0, OPT_ZPACKER},
+{"bam-compression", required_argument, 0, OPT_BAM_COMPRESSION},
 {"samtools", required_argument, 0, OPT_SAMTOOLS},
 {"aux-outfile", required_argument, 0, OPT_AUX_OUT},
 {"outfile", required_argument, 0, OPT_STD_OUT},
@@ -617,6 +620,10 @@ int parse_options(int argc, char** argv, void (*print_usage)())
     case OPT_ZPACKER:
       zpacker =  optarg;
       break;
+    case OPT_BAM_COMPRESSION:
+      bam_compression_level = parseIntOpt(0, "--bam-compression must be at least 0", print_usage);
+      if (bam_compression_level>9) bam_compression_level=9;
+      break;
     case OPT_SAMTOOLS:
       samtools_path =  optarg;
       break;
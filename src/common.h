@@ -113,6 +113,7 @@ extern std::string ium_reads;
 extern std::string sam_header;
 extern std::string sam_readgroup_id;
 extern std::string zpacker; //path to program to use for de/compression (gzip, pigz, bzip2, pbzip2)
+extern int bam_compression_level; //zlib level for the BAM files written by GBamWriter (-1 = default)
 extern std::string samtools_path; //path to samtools executable
 extern std::string std_outfile; //main output file that some modules can use instead of stdout
 extern std::string aux_outfile; //auxiliary output file name
@@ -407,6 +408,14 @@ class GBamWriter {
    int64_t idx_last_id;
    bool external_header;
  public:
+   const char* bam_write_mode(bool uncompressed=false) {
+      static char wmode[4];
+      wmode[0]='w'; wmode[1]='b'; wmode[2]=0; wmode[3]=0;
+      if (uncompressed) wmode[2]='u';
+        else if (bam_compression_level>=0) wmode[2]='0'+bam_compression_level;
+      return wmode;
+      }
+
    void create(const char* fname, bool uncompressed=false) {
 	  findex=NULL;
 	  wcount=0;
@@ -415,12 +424,7 @@ class GBamWriter {
 	  external_header=false;
       if (bam_header==NULL)
          err_die("Error: no bam_header for GBamWriter::create()!\n");
-      if (uncompressed) {
-         bam_file=samopen(fname, "wbu", bam_header);
-         }
-        else {
-         bam_file=samopen(fname, "wb", bam_header);
-         }
+      bam_file=samopen(fname, bam_write_mode(uncompressed), bam_header);
       if (bam_file==NULL)
          err_die("Error: could not create BAM file %s!\n",fname);
       //do we need to call bam_header_write() ?
@@ -434,7 +438,7 @@ class GBamWriter {
 	  external_header=false;
       if (bam_header==NULL)
          err_die("Error: no bam_header for GBamWriter::create()!\n");
-      bam_file=samopen(fname, "wb", bam_header);
+      bam_file=samopen(fname, bam_write_mode(), bam_header);
       if (bam_file==NULL)
          err_die("Error: could not create BAM file %s!\n",fname);
       if (!idxfile.empty()) {
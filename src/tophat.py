@@ -23,8 +23,23 @@ import warnings
 import re
 import glob
 import signal
+import stat
+import select
+import cPickle
+import multiprocessing
+import multiprocessing.pool
+import traceback
+import hashlib
+import json
+import time
+import fcntl
+import mmap
+import struct
+import zlib
+import binascii
+import string
 from datetime import datetime
-from shutil import copy, rmtree, move
+from shutil import copy, copyfileobj, rmtree, move
 import logging
 
 use_message = '''
@@ -81,12 +96,29 @@ Options:
     --microexon-search
     --keep-tmp
     --tmp-dir                      <dirname>   [ default: <output_dir>/tmp ]
+    --cache-dir                    <dirname>   [ default: no cache         ]
     -z/--zpacker                   <program>   [ default: gzip             ]
     -X/--unmapped-fifo                         [use mkfifo to compress more temporary
                                                  files for color space reads]
+    --tmp-compression              <policy>    [ none|fast|balanced|max|auto,
+                                                 default: -z/--zpacker defaults ]
 
 Advanced Options:
     --report-secondary-alignments
+    --parallel-mates                           (map left and right reads
+                                                concurrently, splitting -p
+                                                between the two sides)
+    --parallel-segments                        (run the Bowtie jobs for read
+                                                segments concurrently within
+                                                the -p thread budget)
+    --multiplex-segments                       (map all read segments with a
+                                                single Bowtie run per index)
+    --bowtie-mm                                (preload the Bowtie index files
+                                                and run Bowtie with --mm so all
+                                                Bowtie runs share one copy)
+    --stream-segments                          (stream the IUM reads through
+                                                named pipes into the segment
+                                                splitting and segment mapping)
     --no-discordant
     --no-mixed
 
@@ -101,6 +133,24 @@ Advanced Options:
     --no-sort-bam                              (Output BAM is not coordinate-sorted)
     --no-convert-bam                           (Do not output bam format.
                                                 Output is <output_dir>/accepted_hits.sam)
+    --sort-memory                  <size>      [ memory for sorting the output,
+                                                 e.g. 4G; default: 500M per
+                                                 part, at most 1/4 of the RAM ]
+    --region-merge                             (merge the sorted output by
+                                                groups of chromosomes, then
+                                                concatenate the groups)
+    --no-index-bam                             (do not index the sorted
+                                                accepted_hits.bam)
+    --index-unmapped                           (also index unmapped.bam)
+    --split-output-by-chrom                    (write one sorted BAM file per
+                                                chromosome, small contigs
+                                                grouped, and a manifest
+                                                instead of accepted_hits.bam)
+    --output-stream                <path|->    (write the alignments to this
+                                                file or named pipe, or to
+                                                stdout, instead of
+                                                accepted_hits.bam; SAM with
+                                                --no-convert-bam)
     --keep-fasta-order
     --allow-partial-mapping
 
@@ -172,6 +222,7 @@ tophat_log = None  #main log file handle
 tophat_logger = None # main logging object
 run_cmd = None
 tmp_dir = output_dir + "tmp/"
+cache_dir = None # set by --cache-dir, for data reused across runs (see index_cache_dir())
 bin_dir = sys.path[0] + "/"
 use_zpacker = False # this is set by -z/--zpacker option (-z0 leaves it False)
 
@@ -205,6 +256,14 @@ stageNames = ["start", "prep_reads", "map_start", "map_segments", "find_juncs",
 runStages = dict([(stageNames[st], st) for st in range(0, 9)])
 currentStage  = 0
 resumeStage = 0
+in_worker = False # True in processes forked by ForkedCall; only the main
+                  # process writes the stage markers into run.log
+bowtie_idx_runs = {} # bowtie index prefix -> number of Bowtie runs using it
+resource_records = [] # resource usage of each finished subprocess, see TrackedPopen
+live_workers = [] # ForkedCall workers not reaped yet, see terminate_workers()
+worker_result_fd = None # in a ForkedCall worker, the pipe of its result
+stage_times = [] # (stage number, start time) for each stage of the run
+preloaded_idx = {} # bowtie index prefix -> (number of bytes, preload duration)
 
 def getResumeStage(rlog):
   #returns tuple: (resumeStage, old_cmd_args)
@@ -264,9 +323,87 @@ def doResume(odir):
   resumeStage = best_stage
   return best_argv
 
+# A step of the pipeline that finished successfully leaves a checkpoint
+# manifest with its command line and the stamps of its input and output
+# files. When a run is resumed, the steps of the resumed stage whose
+# manifest still matches their inputs and outputs are not run again. Only
+# the Bowtie runs, segment_juncs, juncs_db with the splice index build and
+# long_spanning_reads have checkpoints; prep_reads, tophat_reports and the
+# sorting and merging of BAM files are only skipped by the stage resumed.
+def checkpoint_file(cmd):
+    key = hashlib.sha1("\0".join(cmd)).hexdigest()
+    return logging_dir + "checkpoints/" + key + ".json"
+
+# A cheap stamp of a file's version, in the spirit of make: its size and
+# modification time, plus the md5 of its first and last 64KB to also catch
+# a file rewritten within the mtime resolution. It does not read the whole
+# file, so an edit in the middle that keeps the size and the mtime goes
+# unnoticed.
+#--> returns the stamp of a regular file, or None if there is no such file
+def file_stamp(fname):
+    blksize = 65536
+    try:
+        if not os.path.isfile(fname):
+            return None
+        st = os.stat(fname)
+        fsize = st.st_size
+        f = open(fname, "rb")
+        fmd5 = hashlib.md5(f.read(blksize))
+        if fsize > blksize:
+            f.seek(max(blksize, fsize - blksize))
+            fmd5.update(f.read(blksize))
+        f.close()
+    except (IOError, OSError):
+        return None
+    return "%d:%r:%s" % (fsize, st.st_mtime, fmd5.hexdigest())
+
+def checkpoint_valid(cmd, inputs):
+    if not resumeStage:
+        return False
+    try:
+        mf = open(checkpoint_file(cmd))
+        manifest = json.load(mf)
+        mf.close()
+    except (IOError, ValueError):
+        return False
+    if manifest["cmd"] != cmd or sorted(manifest["inputs"].keys()) != sorted(inputs):
+        return False
+    for fname in inputs:
+        if manifest["inputs"][fname] != file_stamp(fname):
+            return False
+    for fname, fprint in manifest["outputs"].items():
+        if fprint == None or file_stamp(fname) != fprint:
+            return False
+    return True
+
+# Writes the checkpoint manifest of a step; outputs that were not created
+# are left out
+def write_checkpoint(cmd, inputs, outputs):
+    ckpt_dir = logging_dir + "checkpoints/"
+    try:
+        if not os.path.exists(ckpt_dir):
+            os.makedirs(ckpt_dir)
+    except OSError, o:
+        # concurrent workers may create it at the same time
+        if o.errno != errno.EEXIST:
+            raise
+    manifest = { "cmd" : cmd,
+                 "inputs" : dict([(f, file_stamp(f)) for f in inputs]),
+                 "outputs" : dict([(f, file_stamp(f)) for f in outputs if os.path.isfile(f)]) }
+    mfname = checkpoint_file(cmd)
+    tmp_mfname = "%s.%d.tmp" % (mfname, os.getpid())
+    mf = open(tmp_mfname, "w")
+    json.dump(manifest, mf, indent=1)
+    mf.flush()
+    os.fsync(mf.fileno())
+    mf.close()
+    os.rename(tmp_mfname, mfname)
+
 def setRunStage(stnum):
    global currentStage
-   print >> run_log, "#>"+stageNames[stnum]+":"
+   if not in_worker:
+      print >> run_log, "#>"+stageNames[stnum]+":"
+      stage_times.append((stnum, time.time()))
    currentStage = stnum
 
 def init_logger(log_fname):
@@ -362,6 +499,13 @@ class TopHatParams:
             self.keep_tmp = keep_tmp
             self.zipper = "gzip"
             self.zipper_opts= []
+            self.parallel_mates = False
+            self.parallel_segments = False
+            self.bowtie_mm = False
+            self.stream_segments = False
+            self.tmp_compression = None
+            self.zipper_level = None
+            self.bam_compression = -1
 
         def parse_options(self, opts):
             global use_zpacker
@@ -379,6 +523,16 @@ class TopHatParams:
                     #   self.zipper='gzip'
                 elif option in ("-X", "--unmapped-fifo"):
                     use_BWT_FIFO=True
+                elif option == "--parallel-mates":
+                    self.parallel_mates = True
+                elif option == "--parallel-segments":
+                    self.parallel_segments = True
+                elif option == "--bowtie-mm":
+                    self.bowtie_mm = True
+                elif option == "--stream-segments":
+                    self.stream_segments = True
+                elif option == "--tmp-compression":
+                    self.tmp_compression = value.lower()
             if self.zipper:
                 use_zpacker=True
                 if self.num_threads>1 and not self.zipper_opts:
@@ -395,8 +549,14 @@ class TopHatParams:
                  cmdline.extend(['-z',self.zipper])
             if self.num_threads>1:
                  cmdline.extend(['-p'+str(self.num_threads)])
+            cmdline.extend(self.bam_compression_cmd())
             return cmdline
 
+        def bam_compression_cmd(self):
+            if self.bam_compression < 0:
+                 return []
+            return ['--bam-compression', str(self.bam_compression)]
+
         def check(self):
             if self.num_threads<1 :
                  die("Error: arg to --num-threads must be greater than 0")
@@ -404,6 +564,9 @@ class TopHatParams:
                 xzip=which(self.zipper)
                 if not xzip:
                     die("Error: cannot find compression program "+self.zipper)
+            if self.tmp_compression and self.tmp_compression != "auto" and \
+                   self.tmp_compression not in TMP_COMPRESSION_POLICIES:
+                 die("Error: arg to --tmp-compression must be one of none, fast, balanced, max or auto")
 
     # ReadParams is a group of runtime parameters that specify various properties
     # of the user's reads (e.g. which quality scale their are on, how long the
@@ -551,6 +714,13 @@ class TopHatParams:
         def __init__(self):
             self.sort_bam = True
             self.convert_bam = True
+            self.sort_memory = None
+            self.region_merge = False
+            self.index_bam = True
+            self.index_unmapped = False
+            self.split_by_chrom = False
+            self.output_stream = None
+            self.stdout_fd = None # the original stdout, for --output-stream -
 
         def parse_options(self, opts):
             for option, value in opts:
@@ -558,6 +728,20 @@ class TopHatParams:
                     self.sort_bam = False
                 if option == "--no-convert-bam":
                     self.convert_bam = False
+                if option == "--sort-memory":
+                    self.sort_memory = parse_mem_size(value)
+                    if not self.sort_memory:
+                        die("Error: arg to --sort-memory must be a size such as 768M or 4G")
+                if option == "--region-merge":
+                    self.region_merge = True
+                if option == "--no-index-bam":
+                    self.index_bam = False
+                if option == "--index-unmapped":
+                    self.index_unmapped = True
+                if option == "--split-output-by-chrom":
+                    self.split_by_chrom = True
+                if option == "--output-stream":
+                    self.output_stream = value
 
     class Bowtie2Params:
         def __init__(self):
@@ -715,6 +899,7 @@ class TopHatParams:
         self.gff_annotation = None
         self.transcriptome_only = False
         self.transcriptome_index = None
+        self.transcriptome_key = None # content hash of the transcriptome inputs
         self.transcriptome_outdir = None
         self.transcriptome_buildonly = None
         self.raw_junctions = None
@@ -734,6 +919,7 @@ class TopHatParams:
         self.read_realign_edit_dist = None
         self.segment_length = 25
         self.segment_mismatches = 2
+        self.multiplex_segments = False
         self.bowtie_alignment_option = "-v"
         self.max_insertion_length = 3
         self.max_deletion_length = 3
@@ -772,6 +958,14 @@ class TopHatParams:
             die("Error: arg to --segment-length must at least 10")
         if self.segment_mismatches < 0 or self.segment_mismatches > 3:
             die("Error: arg to --segment-mismatches must in [0, 3]")
+        if self.report_params.split_by_chrom and \
+               not (self.report_params.sort_bam and self.report_params.convert_bam):
+            die("Error: --split-output-by-chrom requires sorted BAM output")
+        if self.report_params.output_stream:
+            if self.report_params.split_by_chrom:
+                die("Error: --output-stream cannot be used with --split-output-by-chrom")
+            # a stream cannot be indexed
+            self.report_params.index_bam = False
         if self.read_params.color:
             if self.bowtie2:
                 th_log("Warning: bowtie2 in colorspace is not supported; --bowtie1 option assumed.")
@@ -959,6 +1153,7 @@ class TopHatParams:
                                          "read-realign-edit-dist=",
                                          "segment-length=",
                                          "segment-mismatches=",
+                                         "multiplex-segments",
                                          "bowtie-n",
                                          "keep-tmp",
                                          "rg-id=",
@@ -970,14 +1165,26 @@ class TopHatParams:
                                          "rg-date=",
                                          "rg-platform=",
                                          "tmp-dir=",
+                                         "cache-dir=",
                                          "zpacker=",
                                          "unmapped-fifo",
+                                         "parallel-mates",
+                                         "parallel-segments",
+                                         "bowtie-mm",
+                                         "stream-segments",
+                                         "tmp-compression=",
                                          "max-insertion-length=",
                                          "max-deletion-length=",
                                          "insertions=",
                                          "deletions=",
                                          "no-sort-bam",
                                          "no-convert-bam",
+                                         "sort-memory=",
+                                         "region-merge",
+                                         "no-index-bam",
+                                         "index-unmapped",
+                                         "split-output-by-chrom",
+                                         "output-stream=",
                                          "report-secondary-alignments",
                                          "no-discordant",
                                          "no-mixed",
@@ -1017,6 +1224,7 @@ class TopHatParams:
         global output_dir
         global logging_dir
         global tmp_dir
+        global cache_dir
 
         custom_tmp_dir = None
         custom_out_dir = None
@@ -1102,6 +1310,8 @@ class TopHatParams:
                 self.segment_length = int(value)
             if option == "--segment-mismatches":
                 self.segment_mismatches = int(value)
+            if option == "--multiplex-segments":
+                self.multiplex_segments = True
             if option == "--bowtie-n":
                 self.bowtie_alignment_option = "-n"
             if option == "--max-insertion-length":
@@ -1128,6 +1338,8 @@ class TopHatParams:
                 self.resume_dir = value
             if option == "--tmp-dir":
                 custom_tmp_dir = value + "/"
+            if option == "--cache-dir":
+                cache_dir = value + "/"
 
         if self.transcriptome_only:
            self.find_novel_juncs=False
@@ -1158,9 +1370,9 @@ def nonzeroFile(filepath):
      fbase, fext =os.path.splitext(fname)
      if fext.lower() == ".bam":
          samtools_view_cmd = [samtools_path, "view", filepath]
-         samtools_view = subprocess.Popen(samtools_view_cmd, stdout=subprocess.PIPE)
+         samtools_view = TrackedPopen(samtools_view_cmd, stdout=subprocess.PIPE)
          head_cmd = ["head", "-1"]
-         head = subprocess.Popen(head_cmd, stdin=samtools_view.stdout, stdout=subprocess.PIPE)
+         head = TrackedPopen(head_cmd, stdin=samtools_view.stdout, stdout=subprocess.PIPE)
 
          samtools_view.stdout.close() # as per http://bugs.python.org/issue7678
          output = head.communicate()[0][:-1]
@@ -1180,6 +1392,12 @@ def fileExists(filepath, minfsize=2):
   else:
      return False
 
+def isFifo(filepath):
+  try:
+     return stat.S_ISFIFO(os.stat(filepath).st_mode)
+  except OSError:
+     return False
+
 def removeFileWithIndex(filepath):
     if os.path.exists(filepath):
         os.remove(filepath)
@@ -1257,6 +1475,111 @@ def prepare_output_dir():
           die("\nError creating directory %s (%s)" % (tmp_dir, o))
 
 
+# --tmp-compression policies: the level option given to the zpacker and the
+# zlib level of the temporary BAM files; "none" leaves the temporary
+# files uncompressed
+TMP_COMPRESSION_POLICIES = { "none":     (None, 0),
+                             "fast":     ("-1", 1),
+                             "balanced": ("-6", 6),
+                             "max":      ("-9", 9) }
+TMP_SPACE_FACTOR = 4 # temporary files written per byte of (uncompressed) input reads
+TMP_INPUT_RATIO = 4 # assumed compression ratio of compressed input reads
+TMP_PROBE_SIZE = 16 * 1024 * 1024
+
+# random FASTQ records, a stand-in for the temporary files in the throughput probe
+def probe_fastq_sample(size):
+    bases = string.maketrans("".join(map(chr, range(256))), "ACGT" * 64)
+    quals = string.maketrans("".join(map(chr, range(256))), "".join(map(chr, range(35, 75))) * 6 + "I" * 16)
+    seqs = os.urandom(size / 2).translate(bases)
+    qvs = os.urandom(size / 2).translate(quals)
+    rlen = 100
+    return "".join(["@probe_read_%d\n%s\n+\n%s\n" % (i, seqs[i:i+rlen], qvs[i:i+rlen])
+                    for i in xrange(0, len(seqs) - rlen + 1, rlen)])
+
+# measures the write throughput of dirname (through to the disk) and the
+# level 1 deflate throughput of one CPU, in bytes/sec
+def probe_tmp_throughput(dirname):
+    sample = probe_fastq_sample(TMP_PROBE_SIZE / 4)
+    t0 = time.time()
+    zlib.compress(sample, 1)
+    deflate_rate = len(sample) / max(time.time() - t0, 1e-6)
+    probe_file = os.path.join(dirname, ".tmp_compression.probe")
+    try:
+        t0 = time.time()
+        f = open(probe_file, "wb")
+        written = 0
+        while written < TMP_PROBE_SIZE:
+            f.write(sample)
+            written += len(sample)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        disk_rate = written / max(time.time() - t0, 1e-6)
+    finally:
+        if os.path.exists(probe_file):
+            os.remove(probe_file)
+    return (disk_rate, deflate_rate)
+
+# estimated size of the reads in the comma separated file lists, uncompressed
+def reads_input_size(reads_lists):
+    total = 0
+    for reads_list in reads_lists:
+        if not reads_list: continue
+        for fname in reads_list.split(","):
+            try:
+                fsize = os.path.getsize(fname)
+            except OSError:
+                continue
+            if re.search(r"\.(z|gz|gzip|bz2|bzip2|bzip|xz|bam)$", fname.lower()):
+                fsize *= TMP_INPUT_RATIO
+            total += fsize
+    return total
+
+# --tmp-compression auto: compress only when the scratch space is short or
+# when writing to it is slower than deflating what would be written
+def auto_tmp_compression(params, reads_lists):
+    st = os.statvfs(tmp_dir)
+    free_space = st.f_bavail * st.f_frsize
+    needed = TMP_SPACE_FACTOR * reads_input_size(reads_lists)
+    disk_rate, deflate_rate = probe_tmp_throughput(tmp_dir)
+    if needed > free_space:
+        policy = "balanced"
+    elif disk_rate >= deflate_rate:
+        policy = "none"
+    else:
+        policy = "fast"
+    th_logp("\tTemporary files: %.0f MB free for ~%.0f MB, disk %.0f MB/s vs. deflate %.0f MB/s: %s compression" %
+            (free_space / 1048576.0, needed / 1048576.0, disk_rate / 1048576.0, deflate_rate / 1048576.0, policy))
+    return policy
+
+# applies the --tmp-compression policy to the temporary files of the run;
+# the policy chosen by "auto" is kept for resuming the run
+def set_tmp_compression(params, reads_lists):
+    global use_zpacker
+    global use_BWT_FIFO
+    sys_params = params.system_params
+    policy = sys_params.tmp_compression
+    if not policy:
+        return
+    policy_file = logging_dir + "tmp_compression"
+    if policy == "auto":
+        if resumeStage > 0 and fileExists(policy_file):
+            policy = open(policy_file).read().strip()
+        else:
+            policy = auto_tmp_compression(params, reads_lists)
+    f = open(policy_file, "w")
+    f.write(policy + "\n")
+    f.close()
+    zipper_level, bam_compression = TMP_COMPRESSION_POLICIES[policy]
+    sys_params.bam_compression = bam_compression
+    if zipper_level is None:
+        sys_params.zipper = ""
+        use_zpacker = False
+        use_BWT_FIFO = False
+    elif sys_params.zipper:
+        # only for writing (see ZWriter), zipper_opts are also used with -cd
+        sys_params.zipper_level = zipper_level
+
 # to be added as preexec_fn for every subprocess.Popen() call:
 # see http://bugs.python.org/issue1652
 def subprocess_setup():
@@ -1264,6 +1587,337 @@ def subprocess_setup():
  # gzip or other de/compression pipes to complain about "stdout: Broken pipe"
    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
+# splits a thread budget into num_parts shares of at least one thread each
+def split_threads(num_threads, num_parts):
+    shares = [num_threads / num_parts] * num_parts
+    for i in range(num_threads % num_parts):
+        shares[i] += 1
+    return [max(1, n) for n in shares]
+
+# Runs func(*args) in a forked child process; the (picklable) return value
+# is sent back to the parent through a pipe and collected by result().
+# A die() in the child terminates only the child, result() then fails the run
+# after terminating the other workers.
+# The workers forked by the main process lead their own process group, which
+# the programs they run (and their own workers) join, so that a worker can be
+# terminated with everything it started.
+class ForkedCall:
+    def __init__(self, func, *args):
+        global in_worker, bowtie_idx_runs, resource_records, live_workers, worker_result_fd
+        self.name = func.__name__
+        self.own_group = not in_worker
+        sys.stdout.flush()
+        sys.stderr.flush()
+        rfd, wfd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(rfd)
+            if self.own_group:
+                os.setpgid(0, 0)
+            # the parent sees the end of the result only when no process
+            # holds the pipe open: not the programs run by this worker, nor
+            # the workers it forks (which close the pipe of their parent)
+            if worker_result_fd is not None:
+                os.close(worker_result_fd)
+            worker_result_fd = wfd
+            fcntl.fcntl(wfd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            in_worker = True
+            bowtie_idx_runs = {}
+            resource_records = []
+            live_workers = []
+            retcode = 0
+            try:
+                ret = func(*args)
+                wfile = os.fdopen(wfd, "wb")
+                # the worker's bookkeeping travels back with its result
+                cPickle.dump((ret, bowtie_idx_runs, resource_records), wfile, cPickle.HIGHEST_PROTOCOL)
+                wfile.close()
+            except SystemExit, e:
+                retcode = 1
+                if e.code in (0, None):
+                    retcode = 0
+            except:
+                traceback.print_exc()
+                retcode = 1
+            os._exit(retcode)
+        if self.own_group:
+            try:
+                os.setpgid(self.pid, self.pid) # before the child gets to it
+            except OSError:
+                pass # the child has already done it
+        os.close(wfd)
+        self.rfile = os.fdopen(rfd, "rb")
+        live_workers.append(self)
+
+    def fileno(self):
+        return self.rfile.fileno()
+
+    # signals the worker, with its process group when it has one (the group
+    # outlives the worker as long as any program it started is running)
+    def kill(self, sig=signal.SIGTERM):
+        try:
+            if self.own_group:
+                os.killpg(self.pid, sig)
+            else:
+                os.kill(self.pid, sig)
+        except OSError:
+            pass # all gone already
+
+    # terminates and reaps a worker whose result is not needed
+    def terminate(self):
+        self.kill()
+        self.rfile.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        if self in live_workers:
+            live_workers.remove(self)
+
+    def result(self):
+        # read everything first, so a large result cannot block the child
+        data = self.rfile.read()
+        self.rfile.close()
+        pid, status = os.waitpid(self.pid, 0)
+        live_workers.remove(self)
+        if status != 0 or not data:
+            # the programs the failed worker left behind and the other
+            # workers would keep running after the run has failed
+            self.kill()
+            terminate_workers()
+            die(fail_str+"Error: worker process for "+self.name+" failed.")
+        ret, idx_runs, resources = cPickle.loads(data)
+        for idx_prefix, runs in idx_runs.items():
+            bowtie_idx_runs[idx_prefix] = bowtie_idx_runs.get(idx_prefix, 0) + runs
+        resource_records.extend(resources)
+        return ret
+
+# terminates all the running ForkedCall workers of this process
+def terminate_workers():
+    for worker in live_workers[:]:
+        worker.terminate()
+
+# Runs jobs in ForkedCall worker processes while keeping the number of CPU
+# tokens held by the running jobs within a fixed budget (usually -p).
+# A job asking for more tokens than the budget is given the whole budget.
+class TokenScheduler:
+    def __init__(self, num_tokens):
+        self.num_tokens = max(1, num_tokens)
+        self.jobs = [] # [tokens, func, args, deps]
+
+    def add(self, tokens, func, *args):
+        return self.add_job(tokens, [], func, args)
+
+    # deps: indices of the jobs that must be finished before this one starts
+    def add_job(self, tokens, deps, func, args):
+        self.jobs.append([min(max(1, tokens), self.num_tokens), func, args, deps])
+        return len(self.jobs)-1
+
+    #--> returns the list of job results, in the order the jobs were added
+    def run(self):
+        results = [None] * len(self.jobs)
+        done = [False] * len(self.jobs)
+        pending = range(len(self.jobs))
+        running = {} # ForkedCall -> job index
+        free_tokens = self.num_tokens
+        while pending or running:
+            # start the ready jobs in the order they were added; a ready job
+            # waiting for tokens holds back the jobs added after it
+            for j in pending[:]:
+                tokens, func, args, deps = self.jobs[j]
+                if [d for d in deps if not done[d]]:
+                    continue
+                if tokens > free_tokens:
+                    break
+                pending.remove(j)
+                free_tokens -= tokens
+                running[ForkedCall(func, *args)] = j
+            if not running:
+                die(fail_str+"Error: circular dependency between pipeline tasks.")
+            # a worker's pipe becomes readable only when it is done
+            ready, w, x = select.select(running.keys(), [], [])
+            for worker in ready:
+                j = running.pop(worker)
+                results[j] = worker.result()
+                done[j] = True
+                free_tokens += self.jobs[j][0]
+        return results
+
+# A TokenScheduler for pipeline steps declared with the files they read and
+# write: a task starts only after the tasks producing its input files are
+# done, independent tasks run concurrently within the token budget.
+class TaskGraph(TokenScheduler):
+    def __init__(self, num_tokens):
+        TokenScheduler.__init__(self, num_tokens)
+        self.producers = {} # output file -> task index
+
+    def add_task(self, tokens, inputs, outputs, func, *args):
+        deps = []
+        for fname in inputs:
+            if fname in self.producers and self.producers[fname] not in deps:
+                deps.append(self.producers[fname])
+        t = self.add_job(tokens, deps, func, args)
+        for fname in outputs:
+            if fname in self.producers:
+                die(fail_str+"Error: pipeline file "+fname+" has more than one producer.")
+            self.producers[fname] = t
+        return t
+
+# Pipes to and from the helper programs get large Python-side buffers (the
+# Python 2 default is unbuffered) and, on Linux, a larger kernel pipe
+# (F_SETPIPE_SZ is missing from Python 2's fcntl module)
+PIPE_BUFSIZE = 1024 * 1024
+F_SETPIPE_SZ = 1031
+PIPE_CAPACITY = 1024 * 1024
+
+def enlarge_pipe(pipe_file):
+    try:
+        fcntl.fcntl(pipe_file.fileno(), F_SETPIPE_SZ, PIPE_CAPACITY)
+    except (IOError, OSError):
+        pass # not Linux, or above /proc/sys/fs/pipe-max-size
+
+# A subprocess.Popen that reaps its process with os.wait4() in order to
+# record the wall time, CPU time, peak RSS and block I/O of every program
+# run by the pipeline into resource_records. The processes of a pipe chain
+# share the same pipeline name (given with the extra pipeline= argument),
+# a program run on its own is a pipeline by itself.
+class TrackedPopen(subprocess.Popen):
+    def __init__(self, args, **kwargs):
+        pipeline = kwargs.pop("pipeline", None)
+        kwargs.setdefault("bufsize", PIPE_BUFSIZE)
+        self.start_time = time.time()
+        self.stage = stageNames[currentStage]
+        subprocess.Popen.__init__(self, args, **kwargs)
+        for pipe_file in (self.stdin, self.stdout):
+            if pipe_file is not None:
+                enlarge_pipe(pipe_file)
+        if isinstance(args, basestring):
+            args = args.split()
+        self.program = os.path.basename(args[0])
+        self.pipeline = pipeline or self.program
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, sts, rusage = os.wait4(self.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid, sts, rusage = self.pid, 0, None
+            if pid == self.pid:
+                self._handle_exitstatus(sts)
+                self.record_resources(rusage)
+        return self.returncode
+
+    def _internal_poll(self, _deadstate=None, *args, **kwargs):
+        if self.returncode is None:
+            try:
+                pid, sts, rusage = os.wait4(self.pid, os.WNOHANG)
+                if pid == self.pid:
+                    self._handle_exitstatus(sts)
+                    self.record_resources(rusage)
+            except OSError:
+                if _deadstate is not None:
+                    self.returncode = _deadstate
+        return self.returncode
+
+    def record_resources(self, rusage):
+        end_time = time.time()
+        rec = { "program" : self.program,
+                "pipeline" : self.pipeline,
+                "stage" : self.stage,
+                "pid" : self.pid,
+                "exit_code" : self.returncode,
+                "start_time" : self.start_time,
+                "end_time" : end_time,
+                "wall_sec" : end_time - self.start_time }
+        if rusage:
+            rec["user_sec"] = rusage.ru_utime
+            rec["sys_sec"] = rusage.ru_stime
+            rec["max_rss_kb"] = rusage.ru_maxrss
+            # block counts are in 512 byte units
+            rec["read_bytes"] = rusage.ru_inblock * 512
+            rec["write_bytes"] = rusage.ru_oublock * 512
+        resource_records.append(rec)
+
+def tracked_call(*popenargs, **kwargs):
+    return TrackedPopen(*popenargs, **kwargs).wait()
+
+# Writes logs/resources.json and a summary of the resource usage of each
+# program in each stage at the end of tophat.log
+def report_resources():
+    try:
+        rf = open(logging_dir + "resources.json", "w")
+        json.dump(resource_records, rf, indent=1)
+        rf.close()
+    except IOError, o:
+        th_logp("Warning: could not write resource usage file: "+str(o))
+    summary = {} # (stage, program) -> [runs, wall, cpu, max_rss_kb, read_bytes, write_bytes]
+    for rec in resource_records:
+        k = (runStages[rec["stage"]], rec["program"])
+        if k not in summary:
+            summary[k] = [0, 0.0, 0.0, 0, 0, 0]
+        row = summary[k]
+        row[0] += 1
+        row[1] += rec["wall_sec"]
+        row[2] += rec.get("user_sec", 0.0) + rec.get("sys_sec", 0.0)
+        row[3] = max(row[3], rec.get("max_rss_kb", 0))
+        row[4] += rec.get("read_bytes", 0)
+        row[5] += rec.get("write_bytes", 0)
+    if not summary:
+        return
+    th_logp("Resource usage by stage (details in %sresources.json):" % logging_dir)
+    th_logp("  %-14s %-22s %4s %10s %10s %11s %10s %10s" % ("stage", "program", "runs",
+            "wall(s)", "cpu(s)", "peakRSS(MB)", "read(MB)", "write(MB)"))
+    for k in sorted(summary.keys()):
+        runs, wall, cpu, max_rss, rbytes, wbytes = summary[k]
+        th_logp("  %-14s %-22s %4d %10.1f %10.1f %11.1f %10.1f %10.1f" % (stageNames[k[0]], k[1], runs,
+                wall, cpu, max_rss / 1024.0, rbytes / 1048576.0, wbytes / 1048576.0))
+
+# Writes logs/timeline.json in the Chrome trace event format (viewable with
+# chrome://tracing or Perfetto): the stages of the run are shown as the first
+# track, followed by one track for each pipeline with a row for each of
+# its processes.
+def write_timeline():
+    if not stage_times:
+        return
+    # programs can start before the first stage is recorded (the index
+    # checks), the timeline starts with whatever started first
+    t0 = min([st[1] for st in stage_times] + [rec["start_time"] for rec in resource_records])
+    def usec(t):
+        return int((t - t0) * 1000000)
+    events = [ { "name" : "process_name", "ph" : "M", "pid" : 0,
+                 "args" : { "name" : "TopHat stages" } } ]
+    stage_ends = [st[1] for st in stage_times[1:]] + [time.time()]
+    for (stnum, start), end in zip(stage_times, stage_ends):
+        events.append({ "name" : stageNames[stnum], "cat" : "stage", "ph" : "X",
+                        "pid" : 0, "tid" : 0,
+                        "ts" : usec(start), "dur" : usec(end) - usec(start) })
+    pipelines = {}
+    for rec in sorted(resource_records, key=lambda r: r["start_time"]):
+        if rec["pipeline"] not in pipelines:
+            pipelines[rec["pipeline"]] = len(pipelines) + 1
+            events.append({ "name" : "process_name", "ph" : "M",
+                            "pid" : pipelines[rec["pipeline"]],
+                            "args" : { "name" : rec["pipeline"] } })
+        events.append({ "name" : "thread_name", "ph" : "M",
+                        "pid" : pipelines[rec["pipeline"]], "tid" : rec["pid"],
+                        "args" : { "name" : rec["program"] } })
+        events.append({ "name" : rec["program"], "cat" : rec["stage"], "ph" : "X",
+                        "pid" : pipelines[rec["pipeline"]], "tid" : rec["pid"],
+                        "ts" : usec(rec["start_time"]),
+                        "dur" : usec(rec["end_time"]) - usec(rec["start_time"]),
+                        "args" : dict([(k, v) for (k, v) in rec.items()
+                                       if k not in ("start_time", "end_time")]) })
+    try:
+        tf = open(logging_dir + "timeline.json", "w")
+        json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, tf)
+        tf.close()
+    except IOError, o:
+        th_logp("Warning: could not write timeline file: "+str(o))
+
 # Check that the Bowtie index specified by the user is present and all files
 # are there.
 def check_bowtie_index(idx_prefix, is_bowtie2, add="(genome)"):
@@ -1322,14 +1976,135 @@ def check_bowtie_index(idx_prefix, is_bowtie2, add="(genome)"):
         else:
             die(bwtidxerr)
 
+# Returns the list of files of the Bowtie index with the given prefix
+def bowtie_index_files(idx_prefix, is_bowtie2):
+    if is_bowtie2:
+        idxexts = ["bt2", "bt2l"]
+        bwtidx_env = os.environ.get("BOWTIE2_INDEXES")
+    else:
+        idxexts = ["ebwt"]
+        bwtidx_env = os.environ.get("BOWTIE_INDEXES")
+    for idx_dir in ["", bwtidx_env]:
+        if idx_dir == None:
+            continue
+        for idxext in idxexts:
+            idx_files = glob.glob(idx_dir + idx_prefix + ".*." + idxext)
+            if idx_files:
+                return sorted(idx_files)
+    return []
+
+# Metadata derived from a Bowtie index (its @SQ header lines and the
+# reference FASTA rebuilt from the index) is cached so it is computed once
+# per index instead of once per run. The cache is only kept when --cache-dir
+# is given (the rebuilt FASTA is as large as the genome), in a subdirectory
+# keyed on the names, sizes and modification times of the index files.
+#--> returns the cache directory for the index, or None if it is not usable
+def index_cache_dir(idx_prefix, is_bowtie2):
+    if not cache_dir:
+        return None
+    idx_files = bowtie_index_files(idx_prefix, is_bowtie2)
+    if not idx_files:
+        return None
+    idx_dir = os.path.dirname(os.path.abspath(idx_files[0])) + "/"
+    if idx_dir.startswith(os.path.abspath(tmp_dir) + "/"):
+        # indexes built by this run are not worth caching
+        return None
+    idx_cache = cache_dir + "index/" + os.path.basename(idx_prefix) + "." + index_fingerprint(idx_files)[:16] + "/"
+    if not os.path.isdir(idx_cache):
+        try:
+            os.makedirs(idx_cache)
+        except OSError:
+            # a concurrent run may have just created it, otherwise the
+            # location is not writable and we go without the cache
+            if not os.path.isdir(idx_cache):
+                return None
+    return idx_cache
+
+# hash of the names, sizes and modification times of the index files
+def index_fingerprint(idx_files):
+    idx_key = hashlib.sha1()
+    for idx_file in idx_files:
+        st = os.stat(idx_file)
+        idx_key.update("%s\t%d\t%d\n" % (os.path.basename(idx_file), st.st_size, int(st.st_mtime)))
+    return idx_key.hexdigest()
+
+# Takes an exclusive lock on the given lock file, waiting for the run that
+# holds it if needed; returns the open lock file, see unlock_file()
+def lock_file(lock_fname, what):
+    lockf = open(lock_fname, "a")
+    try:
+        fcntl.flock(lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        th_log("Waiting for another TopHat run to finish "+what)
+        fcntl.flock(lockf.fileno(), fcntl.LOCK_EX)
+    return lockf
+
+def unlock_file(lockf):
+    fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+    lockf.close()
+
+# Writes a file into the cache under a temporary name first, so concurrent
+# runs never see it partially written; failures only disable the caching
+def write_cache_file(fname, lines):
+    tmp_fname = "%s.%d.tmp" % (fname, os.getpid())
+    try:
+        f = open(tmp_fname, "w")
+        f.writelines(lines)
+        f.close()
+        os.rename(tmp_fname, fname)
+    except (IOError, OSError), o:
+        th_logp("Warning: could not write cache file "+fname+": "+str(o))
+
+# Reads the Bowtie index files once so they are resident in the page cache.
+# Bowtie runs started with --mm then map these pages instead of each loading
+# a private copy of the index, and so do concurrent TopHat runs on the host.
+def preload_bowtie_index(idx_prefix, is_bowtie2):
+    if idx_prefix in preloaded_idx:
+        return
+    th_log("Preloading Bowtie index "+idx_prefix)
+    start_time = datetime.now()
+    idx_bytes = 0
+    for idx_file in bowtie_index_files(idx_prefix, is_bowtie2):
+        try:
+            f = open(idx_file, "rb")
+            while True:
+                buf = f.read(16*1024*1024)
+                if not buf:
+                    break
+                idx_bytes += len(buf)
+            f.close()
+        except IOError, o:
+            th_logp("Warning: could not preload Bowtie index file "+idx_file+": "+str(o))
+    preloaded_idx[idx_prefix] = (idx_bytes, datetime.now() - start_time)
+
+# Logs how much index loading time was saved by preloading the Bowtie indexes:
+# without --mm each Bowtie run would have read the whole index again
+def report_index_preload():
+    for idx_prefix in sorted(preloaded_idx.keys()):
+        idx_bytes, load_time = preloaded_idx[idx_prefix]
+        runs = bowtie_idx_runs.get(idx_prefix, 0)
+        th_logp("Bowtie index %s (%.1f MB) was preloaded in %s and shared by %d Bowtie runs" %
+                (idx_prefix, idx_bytes / 1048576.0, formatTD(load_time), runs))
+
 # Reconstructs the multifasta file from which the Bowtie index was created, if
 # it's not already there.
 def bowtie_idx_to_fa(idx_prefix, is_bowtie2):
     idx_name = idx_prefix.split('/')[-1]
+    fasta_file_name = tmp_dir + idx_name + ".fa"
+    idx_cache = index_cache_dir(idx_prefix, is_bowtie2)
+    if idx_cache:
+        fasta_file_name = idx_cache + idx_name + ".fa"
+        if os.path.exists(fasta_file_name):
+            th_log("Using reference FASTA file reconstituted from the Bowtie index in " + idx_cache)
+            return fasta_file_name
     th_log("Reconstituting reference FASTA file from Bowtie index")
 
     try:
-        tmp_fasta_file_name = tmp_dir + idx_name + ".fa"
+        tmp_fasta_file_name = fasta_file_name
+        if idx_cache:
+            tmp_fasta_file_name = "%s.%d.tmp" % (fasta_file_name, os.getpid())
         tmp_fasta_file = open(tmp_fasta_file_name, "w")
 
         inspect_log = open(logging_dir + "bowtie_inspect_recons.log", "w")
@@ -1342,19 +2117,22 @@ def bowtie_idx_to_fa(idx_prefix, is_bowtie2):
         inspect_cmd += [idx_prefix]
 
         th_logp("  Executing: " + " ".join(inspect_cmd) + " > " + tmp_fasta_file_name)
-        ret = subprocess.call(inspect_cmd,
+        ret = tracked_call(inspect_cmd,
                               stdout=tmp_fasta_file,
                               stderr=inspect_log)
         # Bowtie reported an error
         if ret != 0:
            die(fail_str+"Error: bowtie-inspect returned an error\n"+log_tail(logging_dir + "bowtie_inspect_recons.log"))
+        tmp_fasta_file.close()
+        if tmp_fasta_file_name != fasta_file_name:
+           os.rename(tmp_fasta_file_name, fasta_file_name)
 
     # Bowtie not found
     except OSError, o:
         if o.errno == errno.ENOTDIR or o.errno == errno.ENOENT:
             die(fail_str+"Error: bowtie-inspect not found on this system.  Did you forget to include it in your PATH?")
 
-    return tmp_fasta_file_name
+    return fasta_file_name
 
 # Checks whether the multifasta file for the genome is present alongside the
 # Bowtie index files for it.
@@ -1389,7 +2167,7 @@ def check_index(idx_prefix, is_bowtie2):
 def get_bowtie_version():
     try:
         # Launch Bowtie to capture its version info
-        proc = subprocess.Popen([bowtie_path, "--version"],
+        proc = TrackedPopen([bowtie_path, "--version"],
                           stdout=subprocess.PIPE)
 
         stdout_value = proc.communicate()[0]
@@ -1412,6 +2190,18 @@ def get_bowtie_version():
            errmsg+="Error: bowtie not found on this system"
        die(errmsg)
 
+# Stores the @SQ lines of an index header (in index order) into the index cache
+def cache_index_header(idx_cache, header_lines):
+    sq_lines = [line for line in header_lines if line.startswith("@SQ")]
+    for line in sq_lines:
+        fields = dict([col.split(':', 1) for col in line.rstrip('\n').split('\t')[1:] if ':' in col])
+        if "SN" not in fields or "LN" not in fields:
+            # not a header we can rely on
+            return
+    if not sq_lines:
+        return
+    write_cache_file(idx_cache + "sq_header.sam", sq_lines)
+
 def get_index_sam_header(params, idx_prefix, name = ""):
     noSkip = currentStage >= resumeStage
     try:
@@ -1434,12 +2224,20 @@ def get_index_sam_header(params, idx_prefix, name = ""):
 
         bowtie_header_cmd.extend([idx_prefix, '/dev/null'])
         if noSkip:
-           subprocess.call(bowtie_header_cmd,
-                   stdout=temp_sam_header_file,
-                   stderr=open('/dev/null'))
+           idx_cache = index_cache_dir(idx_prefix, params.bowtie2)
+           if idx_cache and os.path.exists(idx_cache + "sq_header.sam"):
+              temp_sam_header_file.close()
+              temp_sam_header_file = open(idx_cache + "sq_header.sam", "r")
+           else:
+              tracked_call(bowtie_header_cmd,
+                      stdout=temp_sam_header_file,
+                      stderr=open('/dev/null'))
 
-           temp_sam_header_file.close()
-           temp_sam_header_file = open(temp_sam_header_filename, "r")
+              temp_sam_header_file.close()
+              temp_sam_header_file = open(temp_sam_header_filename, "r")
+              if idx_cache:
+                 cache_index_header(idx_cache, temp_sam_header_file.readlines())
+                 temp_sam_header_file.seek(0)
 
         bowtie_sam_header_filename = tmp_dir + idx_prefix.split('/')[-1]
         if name != "":
@@ -1547,7 +2345,7 @@ def check_bowtie(params):
 def get_samtools_version():
     try:
         # Launch Bowtie to capture its version info
-        proc = subprocess.Popen(samtools_path, stderr=subprocess.PIPE)
+        proc = TrackedPopen(samtools_path, stderr=subprocess.PIPE)
         samtools_out = proc.communicate()[1]
 
         # Find the version identifier
@@ -1580,40 +2378,79 @@ def check_samtools():
 
 
 
+# FastxReader parses FASTA/FASTQ records out of a buffer filled in large
+# blocks (or a read-only mmap of an uncompressed regular file). Records are
+# returned by nextRecord() or in batches by next_batch(); iterating over the
+# reader yields all the remaining records.
+FASTX_BLOCK_SIZE = 1024 * 1024
+FASTX_BATCH_SIZE = 10000
+
 class FastxReader:
   def __init__(self, i_file, is_color=0, fname=''):
-    self.bufline=None
     self.format=None
     self.ifile=i_file
     self.nextRecord=None
     self.eof=None
     self.fname=fname
-    self.lastline=None
+    self.buf=""
+    self.pos=0
+    self.lastpos=None
+    self.mmap=None
     self.numrecords=0
     self.isColor=0
     if is_color : self.isColor=1
+    try:
+      st=os.fstat(i_file.fileno())
+      if stat.S_ISREG(st.st_mode) and st.st_size>0 and i_file.tell()==0:
+        self.mmap=mmap.mmap(i_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf=self.mmap
+        self.eof=1 # nothing more to read
+    except (AttributeError, IOError, OSError, ValueError):
+      pass
     # determine file type
     #no records processed yet, skip custom header lines if any
     hlines=10 # allow maximum 10 header lines
-    self.lastline=" "
-    while hlines>0 and self.lastline[0] not in "@>" :
-       self.lastline=self.ifile.readline()
+    line=" "
+    while hlines>0 and line and line[0] not in "@>" :
+       line=self.getLine()
        hlines-=1
-    if self.lastline[0] == '@':
+    if line and line[0] == '@':
       self.format='fastq'
       self.nextRecord=self.nextFastq
-    elif self.lastline[0] == '>':
+    elif line and line[0] == '>':
       self.format='fasta'
       self.nextRecord=self.nextFasta
     else:
       die("Error: cannot determine record type in input file %s" % fname)
-    self.bufline=self.lastline
-    self.lastline=None
+    self.ungetLine()
 
   def nextFastq(self):
     # returning tuple: (seqID, sequence_string, seq_len, qv_string)
+    buf, pos = self.buf, self.pos
+    # fast path: a complete 4 line record is in the buffer
+    e1 = buf.find("\n", pos)
+    e2 = e3 = e4 = -1
+    if e1 >= 0: e2 = buf.find("\n", e1 + 1)
+    if e2 >= 0: e3 = buf.find("\n", e2 + 1)
+    if e3 >= 0: e4 = buf.find("\n", e3 + 1)
+    if e4 >= 0 and buf[pos] == "@" and buf[e2 + 1] == "+":
+      seqstr = buf[e1+1:e2].rstrip()
+      qstr = buf[e3+1:e4].rstrip()
+      seq_len, qstrlen = len(seqstr), len(qstr)
+      if self.isColor and qstrlen == seq_len:
+        qstr = qstr[1:]
+        qstrlen -= 1
+      if qstrlen == seq_len - self.isColor:
+        self.pos = e4 + 1
+        self.numrecords+=1
+        if self.isColor :
+          seq_len-=1
+          seqstr = seqstr[1:]
+        return (buf[pos+1:e1].rstrip(), seqstr, seq_len, qstr)
+    return self.parseFastq()
+
+  def parseFastq(self):
     seqid,seqstr,qstr,seq_len='','','',0
-    if self.eof: return (seqid, seqstr, seq_len, qstr)
     fline=self.getLine #shortcut to save a bit of time
     line=fline()
 
@@ -1626,7 +2463,7 @@ class FastxReader:
           raise ValueError("Records in Fastq files should start with '@' character")
 
       seqid = line[1:].rstrip()
-      seqstr = fline().rstrip()
+      seqlines = [fline().rstrip()]
 
       #There may now be more sequence lines, or the "+" quality marker line:
       while True:
@@ -1635,25 +2472,24 @@ class FastxReader:
              raise ValueError("Premature end of file (missing quality values for "+seqid+")")
           if line[0] == "+":
              # -- sequence string ended
-             #qtitle = line[1:].rstrip()
-             #if qtitle and qtitle != seqid:
-             #   raise ValueError("Different read ID for sequence and quality (%s vs %s)" \
-             #                    % (seqid, qtitle))
              break
-          seqstr += line.rstrip() #removes trailing newlines
+          seqlines.append(line.rstrip()) #removes trailing newlines
           #loop until + found
+      seqstr = "".join(seqlines)
       seq_len = len(seqstr)
       #at least one line of quality data should follow
+      qlines=[]
       qstrlen=0
       #now read next lines as quality values until seq_len is reached
       while True:
           line=fline()
           if not line : break #end of file
-          qstr += line.rstrip()
-          qstrlen=len(qstr)
+          qlines.append(line.rstrip())
+          qstrlen+=len(qlines[-1])
           if qstrlen + self.isColor >= seq_len :
                break # qv string has reached the length of seq string
           #loop until qv has the same length as seq
+      qstr = "".join(qlines)
 
       if self.isColor:
            # and qstrlen==seq_len :
@@ -1682,7 +2518,7 @@ class FastxReader:
     # returning tuple: (seqID, sequence_string, seq_len)
     seqid,seqstr,seq_len='','',0
     fline=self.getLine # shortcut to readline function of f
-    line=fline() # this will use the buffer line if it's there
+    line=fline()
     if not line : return (seqid, seqstr, seq_len, None)
     while len(line.rstrip())==0: # skip empty lines
       line=fline()
@@ -1692,6 +2528,7 @@ class FastxReader:
           raise ValueError("Records in Fasta files must start with '>' character")
        seqid = line[1:].split()[0]
        #more sequence lines, or the ">" quality marker line:
+       seqlines = []
        while True:
           line = fline()
           if not line: break
@@ -1699,8 +2536,9 @@ class FastxReader:
              #next sequence starts here
              self.ungetLine()
              break
-          seqstr += line.rstrip()
+          seqlines.append(line.rstrip())
           #loop until '>' found
+       seqstr = "".join(seqlines)
        seq_len = len(seqstr)
        if seq_len < 3:
           raise ValueError("Read %s too short (%i)." \
@@ -1714,23 +2552,56 @@ class FastxReader:
         seqstr=seqstr[1:]
     return (seqid, seqstr, seq_len, None)
 
+  # returns a list of up to n records, an empty list at the end of the input
+  def next_batch(self, n=FASTX_BATCH_SIZE):
+    batch=[]
+    nextRecord=self.nextRecord
+    while len(batch) < n:
+      rec=nextRecord()
+      if not rec[0]: break
+      batch.append(rec)
+    return batch
+
+  def __iter__(self):
+    while True:
+      batch=self.next_batch()
+      if not batch: return
+      for rec in batch:
+        yield rec
+
+  def fill(self):
+      data=self.ifile.read(FASTX_BLOCK_SIZE)
+      if not data:
+         self.eof=1
+         return
+      self.buf=self.buf[self.pos:]+data
+      self.pos=0
+
   def getLine(self):
-      if self.bufline: #return previously buffered line
-         r=self.bufline
-         self.bufline=None
-         return r
-      else: #read a new line from stream and return it
-         if self.eof: return None
-         self.lastline=self.ifile.readline()
-         if not self.lastline:
-            self.eof=1
-            return None
-         return self.lastline
+      buf=self.buf
+      end=buf.find("\n", self.pos)
+      while end < 0 and not self.eof:
+         self.fill()
+         buf=self.buf
+         end=buf.find("\n", self.pos)
+      if end < 0:
+         if self.pos >= len(buf): return None
+         end=len(buf)-1 # last line, no newline
+      self.lastpos=self.pos
+      self.pos=end+1
+      return buf[self.lastpos:self.pos]
   def ungetLine(self):
-      if self.lastline is None:
+      if self.lastpos is None:
          th_logp("Warning: FastxReader called ungetLine() with no prior line!")
-      self.bufline=self.lastline
-      self.lastline=None
+         return
+      self.pos=self.lastpos
+      self.lastpos=None
+
+  def close(self):
+      if self.mmap:
+         self.mmap.close()
+         self.mmap=None
+      self.buf=""
 #< class FastxReader
 
 def fa_write(fhandle, seq_id, seq):
@@ -1753,8 +2624,182 @@ def fa_write(fhandle, seq_id, seq):
              end = len(seq)
         fhandle.write( seq[ start:end ] + "\n")
 
+# In-process gzip decompression, see InflateReader
+INFLATE_CHUNK_SIZE = 4 * 1024 * 1024
+INFLATE_SAMPLE_SIZE = 64 * 1024 # for a look at the first few records
+GZIP_MAGIC = "\x1f\x8b"
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+
+# Yields the decompressed data of a BGZF (or any multi-member gzip) file,
+# about chunk_size compressed bytes at a time; head is data already read
+# from the start of f. Zero bytes after the last member (tape padding) are
+# ignored, as gzip does.
+def gunzip_chunks(f, chunk_size=INFLATE_CHUNK_SIZE, head=""):
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_start = True
+    padding = False
+    started = False
+    while True:
+        data = head + f.read(chunk_size)
+        head = ""
+        if not data:
+            break
+        started = True
+        out = []
+        while data:
+            if padding or (member_start and data[0] == "\0"):
+                if data.strip("\0"):
+                    raise ValueError("trailing garbage after gzip data")
+                padding = True
+                break
+            out.append(d.decompress(data))
+            member_start = False
+            data = d.unused_data
+            if data:
+                # the next gzip member (BGZF block)
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                member_start = True
+        yield "".join(out)
+    if started and not padding:
+        # an ended gzip member leaves any more input unused
+        try:
+            d.decompress("\0")
+            ended = d.unused_data == "\0"
+        except zlib.error:
+            ended = False
+        if not ended:
+            raise ValueError("truncated gzip file")
+
+#--> returns the total size of the BGZF block at buf[p:], 0 if buf does not
+# hold its whole header yet, or None if it is not a BGZF block
+def bgzf_block_size(buf, p=0):
+    if len(buf) < p + 12:
+        return 0
+    if buf[p:p+4] != BGZF_MAGIC:
+        return None
+    q = p + 12
+    xend = q + struct.unpack_from("<H", buf, p + 10)[0]
+    if len(buf) < xend:
+        return 0
+    while q + 4 <= xend:
+        slen = struct.unpack_from("<H", buf, q + 2)[0]
+        if buf[q:q+2] == "BC" and slen == 2:
+            return struct.unpack_from("<H", buf, q + 4)[0] + 1
+        q += 4 + slen
+    return None
+
+# Inflates a whole BGZF block (run by the threads of InflateReader, zlib
+# releases the GIL while inflating)
+def inflate_bgzf_block(block):
+    xlen = struct.unpack_from("<H", block, 10)[0]
+    data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(block[12+xlen:-8])
+    (crc, isize) = struct.unpack_from("<II", block, len(block) - 8)
+    if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+        raise ValueError("corrupt BGZF block")
+    return data
+
+# Yields the decompressed data of a BGZF file, inflating all the blocks of
+# each chunk_size of compressed data in parallel with pool
+def bgzf_chunks(f, pool, chunk_size=INFLATE_CHUNK_SIZE, head=""):
+    buf = head
+    padding = False
+    while True:
+        data = f.read(chunk_size)
+        buf += data
+        blocks = []
+        p = 0
+        while p < len(buf):
+            if padding or buf[p] == "\0":
+                # zero padding after the last block, see gunzip_chunks()
+                if buf[p:].strip("\0"):
+                    raise ValueError("trailing garbage after BGZF data")
+                padding = True
+                p = len(buf)
+                break
+            bsize = bgzf_block_size(buf, p)
+            if bsize is None:
+                raise ValueError("not a BGZF block at offset %d" % p)
+            if not bsize or p + bsize > len(buf):
+                break
+            blocks.append(buf[p:p+bsize])
+            p += bsize
+        buf = buf[p:]
+        if blocks:
+            yield "".join(pool.map(inflate_bgzf_block, blocks))
+        if not data:
+            if buf:
+                raise ValueError("truncated BGZF file")
+            return
+
+# InflateReader is a file-like reader of a gzip file decompressed in this
+# process, whichever program -z names. The blocks of a BGZF file (bgzip,
+# samtools) are independent and are inflated by a pool of num_threads
+# threads; any other gzip file is inflated as a zlib stream.
+# It serves the Python readers of the user files (ZReader) and the
+# InflateFeeder pipes of prep_reads.
+class InflateReader:
+    def __init__(self, fsrc, fname, num_threads=1, chunk_size=INFLATE_CHUNK_SIZE):
+        self.fsrc=fsrc
+        self.fname=fname
+        self.pool=None
+        self.buf=""
+        self.pos=0
+        head=fsrc.read(18)
+        if num_threads > 1 and bgzf_block_size(head):
+            self.pool=multiprocessing.pool.ThreadPool(num_threads)
+            self.chunks=bgzf_chunks(fsrc, self.pool, chunk_size, head=head)
+        else:
+            self.chunks=gunzip_chunks(fsrc, chunk_size, head=head)
+
+    # appends the next chunk of data to the buffer, returns False at the end
+    def fill(self):
+        try:
+            chunk=next(self.chunks, None)
+        except (ValueError, zlib.error), e:
+            die("Error: could not decompress %s: %s" % (self.fname, str(e)))
+        if chunk is None:
+            return False
+        self.buf=self.buf[self.pos:]+chunk
+        self.pos=0
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) - self.pos < size:
+            if not self.fill(): break
+        if size < 0:
+            size=len(self.buf) - self.pos
+        data=self.buf[self.pos:self.pos+size]
+        self.pos+=len(data)
+        return data
+
+    def readline(self):
+        end=self.buf.find("\n", self.pos)
+        while end < 0:
+            if not self.fill():
+                end=len(self.buf)-1
+                break
+            end=self.buf.find("\n", self.pos)
+        line=self.buf[self.pos:end+1]
+        self.pos=end+1
+        return line
+
+    def __iter__(self):
+        while True:
+            line=self.readline()
+            if not line: return
+            yield line
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool=None
+        self.buf=""
+
+# with sample=True only the first few records are going to be read, so
+# gzip files are inflated a small chunk at a time without a thread pool
 class ZReader:
-    def __init__(self, filename, params, guess=True):
+    def __init__(self, filename, params, guess=True, sample=False):
         self.fname=filename
         self.file=None
         self.fsrc=None
@@ -1762,6 +2807,18 @@ class ZReader:
         sys_params = params.system_params
         pipecmd=[]
         s=filename.lower()
+        if guess and (s.endswith(".z") or s.endswith(".gz") or s.endswith(".gzip")):
+           self.fsrc=open(self.fname, 'rb')
+           if self.fsrc.read(2) == GZIP_MAGIC:
+              # inflated here, in parallel for BGZF files
+              self.fsrc.seek(0)
+              if sample:
+                  self.file=InflateReader(self.fsrc, self.fname, 1, INFLATE_SAMPLE_SIZE)
+              else:
+                  self.file=InflateReader(self.fsrc, self.fname, sys_params.num_threads)
+              return
+           self.fsrc.close()
+           self.fsrc=None
         if s.endswith(".bam"):
            pipecmd=[prog_path("bam2fastx")]
            if params.read_params.color:
@@ -1798,7 +2855,7 @@ class ZReader:
         if pipecmd:
            try:
               self.fsrc=open(self.fname, 'rb')
-              self.popen=subprocess.Popen(pipecmd,
+              self.popen=TrackedPopen(pipecmd,
                     preexec_fn=subprocess_setup,
                     stdin=self.fsrc,
                     stdout=subprocess.PIPE, stderr=tophat_log, close_fds=True)
@@ -1819,9 +2876,11 @@ class ZWriter:
       self.fname=filename
       if use_zpacker:
           pipecmd=[sysparams.zipper,"-cf", "-"]
+          if sysparams.zipper_level:
+              pipecmd.insert(1, sysparams.zipper_level)
           self.ftarget=open(filename, "wb")
           try:
-             self.popen=subprocess.Popen(pipecmd,
+             self.popen=TrackedPopen(pipecmd,
                    preexec_fn=subprocess_setup,
                    stdin=subprocess.PIPE,
                    stderr=tophat_log, stdout=self.ftarget, close_fds=True)
@@ -1839,6 +2898,23 @@ class ZWriter:
           self.popen.wait() #! required to actually flush the pipes (eek!)
           self.popen=None
 
+# TeeWriter writes through a ZWriter and also into a named pipe, which is
+# read by a concurrently running process (see --stream-segments)
+class TeeWriter:
+   def __init__(self, zwriter, fifo_name):
+      self.fname=zwriter.fname
+      self.zwriter=zwriter
+      self.stream=open(fifo_name, "w")
+      # processes started later must not hold the write end of the pipe open
+      fcntl.fcntl(self.stream.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+      self.file=self
+   def write(self, data):
+      self.zwriter.file.write(data)
+      self.stream.write(data)
+   def close(self):
+      self.zwriter.close()
+      self.stream.close()
+
 # check_reads_format() examines the first few records in the user files
 # to determines the file format
 def check_reads_format(params, reads_files):
@@ -1853,20 +2929,18 @@ def check_reads_format(params, reads_files):
 
     for f_name in files:
         #try:
-        zf = ZReader(f_name, params)
+        zf = ZReader(f_name, params, sample=True)
         #except IOError:
         #   die("Error: could not open file "+f_name)
         freader=FastxReader(zf.file, params.read_params.color, zf.fname)
-        toread=4 #just sample the first 4 reads
-        while toread>0:
-            seqid, seqstr, seq_len, qstr = freader.nextRecord()
-            if not seqid: break
-            toread-=1
+        #just sample the first 4 reads
+        for seqid, seqstr, seq_len, qstr in freader.next_batch(4):
             if seq_len < 20:
                   th_logp("Warning: found a read < 20bp in "+f_name)
             else:
                 min_seed_len = min(seq_len, min_seed_len)
                 max_seed_len = max(seq_len, max_seed_len)
+        freader.close()
         zf.close()
         observed_formats.add(freader.format)
 #     if len(observed_formats) > 1:
@@ -2025,12 +3099,108 @@ def prep_reads_cmd(params, l_reads_list, l_quals_list=None, r_reads_list=None, r
 
   return prep_cmd
 
+# prep_reads opens the user files itself and inflates gzip files with a gzip
+# (or pigz) subprocess, which can only use a single core for BGZF files.
+# With -p > 1 each BGZF file is instead inflated by InflateReader in a forked
+# InflateFeeder process and reaches prep_reads through a pipe (/dev/fd/N);
+# other_fds are the pipes of the feeders started before, left to prep_reads.
+class InflateFeeder:
+    def __init__(self, fname, num_threads, other_fds):
+        self.fname = fname
+        sys.stdout.flush()
+        sys.stderr.flush()
+        rfd, wfd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            retcode = 0
+            try:
+                os.close(rfd)
+                for fd in other_fds:
+                    os.close(fd)
+                out = os.fdopen(wfd, "wb")
+                enlarge_pipe(out)
+                reader = InflateReader(open(fname, "rb"), fname, num_threads)
+                while True:
+                    data = reader.read(INFLATE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    out.write(data)
+                reader.close()
+                out.close()
+            except SystemExit:
+                retcode = 1 # die() has reported the error
+            except IOError, e:
+                # a broken pipe means prep_reads failed, which is reported
+                if e.errno != errno.EPIPE:
+                    traceback.print_exc()
+                retcode = 1
+            except:
+                traceback.print_exc()
+                retcode = 1
+            os._exit(retcode)
+        os.close(wfd)
+        self.fd = rfd
+        self.path = "/dev/fd/%d" % rfd
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    #--> returns True if the whole file went through the pipe
+    def wait(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        pid, status = os.waitpid(self.pid, 0)
+        return status == 0
+
+def is_bgzf_file(fname):
+    try:
+        f = open(fname, "rb")
+        head = f.read(18)
+        f.close()
+    except IOError:
+        return False # prep_reads reports it
+    return bool(bgzf_block_size(head))
+
+# Replaces the BGZF files of the comma separated reads_lists with the pipes
+# of InflateFeeder processes, see above
+#--> returns the new lists and the feeders
+def feed_inflated_reads(params, reads_lists, num_threads=None):
+    if not num_threads:
+        num_threads = params.system_params.num_threads
+    feeders = []
+    if num_threads < 2:
+        return reads_lists, feeders
+    # the files of each list are read at the same time as the other lists'
+    feeder_threads = max(1, num_threads / len([l for l in reads_lists if l]))
+    out_lists = []
+    for reads_list in reads_lists:
+        if not reads_list:
+            out_lists.append(reads_list)
+            continue
+        fnames = reads_list.split(",")
+        for i in range(len(fnames)):
+            s = fnames[i].lower()
+            if (s.endswith(".gz") or s.endswith(".gzip") or s.endswith(".z")) and \
+                   is_bgzf_file(fnames[i]):
+                feeder = InflateFeeder(fnames[i], feeder_threads, [f.fd for f in feeders])
+                feeders.append(feeder)
+                fnames[i] = feeder.path
+        out_lists.append(",".join(fnames))
+    return out_lists, feeders
+
 # Calls the prep_reads executable, which prepares an internal read library.
 # The read library features reads with monotonically increasing integer IDs.
 # prep_reads also filters out very low complexy or garbage reads as well as
 # polyA reads.
+# When num_threads is given it overrides -p for the decompression of the
+# reads (see InflateFeeder), prep_reads itself is single threaded.
 #--> returns a PrepReadsInfo structure
-def prep_reads(params, l_reads_list, l_quals_list, r_reads_list, r_quals_list, prefilter_reads=[]):
+def prep_reads(params, l_reads_list, l_quals_list, r_reads_list, r_quals_list, prefilter_reads=[],
+               num_threads=None):
     reads_suffix = ".bam"
     use_bam = True
 
@@ -2072,6 +3242,8 @@ def prep_reads(params, l_reads_list, l_quals_list, r_reads_list, r_quals_list, p
     index_file = out_fname + ".index"
     if do_use_zpacker: index_file=None
 
+    (l_reads_list, l_quals_list, r_reads_list, r_quals_list), feeders = \
+        feed_inflated_reads(params, [l_reads_list, l_quals_list, r_reads_list, r_quals_list], num_threads)
     prep_cmd=prep_reads_cmd(params, l_reads_list, l_quals_list, r_reads_list, r_quals_list,
                                        out_fname, info_file, index_file, prefilter_reads)
     shell_cmd = ' '.join(prep_cmd)
@@ -2087,28 +3259,39 @@ def prep_reads(params, l_reads_list, l_quals_list, r_reads_list, r_quals_list, p
     try:
         print >> run_log, shell_cmd
         if do_use_zpacker:
-            filter_proc = subprocess.Popen(prep_cmd,
+            filter_proc = TrackedPopen(prep_cmd, pipeline="prep_reads",
                                   stdout=subprocess.PIPE,
                                   stderr=filter_log)
-            zip_proc=subprocess.Popen(zip_cmd,
+            zip_proc=TrackedPopen(zip_cmd, pipeline="prep_reads",
                                   preexec_fn=subprocess_setup,
                                   stdin=filter_proc.stdout,
                                   stderr=tophat_log, stdout=kept_reads)
             filter_proc.stdout.close() #as per http://bugs.python.org/issue7678
             zip_proc.communicate()
-            retcode=filter_proc.poll()
+            retcode=filter_proc.wait()
             if retcode==0:
-              retcode=zip_proc.poll()
+              retcode=zip_proc.wait()
         else:
             if use_bam:
-              retcode = subprocess.call(prep_cmd, stderr=filter_log)
+              retcode = tracked_call(prep_cmd, pipeline="prep_reads", stderr=filter_log)
             else:
-              retcode = subprocess.call(prep_cmd,
+              retcode = tracked_call(prep_cmd, pipeline="prep_reads",
                                  stdout=kept_reads, stderr=filter_log)
+        bad_inputs = []
+        for feeder in feeders:
+            if retcode:
+                feeder.kill()
+            if not feeder.wait():
+                bad_inputs.append(feeder.fname)
         if retcode:
             die(fail_str+"Error running 'prep_reads'\n"+log_tail(log_fname))
+        if bad_inputs:
+            die(fail_str+"Error: could not decompress "+", ".join(bad_inputs))
 
     except OSError, o:
+        for feeder in feeders:
+            feeder.kill()
+            feeder.wait()
         errmsg=fail_str+str(o)
         die(errmsg+"\n"+log_tail(log_fname))
 
@@ -2132,7 +3315,9 @@ def bowtie(params,
            unmapped_reads,
            extra_output = "",
            mapping_type = _reads_vs_G,
-           multihits_out = None): #only --prefilter-multihits should activate this parameter for the initial prefilter search
+           multihits_out = None, #only --prefilter-multihits should activate this parameter for the initial prefilter search
+           num_threads = None, # overrides -p for this bowtie run
+           seg_demux = None): # [(mapped, unmapped)] per segment, for a multiplexed segment file
     start_time = datetime.now()
     bwt_idx_name = bwt_idx_prefix.split('/')[-1]
     reads_file=reads_list[0]
@@ -2171,11 +3356,20 @@ def bowtie(params,
     use_FIFO = use_BWT_FIFO and use_zpacker and unmapped_reads and params.read_params.color
     if use_FIFO:
          unmapped_reads_out+=".z"
+    if seg_demux:
+         seg_outs = []
+         for (seg_mapped, seg_unmapped) in seg_demux:
+             if seg_unmapped:
+                 seg_unmapped += ".bam"
+             seg_outs.append((seg_mapped + ".bam", seg_unmapped))
     if resume_skip:
          #skipping this step
+         if seg_demux:
+             return seg_outs
          return (mapped_reads, unmapped_reads_out)
 
     bwt_logname=logging_dir + 'bowtie.'+readfile_basename+'.log'
+    pipeline_name = "bowtie " + readfile_basename + " vs " + bwt_idx_name
 
     if t_mapping:
        th_log("Mapping %s to transcriptome %s with %s %s" % (readfile_basename,
@@ -2237,7 +3431,7 @@ def bowtie(params,
                  def on_sig_exit(sig, func=None):
                     os._exit(os.EX_OK)
                  signal.signal(signal.SIGTERM, on_sig_exit)
-                 subprocess.call(unm_zipcmd,
+                 tracked_call(unm_zipcmd, pipeline=pipeline_name,
                                  stdin=open(unmapped_reads_fifo, "r"),
                                  stderr=tophat_log,
                                  stdout=open(unmapped_reads_out, "wb"))
@@ -2261,20 +3455,31 @@ def bowtie(params,
                         "--read-edit-dist", str(params.read_edit_dist),
                         "--read-realign-edit-dist", str(params.read_realign_edit_dist)]
 
-        #write BAM file
-        out_bam = mapped_reads
-
-        if not t_mapping:
-           fix_map_cmd += ["--index-outfile", mapped_reads + ".index"]
         if not params.bowtie2:
            fix_map_cmd += ["--bowtie1"]
         if multihits_out != None:
            if params.bowtie2:
                fix_map_cmd += ["--aux-outfile", params.preflt_data[multihits_out].multihit_reads]
            fix_map_cmd += ["--max-multihits", str(params.max_hits)]
+        fix_map_cmd += ["--sam-header", sam_header_filename]
+        fix_map_cmd += params.system_params.bam_compression_cmd()
+
+        seg_fix_map_cmds = []
+        if seg_demux:
+           # one fix_map_ordering process for each segment of the multiplexed stream
+           for (seg_bam, seg_unmapped_bam) in seg_outs:
+              seg_cmd = fix_map_cmd + ["--index-outfile", seg_bam + ".index", "-", seg_bam]
+              if seg_unmapped_bam:
+                  seg_cmd += [seg_unmapped_bam]
+              seg_fix_map_cmds.append(seg_cmd)
+
+        #write BAM file
+        out_bam = mapped_reads
         if t_mapping:
            out_bam = "-" # we'll pipe into map2gtf
-        fix_map_cmd += ["--sam-header", sam_header_filename, "-", out_bam]
+        else:
+           fix_map_cmd += ["--index-outfile", mapped_reads + ".index"]
+        fix_map_cmd += ["-", out_bam]
         if unmapped_reads:
             fix_map_cmd += [unmapped_reads_out]
         if t_mapping:
@@ -2346,7 +3551,11 @@ def bowtie(params,
                            "-m", str(max_hits),
                            "-S"]
 
-        bowtie_cmd += ["-p", str(params.system_params.num_threads)]
+        if not num_threads:
+            num_threads = params.system_params.num_threads
+        bowtie_cmd += ["-p", str(num_threads)]
+        if params.system_params.bowtie_mm:
+            bowtie_cmd += ["--mm"]
 
         if params.bowtie2: #always use headerless SAM file
             bowtie_cmd += ["--sam-no-hd"]
@@ -2363,6 +3572,25 @@ def bowtie(params,
             bowtie_cmd += ["-x"]
 
         bowtie_cmd += [ bwt_idx_prefix ]
+
+        # a streamed run cannot be skipped: the other end of its pipe
+        # is waiting for it
+        streamed = isFifo(reads_file) or (unmapped_reads and isFifo(unmapped_reads_out))
+        ckpt_cmd = None
+        if not use_FIFO and not streamed:
+            ckpt_cmd = bowtie_cmd + ["<"] + reads_list + ["|"] + fix_map_cmd
+            for seg_cmd in seg_fix_map_cmds:
+                ckpt_cmd += ["|"] + seg_cmd
+            ckpt_inputs = reads_list + bowtie_index_files(bwt_idx_prefix, params.bowtie2)
+            if checkpoint_valid(ckpt_cmd, ckpt_inputs):
+                th_logp("\t(outputs of a previous run are up to date, skipping)")
+                if seg_mapping and not params.bowtie2:
+                    params.bowtie_alignment_option = backup_bowtie_alignment_option
+                if seg_demux:
+                    return seg_outs
+                return (mapped_reads, unmapped_reads_out)
+        bowtie_idx_runs[bwt_idx_prefix] = bowtie_idx_runs.get(bwt_idx_prefix, 0) + 1
+
         bowtie_proc=None
         shellcmd=""
         unzip_proc=None
@@ -2376,14 +3604,14 @@ def bowtie(params,
            sides=["left", "right"]
            preplog_fname=logging_dir + "prep_reads.prefilter_%s.log" % sides[multihits_out]
            prepfilter_log = open(preplog_fname,"w")
-           unzip_proc = subprocess.Popen(prep_cmd,
+           unzip_proc = TrackedPopen(prep_cmd, pipeline=pipeline_name,
                                 stdout=subprocess.PIPE,
                                 stderr=prepfilter_log)
            shellcmd=' '.join(prep_cmd) + "|"
         else:
            z_input=use_zpacker and reads_file.endswith(".z")
            if z_input:
-              unzip_proc = subprocess.Popen(unzip_cmd,
+              unzip_proc = TrackedPopen(unzip_cmd, pipeline=pipeline_name,
                                      stdin=open(reads_file, "rb"),
                                      stderr=tophat_log, stdout=subprocess.PIPE)
               shellcmd=' '.join(unzip_cmd) + "< " +reads_file +"|"
@@ -2391,30 +3619,74 @@ def bowtie(params,
                #must be uncompressed fastq input (unmapped reads from a previous run)
                #or a BAM file with unmapped reads
                if bam_input:
-                   unzip_proc = subprocess.Popen(unzip_cmd, stderr=tophat_log, stdout=subprocess.PIPE)
+                   unzip_proc = TrackedPopen(unzip_cmd, pipeline=pipeline_name, stderr=tophat_log, stdout=subprocess.PIPE)
                    shellcmd=' '.join(unzip_cmd) + "|"
+               elif isFifo(reads_file):
+                   #segment reads streamed by split_reads() (--stream-segments)
+                   bowtie_cmd += ['-']
+                   bowtie_proc = TrackedPopen(bowtie_cmd, pipeline=pipeline_name,
+                                stdin=open(reads_file, "rb"),
+                                stdout=subprocess.PIPE,
+                                stderr=open(bwt_logname, "w"))
+                   shellcmd="cat "+reads_file+"|"
                else:
                    bowtie_cmd += [reads_file]
                    if not unzip_proc:
-                        bowtie_proc = subprocess.Popen(bowtie_cmd,
+                        bowtie_proc = TrackedPopen(bowtie_cmd, pipeline=pipeline_name,
                                      stdout=subprocess.PIPE,
                                      stderr=open(bwt_logname, "w"))
         if unzip_proc:
               #input is compressed OR prep_reads is used as a filter
               bowtie_cmd += ['-']
-              bowtie_proc = subprocess.Popen(bowtie_cmd,
+              bowtie_proc = TrackedPopen(bowtie_cmd, pipeline=pipeline_name,
                                      stdin=unzip_proc.stdout,
                                      stdout=subprocess.PIPE,
                                      stderr=open(bwt_logname, "w"))
               unzip_proc.stdout.close() # see http://bugs.python.org/issue7678
 
-        shellcmd += ' '.join(bowtie_cmd) + '|' + ' '.join(fix_map_cmd)
+        if seg_demux:
+            shellcmd += ' '.join(bowtie_cmd) + '| <demux segments> |' + \
+                        ' ; '.join([' '.join(c) for c in seg_fix_map_cmds])
+        else:
+            shellcmd += ' '.join(bowtie_cmd) + '|' + ' '.join(fix_map_cmd)
         pipeline_proc = None
         fix_order_proc = None
         #write BAM format directly
-        if t_mapping:
+        if seg_demux:
+            seg_fix_procs = []
+            for seg_cmd in seg_fix_map_cmds:
+                seg_fix_procs.append(TrackedPopen(seg_cmd, pipeline=pipeline_name,
+                                                      stdin=subprocess.PIPE,
+                                                      stderr=tophat_log,
+                                                      close_fds=True))
+            print >> run_log, shellcmd
+            try:
+                demux_segment_hits(bowtie_proc.stdout, [p.stdin for p in seg_fix_procs])
+            except (IOError, ValueError), e:
+                # a malformed read name, or a fix_map_ordering that exited
+                for p in [unzip_proc, bowtie_proc] + seg_fix_procs:
+                    if p and p.poll() is None:
+                        p.kill()
+                for p in [unzip_proc, bowtie_proc] + seg_fix_procs:
+                    if p:
+                        p.wait()
+                die(fail_str+"Error demultiplexing the segment hits: "+str(e)+"\n"+
+                    log_tail(bwt_logname,100))
+            bowtie_proc.stdout.close()
+            for p in seg_fix_procs:
+                p.stdin.close()
+            retcode = 0
+            for p in seg_fix_procs:
+                if p.wait():
+                    retcode = p.returncode
+            bowtie_proc.wait()
+            if bowtie_proc.returncode:
+                die(fail_str+"Error running bowtie:\n"+log_tail(bwt_logname,100))
+            if retcode:
+                die(fail_str+"Error running:\n"+shellcmd)
+        elif t_mapping:
             #pipe into map2gtf
-            fix_order_proc = subprocess.Popen(fix_map_cmd,
+            fix_order_proc = TrackedPopen(fix_map_cmd, pipeline=pipeline_name,
                                           stdin=bowtie_proc.stdout,
                                           stdout=subprocess.PIPE,
                                           stderr=tophat_log)
@@ -2428,19 +3700,20 @@ def bowtie(params,
             m2g_log = logging_dir + "m2g_"+readfile_basename+".out"
             m2g_err = logging_dir + "m2g_"+readfile_basename+".err"
             shellcmd += ' | '+' '.join(m2g_cmd)+ ' > '+m2g_log
-            pipeline_proc = subprocess.Popen(m2g_cmd,
+            pipeline_proc = TrackedPopen(m2g_cmd, pipeline=pipeline_name,
                                               stdin=fix_order_proc.stdout,
                                               stdout=open(m2g_log, "w"),
                                               stderr=open(m2g_err, "w"))
             fix_order_proc.stdout.close()
         else:
-            fix_order_proc = subprocess.Popen(fix_map_cmd,
+            fix_order_proc = TrackedPopen(fix_map_cmd, pipeline=pipeline_name,
                                           stdin=bowtie_proc.stdout,
                                           stderr=tophat_log)
             bowtie_proc.stdout.close()
             pipeline_proc = fix_order_proc
 
-        print >> run_log, shellcmd
+        if not seg_demux:
+            print >> run_log, shellcmd
         retcode = None
         if pipeline_proc:
             pipeline_proc.communicate()
@@ -2449,6 +3722,13 @@ def bowtie(params,
             r=bowtie_proc.returncode
             if r:
               die(fail_str+"Error running bowtie:\n"+log_tail(bwt_logname,100))
+        if unzip_proc:
+            # bowtie exited fine, but it may have read truncated input
+            unzip_proc.wait()
+            if unzip_proc.returncode:
+                if multihits_out != None:
+                    die(fail_str+"Error running 'prep_reads'\n"+log_tail(preplog_fname))
+                die(fail_str+"Error running:\n"+' '.join(unzip_cmd))
         if use_FIFO:
             if fifo_pid and not os.path.exists(unmapped_reads_out):
                 try:
@@ -2472,12 +3752,47 @@ def bowtie(params,
     if multihits_out != None and not os.path.exists(params.preflt_data[multihits_out].multihit_reads):
         open(params.preflt_data[multihits_out].multihit_reads, "w").close()
 
+    if ckpt_cmd:
+        ckpt_outputs = [mapped_reads, unmapped_reads_out]
+        if seg_demux:
+            ckpt_outputs = []
+            for (seg_bam, seg_unmapped_bam) in seg_outs:
+                ckpt_outputs += [seg_bam, seg_unmapped_bam]
+        if multihits_out != None:
+            ckpt_outputs.append(params.preflt_data[multihits_out].multihit_reads)
+        ckpt_outputs = [f for f in ckpt_outputs if f]
+        # the .index files that were written (the unmapped reads have none)
+        ckpt_outputs += [f + ".index" for f in ckpt_outputs if os.path.exists(f + ".index")]
+        write_checkpoint(ckpt_cmd, ckpt_inputs, ckpt_outputs)
+
     if seg_mapping:
         if not params.bowtie2:
             params.bowtie_alignment_option = backup_bowtie_alignment_option
 
+    if seg_demux:
+        return seg_outs
     return (mapped_reads, unmapped_reads_out)
 
+# Routes the SAM records of a multiplexed segment mapping to the output
+# stream of their segment; the segment number is taken from the
+# "|offset:seg_num:num_segs" suffix that split_reads() adds to read names.
+# The records are read and written a block at a time.
+def demux_segment_hits(sam_in, seg_outs):
+    while True:
+        lines = sam_in.readlines(SPLIT_BLOCK_SIZE)
+        if not lines:
+            break
+        seg_lines = [[] for seg_out in seg_outs]
+        for line in lines:
+            qname = line[:line.find('\t')]
+            try:
+                seg_lines[int(qname[qname.rfind('|')+1:].split(':')[1])].append(line)
+            except (IndexError, ValueError):
+                raise ValueError("no segment number in read name " + qname)
+        for i in range(len(seg_outs)):
+            if seg_lines[i]:
+                seg_outs[i].write("".join(seg_lines[i]))
+
 
 # Retrieve a .juncs file from a GFF file by calling the gtf_juncs executable
 def get_gtf_juncs(gff_annotation):
@@ -2492,7 +3807,7 @@ def get_gtf_juncs(gff_annotation):
     gtf_juncs_cmd=[prog_path("gtf_juncs"), gff_annotation]
     try:
         print >> run_log, " ".join(gtf_juncs_cmd), " > "+gtf_juncs_out_name
-        retcode = subprocess.call(gtf_juncs_cmd,
+        retcode = tracked_call(gtf_juncs_cmd,
                                   stderr=gtf_juncs_log,
                                   stdout=gtf_juncs_out)
         # cvg_islands returned an error
@@ -2511,29 +3826,54 @@ def get_gtf_juncs(gff_annotation):
     return (True, gtf_juncs_out_name)
 
 # Call bowtie-build on the FASTA file of sythetic splice junction sequences
-def build_juncs_bwt_index(is_bowtie2, external_splice_prefix, color):
-    th_log("Indexing splices")
-    bowtie_build_log = open(logging_dir + "bowtie_build.log", "w")
-
-    #user_splices_out_prefix  = output_dir + "user_splices_idx"
+# bowtie-build program -> whether it accepts --threads
+bowtie_build_threads = {}
 
+# Returns the bowtie-build command line start, with a thread count if this
+# bowtie-build supports multithreaded index construction
+def index_build_cmd(is_bowtie2, color, num_threads):
     if is_bowtie2:
-        bowtie_build_cmd = [prog_path("bowtie2-build")]
+        build_cmd = [prog_path("bowtie2-build")]
     else:
-        bowtie_build_cmd = [prog_path("bowtie-build")]
-
+        build_cmd = [prog_path("bowtie-build")]
+    if num_threads > 1:
+        if build_cmd[0] not in bowtie_build_threads:
+            # older bowtie-build versions do not know --threads
+            try:
+                help_proc = TrackedPopen(build_cmd + ["--help"],
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT)
+                help_out = help_proc.communicate()[0]
+            except OSError:
+                help_out = ""
+            bowtie_build_threads[build_cmd[0]] = (help_out.find("--threads") >= 0)
+        if bowtie_build_threads[build_cmd[0]]:
+            build_cmd += ["--threads", str(num_threads)]
     if color:
-        bowtie_build_cmd += ["-C"]
+        build_cmd += ["-C"]
+    return build_cmd
+
+def build_juncs_bwt_index(is_bowtie2, external_splice_prefix, color, num_threads = 1):
+    th_log("Indexing splices")
+    log_fname = logging_dir + "bowtie_build.log"
+    bowtie_build_log = open(log_fname, "w")
+
+    #user_splices_out_prefix  = output_dir + "user_splices_idx"
+
+    bowtie_build_cmd = index_build_cmd(is_bowtie2, color, num_threads)
 
     bowtie_build_cmd += [external_splice_prefix + ".fa",
                          external_splice_prefix]
     try:
+        start_time = datetime.now()
         print >> run_log, " ".join(bowtie_build_cmd)
-        retcode = subprocess.call(bowtie_build_cmd,
-                                 stdout=bowtie_build_log)
+        retcode = tracked_call(bowtie_build_cmd,
+                                 stdout=bowtie_build_log,
+                                 stderr=bowtie_build_log)
 
         if retcode != 0:
-            die(fail_str+"Error: Splice sequence indexing failed with err ="+ str(retcode))
+            die(fail_str+"Error: Splice sequence indexing failed with err ="+ str(retcode)+"\n"+log_tail(log_fname))
+        th_logp("\tsplice index built in %s" % formatTD(datetime.now() - start_time))
     except OSError, o:
         errmsg=fail_str+str(o)+"\n"
         if o.errno == errno.ENOTDIR or o.errno == errno.ENOENT:
@@ -2552,7 +3892,8 @@ def build_juncs_index(is_bowtie2,
                       external_deletions,
                       external_fusions,
                       reference_fasta,
-                      color):
+                      color,
+                      num_threads = 1):
     th_log("Retrieving sequences for splices")
     juncs_file_list = ",".join(external_juncs)
     insertions_file_list = ",".join(external_insertions)
@@ -2563,13 +3904,24 @@ def build_juncs_index(is_bowtie2,
     if is_bowtie2:
         insertions_file_list = "/dev/null"
         deletions_file_list = "/dev/null"
+        external_insertions = []
+        external_deletions = []
+
+    juncs_cache = None
+    if cache_dir:
+        juncs_key = juncs_index_key(is_bowtie2, min_anchor_length, max_seg_len, external_juncs, external_insertions,
+                                    external_deletions, external_fusions, reference_fasta, color)
+        juncs_cache = cache_dir + "juncs/" + juncs_key + "/"
+        cached_prefix = juncs_cache + juncs_prefix
+        if os.path.exists(cached_prefix + ".fa") and bowtie_index_files(cached_prefix, is_bowtie2):
+            th_log("Using splice index from "+juncs_cache)
+            return cached_prefix
 
     juncs_db_log = open(logging_dir + "juncs_db.log", "w")
 
     external_splices_out_prefix  = tmp_dir + juncs_prefix
     external_splices_out_name = external_splices_out_prefix + ".fa"
 
-    external_splices_out = open(external_splices_out_name, "w")
     # juncs_db_cmd = [bin_dir + "juncs_db",
     juncs_db_cmd = [prog_path("juncs_db"),
                     str(min_anchor_length),
@@ -2579,9 +3931,17 @@ def build_juncs_index(is_bowtie2,
                     deletions_file_list,
                     fusions_file_list,
                     reference_fasta]
+    # the checkpoint covers both juncs_db and the indexing of its output
+    juncs_db_inputs = external_juncs + external_insertions + external_deletions + \
+                      external_fusions + [reference_fasta]
+    ckpt_cmd = juncs_db_cmd + [">", external_splices_out_name, "|", "bowtie-build", str(is_bowtie2), str(color)]
+    if checkpoint_valid(ckpt_cmd, juncs_db_inputs):
+        th_logp("\t(outputs of a previous run are up to date, skipping)")
+        return external_splices_out_prefix
+    external_splices_out = open(external_splices_out_name, "w")
     try:
         print >> run_log, " ".join(juncs_db_cmd) + " > " + external_splices_out_name
-        retcode = subprocess.call(juncs_db_cmd,
+        retcode = tracked_call(juncs_db_cmd,
                                  stderr=juncs_db_log,
                                  stdout=external_splices_out)
 
@@ -2594,40 +3954,115 @@ def build_juncs_index(is_bowtie2,
            errmsg+="Error: juncs_db not found on this system"
        die(errmsg)
 
-    external_splices_out_prefix = build_juncs_bwt_index(is_bowtie2, external_splices_out_prefix, color)
+    external_splices_out_prefix = build_juncs_bwt_index(is_bowtie2, external_splices_out_prefix, color, num_threads)
+    write_checkpoint(ckpt_cmd, juncs_db_inputs,
+                     [external_splices_out_name] + bowtie_index_files(external_splices_out_prefix, is_bowtie2))
+    if juncs_cache:
+        cache_juncs_index(external_splices_out_prefix, is_bowtie2, juncs_cache)
     return external_splices_out_prefix
 
-def build_idx_from_fa(is_bowtie2, fasta_fname, out_dir, color):
+# Hash of everything the splice index depends on: the set of junction,
+# insertion, deletion and fusion records (regardless of the files they come
+# from, their order or duplicates), the segment length, the anchor length,
+# the reference and the kind of index
+def juncs_index_key(is_bowtie2, min_anchor_length, max_seg_len, juncs, insertions,
+                    deletions, fusions, reference_fasta, color):
+    juncs_key = hashlib.sha1("%s\t%s\t%d\t%d\t%s\n" % (is_bowtie2, color, min_anchor_length, max_seg_len,
+                                                     fasta_content_hash(reference_fasta)))
+    # number of leading columns identifying a record, as read by juncs_db
+    for (rec_type, fnames, num_cols) in (("juncs", juncs, 4), ("insertions", insertions, 4),
+                                         ("deletions", deletions, 3), ("fusions", fusions, 5)):
+        records = set()
+        for fname in fnames:
+            f = open(fname)
+            for line in f:
+                cols = line.rstrip("\r\n").split("\t")
+                if len(cols) >= num_cols:
+                    records.add("\t".join(cols[:num_cols]))
+            f.close()
+        records = sorted(records)
+        juncs_key.update("%s\t%d\n" % (rec_type, len(records)))
+        for rec in records:
+            juncs_key.update(rec + "\n")
+    return juncs_key.hexdigest()
+
+# md5 of the whole reference FASTA (file_stamp only samples the ends);
+# it is kept in the cache under the path, size and mtime of the file, so it
+# is computed once for each version of the FASTA file
+def fasta_content_hash(fasta):
+    st = os.stat(fasta)
+    stamp = hashlib.sha1("%s\t%d\t%r" % (os.path.realpath(fasta), st.st_size, st.st_mtime)).hexdigest()
+    hash_dir = cache_dir + "juncs/fasta/"
+    try:
+        return open(hash_dir + stamp).read().strip()
+    except IOError:
+        pass
+    fmd5 = hashlib.md5()
+    f = open(fasta, "rb")
+    while True:
+        buf = f.read(1024*1024)
+        if not buf:
+            break
+        fmd5.update(buf)
+    f.close()
+    try:
+        if not os.path.isdir(hash_dir):
+            os.makedirs(hash_dir)
+        # written under a temporary name, concurrent runs may be reading it
+        tmp_hash = "%s%s.%d.tmp" % (hash_dir, stamp, os.getpid())
+        hf = open(tmp_hash, "w")
+        hf.write(fmd5.hexdigest() + "\n")
+        hf.close()
+        os.rename(tmp_hash, hash_dir + stamp)
+    except (IOError, OSError):
+        pass # computed again next time
+    return fmd5.hexdigest()
+
+# Copies a splice index into the cache; the copy is published by renaming
+# its directory, so a concurrent run either sees the complete index or none
+def cache_juncs_index(juncs_idx_prefix, is_bowtie2, juncs_cache):
+    stage_dir = "%s.%d.tmp/" % (juncs_cache.rstrip("/"), os.getpid())
+    try:
+        os.makedirs(stage_dir)
+        for fname in [juncs_idx_prefix + ".fa"] + bowtie_index_files(juncs_idx_prefix, is_bowtie2):
+            copy(fname, stage_dir)
+        os.rename(stage_dir, juncs_cache)
+    except (IOError, OSError), o:
+        if not os.path.isdir(juncs_cache):
+            th_logp("Warning: could not cache the splice index: "+str(o))
+        rmtree(stage_dir, True)
+
+def build_idx_from_fa(is_bowtie2, fasta_fname, out_dir, color, num_threads = 1):
     """ Build a bowtie index from a FASTA file.
 
     Arguments:
     - `fasta_fname`: File path to FASTA file.
     - `out_dir`: Output directory to place index in. (includes os.sep)
+    - `num_threads`: Number of index building threads, if supported.
 
     Returns:
     - The path to the Bowtie index.
     """
     bwt_idx_path = out_dir + os.path.basename(fasta_fname).replace(".fa", "")
 
-    if is_bowtie2:
-        bowtie_idx_cmd = [prog_path("bowtie2-build")]
-    else:
-        bowtie_idx_cmd = [prog_path("bowtie-build")]
-
-    if color:
-        bowtie_idx_cmd += ["-C"]
+    bowtie_idx_cmd = index_build_cmd(is_bowtie2, color, num_threads)
 
     bowtie_idx_cmd += [fasta_fname,
                        bwt_idx_path]
+    log_fname = logging_dir + "bowtie_build." + os.path.basename(bwt_idx_path) + ".log"
     try:
         th_log("Building Bowtie index from " + os.path.basename(fasta_fname))
+        start_time = datetime.now()
         print >> run_log, " ".join(bowtie_idx_cmd)
-        retcode = subprocess.call(bowtie_idx_cmd,
-                                  stdout=open(os.devnull, "w"),
-                                  stderr=open(os.devnull, "w"))
+        build_log = open(log_fname, "w")
+        retcode = tracked_call(bowtie_idx_cmd,
+                                  stdout=build_log,
+                                  stderr=build_log)
+        build_log.close()
         if retcode != 0:
             die(fail_str + "Error: Couldn't build bowtie index with err = "
-                + str(retcode))
+                + str(retcode) + "\n" + log_tail(log_fname))
+        th_logp("\tindex built in %s" % formatTD(datetime.now() - start_time))
     except OSError, o:
        errmsg=fail_str+str(o)+"\n"
        if o.errno == errno.ENOTDIR or o.errno == errno.ENOENT:
@@ -2728,7 +4163,7 @@ def compile_reports(params, sam_header_filename, ref_fasta, mappings, readfiles,
 
     try:
         print >> run_log, " ".join(report_cmd)
-        report_proc=subprocess.call(report_cmd,
+        report_proc=tracked_call(report_cmd,
                                             preexec_fn=subprocess_setup,
                                             stderr=report_log)
         if report_proc != 0:
@@ -2742,144 +4177,834 @@ def compile_reports(params, sam_header_filename, ref_fasta, mappings, readfiles,
                   break
         num_bam_parts = len(bam_parts)
 
-        if params.report_params.sort_bam:
-            pids = [0 for i in range(num_bam_parts)]
+        # sort the parts, merge them and merge the unmapped reads
+        # concurrently, as far as their inputs allow
+        report_tasks = TaskGraph(params.system_params.num_threads)
+        if params.report_params.convert_bam:
+            hits_out = accepted_hits + ".bam"
+        else:
+            hits_out = accepted_hits + ".sam"
+        if params.report_params.split_by_chrom or (params.report_params.sort_bam and num_bam_parts > 1 and
+               params.report_params.region_merge and params.report_params.convert_bam):
+            # sorted and indexed parts, merged by chromosome groups
+            sort_mem = sort_memory_share(params, min(num_bam_parts, params.system_params.num_threads))
             sorted_bam_parts = ["%s%d_sorted" % (alignments_output_filename, i) for i in range(num_bam_parts)]
-            #left_um_parts = ["%s%s%d_sorted" % (alignments_output_filename, i) for i in range(num_bam_parts)]
-            #right_um_parts = ["%s%d_sorted" % (alignments_output_filename, i) for i in range(num_bam_parts)]
             for i in range(num_bam_parts):
-                    bamsort_cmd = [samtools_path,
-                                   "sort",
-                                   bam_parts[i],
-                                   sorted_bam_parts[i]]
-
-                    sorted_bam_parts[i] += ".bam"
-                    print >> run_log, " ".join(bamsort_cmd)
-
-                    if i + 1 < num_bam_parts:
-                        pid = os.fork()
-                        if pid == 0:
-                            subprocess.call(bamsort_cmd,
-                                            stderr=open(logging_dir + "reports.samtools_sort.log%d" % i, "w"))
-                            os._exit(os.EX_OK)
-                        else:
-                            pids[i] = pid
-                    else:
-                        subprocess.call(bamsort_cmd,
-                                        stderr=open(logging_dir + "reports.samtools_sort.log%d" % i, "w"))
-
-            for i in range(len(pids)):
-                    if pids[i] > 0:
-                        result = os.waitpid(pids[i], 0)
-                        pids[i] = 0
-
-            for bam_part in bam_parts:
-                os.remove(bam_part)
-            bam_parts = sorted_bam_parts[:]
-        #-- endif sort_bam
-
-        if num_bam_parts > 1:
+                bamsort_cmd = [samtools_path, "sort", "-m", str(sort_mem),
+                               bam_parts[i], sorted_bam_parts[i]]
+                sorted_bam_parts[i] += ".bam"
+                report_tasks.add_task(1, [bam_parts[i]], [sorted_bam_parts[i]],
+                                      sort_bam_part, bamsort_cmd, bam_parts[i],
+                                      logging_dir + "reports.samtools_sort.log%d" % i)
+                report_tasks.add_task(1, [sorted_bam_parts[i]], [sorted_bam_parts[i] + ".bai"],
+                                      index_bam_part, sorted_bam_parts[i],
+                                      logging_dir + "reports.samtools_index.log%d" % i)
+            if params.report_params.split_by_chrom:
+                report_tasks.add_task(params.system_params.num_threads,
+                                      [p + ".bai" for p in sorted_bam_parts], [accepted_hits + ".manifest"],
+                                      split_bam_parts, params, sam_header_filename, accepted_hits, sorted_bam_parts)
+            else:
+                report_tasks.add_task(params.system_params.num_threads,
+                                      [p + ".bai" for p in sorted_bam_parts], [hits_out],
+                                      region_merge_bam_parts, params, sam_header_filename, accepted_hits, sorted_bam_parts)
+        elif params.report_params.sort_bam and num_bam_parts > 1:
+            # the parts are sorted concurrently, straight into the merge
+            report_tasks.add_task(num_bam_parts, bam_parts, [hits_out],
+                                  sort_merge_bam_parts, params, sam_header_filename, accepted_hits, bam_parts)
+        else:
             if params.report_params.sort_bam:
-               bammerge_cmd = [samtools_path,
-                    "merge","-f","-h", sam_header_filename]
-               if not params.report_params.convert_bam:
-                    bammerge_cmd += ["-u"]
-            else: #not sorted, so just raw merge
-               bammerge_cmd = [prog_path("bam_merge"), "-Q",
-                     "--sam-header", sam_header_filename]
-
-            if params.report_params.convert_bam:
-               bammerge_cmd += ["%s.bam" % accepted_hits]
-               bammerge_cmd += bam_parts
-               print >> run_log, " ".join(bammerge_cmd)
-               subprocess.call(bammerge_cmd,
-                      stderr=open(logging_dir + "reports.merge_bam.log", "w"))
-            else: #make .sam
-               bammerge_cmd += ["-"]
-               bammerge_cmd += bam_parts
-               merge_proc = subprocess.Popen(bammerge_cmd,
-                            stdout=subprocess.PIPE,
-                            stderr=open(logging_dir + "reports.merge_bam.log", "w"))
-               bam2sam_cmd = [samtools_path, "view", "-h", "-"]
-               sam_proc = subprocess.Popen(bam2sam_cmd,
-                              stdin=merge_proc.stdout,
-                              stdout=open(accepted_hits + ".sam", "w"),
-                              stderr=open(logging_dir + "accepted_hits_bam_to_sam.log", "w"))
-               merge_proc.stdout.close()
-               shellcmd = " ".join(bammerge_cmd) + " | " + " ".join(bam2sam_cmd)
-               print >> run_log, shellcmd
-               sam_proc.communicate()
-               retcode = sam_proc.returncode
-               if retcode:
-                 die(fail_str+"Error running:\n"+shellcmd)
-            for bam_part in bam_parts:
-                os.remove(bam_part)
-        else: # only one file
-            move(bam_parts[0], accepted_hits+".bam")
-            if not params.report_params.convert_bam:
-               #just convert to .sam
-               bam2sam_cmd = [samtools_path, "view", "-h", accepted_hits+".bam"]
-               shellcmd = " ".join(bam2sam_cmd) + " > " + accepted_hits + ".sam"
-               print >> run_log, shellcmd
-               r = subprocess.call(bam2sam_cmd,
-                              stdout=open(accepted_hits + ".sam", "w"),
-                              stderr=open(logging_dir + "accepted_hits_bam_to_sam.log", "w"))
-               if r != 0:
-                  die(fail_str+"Error running: "+shellcmd)
-               os.remove(accepted_hits+".bam")
+                sorted_bam_part = alignments_output_filename + "0_sorted"
+                bamsort_cmd = [samtools_path,
+                               "sort",
+                               "-m", str(sort_memory_share(params, 1)),
+                               bam_parts[0],
+                               sorted_bam_part]
+
+                sorted_bam_part += ".bam"
+                report_tasks.add_task(1, [bam_parts[0]], [sorted_bam_part],
+                                      sort_bam_part, bamsort_cmd, bam_parts[0],
+                                      logging_dir + "reports.samtools_sort.log0")
+                bam_parts = [sorted_bam_part]
+            #-- endif sort_bam
+            report_tasks.add_task(1, bam_parts, [hits_out],
+                                  merge_bam_parts, params, sam_header_filename, accepted_hits, bam_parts)
+
+        # -- merge the unmapped files
+        um_parts = []
+        um_merged = output_dir + "unmapped.bam"
+        for i in range(params.system_params.num_threads):
+            left_um_file =  tmp_dir + "unmapped_left_%d.bam" % i
+            right_um_file = tmp_dir + "unmapped_right_%d.bam" % i
+            if nonzeroFile(left_um_file):
+               um_parts.append(left_um_file)
+            if right_reads and nonzeroFile(right_um_file):
+               um_parts.append(right_um_file)
+        if len(um_parts) > 0:
+            report_tasks.add_task(1, um_parts, [um_merged],
+                                  merge_unmapped_parts, params, sam_header_filename, um_parts, um_merged)
+
+        report_tasks.run()
 
     except OSError, o:
           die(fail_str+"Error: "+str(o)+"\n"+log_tail(log_fname))
 
+    return junctions
+
+SORT_PART_MEMORY = 500000000 # samtools sort's own default for -m
+SORT_MIN_MEMORY = 32 * 1024 * 1024
+
+# parses a memory size like 500000000, 768M or 4G
+def parse_mem_size(value):
+    m = re.match(r"^(\d+)([kmg]?)b?$", value.strip().lower())
+    if not m:
+        return None
+    return int(m.group(1)) * {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}[m.group(2)]
+
+# splits the --sort-memory budget (by default, samtools' 500M per part but
+# no more than a quarter of the physical memory) between the concurrent sorts
+def sort_memory_share(params, num_parts):
+    budget = params.report_params.sort_memory
+    if not budget:
+        budget = SORT_PART_MEMORY * num_parts
+        try:
+            budget = min(budget, os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 4)
+        except (ValueError, OSError):
+            pass
+    return max(SORT_MIN_MEMORY, budget / num_parts)
+
+# Sorts the tophat_reports parts concurrently, each within its share of the
+# sort memory, and streams the sorted parts through pipes into the merge
+# (as /dev/fd/<n> inputs), so the sorted parts are never written to disk
+def sort_merge_bam_parts(params, sam_header_filename, accepted_hits, bam_parts):
+    sort_mem = sort_memory_share(params, len(bam_parts))
+    sorted_fds = [] # read ends of the pipes, inherited by the merge
+    sort_procs = []
+    merged = False
+    try:
+        for i in range(len(bam_parts)):
+            sorted_prefix = bam_parts[i][:-4] + "_sorted" # for sort's temporary files
+            bamsort_cmd = [samtools_path, "sort", "-o", "-m", str(sort_mem),
+                           bam_parts[i], sorted_prefix]
+            rfd, wfd = os.pipe()
+            sorted_fds.append(rfd)
+            print >> run_log, " ".join(bamsort_cmd) + " > /dev/fd/%d &" % rfd
+            try:
+                sort_procs.append(TrackedPopen(bamsort_cmd,
+                                  pipeline="sort " + os.path.basename(bam_parts[i]),
+                                  stdout=wfd, close_fds=True,
+                                  stderr=open(logging_dir + "reports.samtools_sort.log%d" % i, "w")))
+            finally:
+                os.close(wfd)
+        merge_bam_parts(params, sam_header_filename, accepted_hits,
+                        ["/dev/fd/%d" % fd for fd in sorted_fds], False)
+        merged = True
+    finally:
+        for fd in sorted_fds:
+            os.close(fd)
+        # a sort can be left blocked on its pipe if the merge failed
+        for proc in sort_procs:
+            if not merged and proc.poll() is None:
+                proc.kill()
+            proc.wait()
+    for i in range(len(bam_parts)):
+        if sort_procs[i].returncode != 0:
+            log_fname = logging_dir + "reports.samtools_sort.log%d" % i
+            die(fail_str+"Error executing: samtools sort "+bam_parts[i]+"\n"+log_tail(log_fname))
+        os.remove(bam_parts[i])
+
+def index_bam_part(bam_part, log_fname):
+    index_cmd = [samtools_path, "index", bam_part]
+    print >> run_log, " ".join(index_cmd)
+    ret = tracked_call(index_cmd, pipeline="index " + os.path.basename(bam_part),
+                          stderr=open(log_fname, "w"))
+    if ret != 0:
+        die(fail_str+"Error executing: "+" ".join(index_cmd)+"\n"+log_tail(log_fname))
+
+# per reference counts of the reads in indexed BAM files, in header order
+#--> returns [(ref_name, ref_length, num_reads)], including ("*", 0, unplaced reads)
+def bam_ref_counts(bam_files):
+    ref_counts = []
+    ref_idx = {}
+    for bam_file in bam_files:
+        idxstats_cmd = [samtools_path, "idxstats", bam_file]
+        proc = TrackedPopen(idxstats_cmd, stdout=subprocess.PIPE, stderr=tophat_log)
+        for line in proc.stdout:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 4:
+                continue
+            if fields[0] not in ref_idx:
+                ref_idx[fields[0]] = len(ref_counts)
+                ref_counts.append([fields[0], int(fields[1]), 0])
+            ref_counts[ref_idx[fields[0]]][2] += int(fields[2]) + int(fields[3])
+        if proc.wait() != 0:
+            die(fail_str+"Error executing: "+" ".join(idxstats_cmd))
+    return [tuple(r) for r in ref_counts]
+
+# splits the references (in header order) into at most num_groups runs of
+# consecutive references with about the same number of reads
+def partition_refs(ref_counts, num_groups):
+    total = float(sum([c for r, c in ref_counts]))
+    groups = [[]]
+    done = 0
+    for ref, count in ref_counts:
+        if groups[-1] and len(groups) < num_groups and done >= total * len(groups) / num_groups:
+            groups.append([])
+        groups[-1].append(ref)
+        done += count
+    return groups
+
+# samtools view takes the references of a group on its command line; longer
+# lists (assemblies with many contigs) are merged in chunks of names adding up
+# to this many bytes, well below any system's limit on the arguments
+REGION_ARGS_BYTES = 64 * 1024
+
+# splits the reference names into runs short enough for a command line
+def chunk_ref_names(refs, max_bytes=REGION_ARGS_BYTES):
+    chunks = [[]]
+    size = 0
+    for ref in refs:
+        if chunks[-1] and size + len(ref) + 1 > max_bytes:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(ref)
+        size += len(ref) + 1
+    return chunks
+
+#--> returns the number of programs merge_ref_group() runs at the same time:
+# a region query per part and the merge (piped into tee and samtools index)
+def merge_ref_group_procs(num_parts, index=False):
+    if index:
+        return num_parts + 3
+    return num_parts + 1
+
+# Merges the reads of a group of consecutive references from the sorted and
+# indexed parts; a group with too many references for a command line is
+# merged in chunks, which are then concatenated
+def merge_ref_group(sam_header_filename, sorted_bam_parts, refs, group_bam, log_fname, index=False):
+    merge_log = open(log_fname, "w")
+    ref_chunks = chunk_ref_names(refs)
+    if len(ref_chunks) == 1:
+        merge_ref_chunk(sam_header_filename, sorted_bam_parts, refs, group_bam,
+                        log_fname, merge_log, index)
+        return
+    chunk_bams = ["%s.chunk%d.bam" % (group_bam[:-4], c) for c in range(len(ref_chunks))]
+    for c in range(len(ref_chunks)):
+        merge_ref_chunk(sam_header_filename, sorted_bam_parts, ref_chunks[c], chunk_bams[c],
+                        log_fname, merge_log)
+    cat_cmd = [samtools_path, "cat", "-h", sam_header_filename]
+    if index:
+        write_indexed_bam(cat_cmd + chunk_bams, group_bam, "merge " + os.path.basename(group_bam),
+                          log_fname, merge_log, False)
+    else:
+        cat_cmd += ["-o", group_bam] + chunk_bams
+        print >> run_log, " ".join(cat_cmd)
+        ret = tracked_call(cat_cmd, pipeline="merge " + os.path.basename(group_bam),
+                           stderr=merge_log)
+        if ret != 0:
+            die(fail_str+"Error executing: "+" ".join(cat_cmd)+"\n"+log_tail(log_fname))
+    for chunk_bam in chunk_bams:
+        os.remove(chunk_bam)
+
+# each part is read through a region query piped into the merge
+def merge_ref_chunk(sam_header_filename, sorted_bam_parts, refs, group_bam, log_fname, merge_log,
+                    index=False):
+    view_fds = []
+    view_procs = []
+    merged = False
     try:
-    # -- merge the unmapped files
-      um_parts = []
-      um_merged = output_dir + "unmapped.bam"
-      for i in range(params.system_params.num_threads):
-          left_um_file =  tmp_dir + "unmapped_left_%d.bam" % i
-          right_um_file = tmp_dir + "unmapped_right_%d.bam" % i
-          um_len = len(um_parts)
-          if nonzeroFile(left_um_file):
-             um_parts.append(left_um_file)
-          if right_reads and nonzeroFile(right_um_file):
-             um_parts.append(right_um_file)
-
-      if len(um_parts) > 0:
-          if len(um_parts)==1:
-            move(um_parts[0], um_merged)
-          else:
-            merge_cmd=[prog_path("bam_merge"), "-Q",
-              "--sam-header", sam_header_filename, um_merged]
-            merge_cmd += um_parts
+        for bam_part in sorted_bam_parts:
+            view_cmd = [samtools_path, "view", "-u", bam_part] + refs
+            rfd, wfd = os.pipe()
+            view_fds.append(rfd)
+            print >> run_log, " ".join(view_cmd) + " > /dev/fd/%d &" % rfd
+            try:
+                view_procs.append(TrackedPopen(view_cmd,
+                                  pipeline="merge " + os.path.basename(group_bam),
+                                  stdout=wfd, stderr=merge_log, close_fds=True))
+            finally:
+                os.close(wfd)
+        merge_cmd = [samtools_path, "merge", "-f", "-h", sam_header_filename]
+        if index:
+            merge_cmd += ["-"] + ["/dev/fd/%d" % fd for fd in view_fds]
+            write_indexed_bam(merge_cmd, group_bam, "merge " + os.path.basename(group_bam),
+                              log_fname, merge_log, False)
+        else:
+            merge_cmd += [group_bam] + ["/dev/fd/%d" % fd for fd in view_fds]
             print >> run_log, " ".join(merge_cmd)
-            ret = subprocess.call( merge_cmd,
-                                   stderr=open(logging_dir + "bam_merge_um.log", "w") )
+            ret = tracked_call(merge_cmd, pipeline="merge " + os.path.basename(group_bam),
+                               stderr=merge_log)
             if ret != 0:
-                die(fail_str+"Error executing: "+" ".join(merge_cmd)+"\n"+log_tail(logging_dir+"bam_merge_um.log"))
-            for um_part in um_parts:
-                os.remove(um_part)
-
-    except OSError, o:
-          die(fail_str+"Error: "+str(o)+"\n"+log_tail(log_fname))
-
-    return junctions
+                die(fail_str+"Error executing: "+" ".join(merge_cmd)+"\n"+log_tail(log_fname))
+        merged = True
+    finally:
+        for fd in view_fds:
+            os.close(fd)
+        for proc in view_procs:
+            if not merged and proc.poll() is None:
+                proc.kill()
+            proc.wait()
+    if [proc for proc in view_procs if proc.returncode != 0]:
+        die(fail_str+"Error extracting the reads of "+group_bam+"\n"+log_tail(log_fname))
+
+# Merges the sorted and indexed parts into accepted_hits.bam by groups of
+# consecutive references balanced by read count: the groups are merged
+# concurrently and then concatenated in header order, which is only a copy
+# of the compressed blocks
+def region_merge_bam_parts(params, sam_header_filename, accepted_hits, sorted_bam_parts):
+    all_ref_counts = bam_ref_counts(sorted_bam_parts)
+    ref_counts = [(ref, count) for ref, length, count in all_ref_counts if ref != "*" and count > 0]
+    num_unplaced = sum([count for ref, length, count in all_ref_counts if ref == "*"])
+    # each group merge runs a program per part and holds as many threads
+    group_procs = merge_ref_group_procs(len(sorted_bam_parts))
+    groups = partition_refs(ref_counts, max(1, params.system_params.num_threads / group_procs))
+    if num_unplaced > 0 or len(groups) < 2:
+        # reads without a position cannot be queried by region, and a
+        # single group is only a slower merge
+        merge_bam_parts(params, sam_header_filename, accepted_hits, sorted_bam_parts)
+    else:
+        group_bams = ["%s_group%d.bam" % (sorted_bam_parts[0][:-4], g) for g in range(len(groups))]
+        merge_jobs = TokenScheduler(params.system_params.num_threads)
+        for g in range(len(groups)):
+            merge_jobs.add(group_procs, merge_ref_group, sam_header_filename, sorted_bam_parts, groups[g],
+                           group_bams[g], logging_dir + "reports.merge_bam.log%d" % g)
+        merge_jobs.run()
+        cat_cmd = [samtools_path, "cat", "-h", sam_header_filename]
+        if params.report_params.index_bam:
+            write_indexed_bam(cat_cmd + group_bams, accepted_hits + ".bam",
+                              "merge " + os.path.basename(accepted_hits),
+                              logging_dir + "reports.merge_bam.log")
+        else:
+            cat_out = None
+            if params.report_params.output_stream:
+                cat_out = open_output_stream(params)
+            else:
+                cat_cmd += ["-o", accepted_hits + ".bam"]
+            cat_cmd += group_bams
+            print >> run_log, " ".join(cat_cmd)
+            ret = tracked_call(cat_cmd, pipeline="merge " + os.path.basename(accepted_hits),
+                               stdout=cat_out,
+                               stderr=open(logging_dir + "reports.merge_bam.log", "w"))
+            if ret != 0:
+                die(fail_str+"Error executing: "+" ".join(cat_cmd)+"\n"+log_tail(logging_dir + "reports.merge_bam.log"))
+        for group_bam in group_bams:
+            os.remove(group_bam)
+        for bam_part in sorted_bam_parts:
+            os.remove(bam_part)
+    for bam_part in sorted_bam_parts:
+        os.remove(bam_part + ".bai")
+
+SPLIT_MIN_REF_LENGTH = 10000000 # shorter references share an output file, up to this total length
+
+# the references with reads in header order, grouped for --split-output-by-chrom
+#--> returns [(file_tag, [ref_name, ..], num_reads)]
+def split_ref_groups(ref_counts):
+    groups = []
+    small_refs, small_length, small_reads = [], 0, 0
+    for ref, length, count in ref_counts:
+        if ref == "*" or count == 0:
+            continue
+        if length >= SPLIT_MIN_REF_LENGTH:
+            groups.append((re.sub(r"[^\w.-]", "_", ref), [ref], count))
+            continue
+        small_refs.append(ref)
+        small_length += length
+        small_reads += count
+        if small_length >= SPLIT_MIN_REF_LENGTH:
+            groups.append((None, small_refs, small_reads))
+            small_refs, small_length, small_reads = [], 0, 0
+    if small_refs:
+        groups.append((None, small_refs, small_reads))
+    num_small = 0
+    tags = set()
+    for g in range(len(groups)):
+        tag, refs, count = groups[g]
+        if tag is None:
+            num_small += 1
+            tag = "contigs%d" % num_small
+        while tag in tags:
+            tag += "_"
+        tags.add(tag)
+        groups[g] = (tag, refs, count)
+    return groups
+
+# Writes the sorted and indexed parts as one sorted (and indexed) BAM file
+# per reference, with the short references grouped, and lists the files in
+# accepted_hits.manifest
+def split_bam_parts(params, sam_header_filename, accepted_hits, sorted_bam_parts):
+    ref_counts = bam_ref_counts(sorted_bam_parts)
+    if sum([count for ref, length, count in ref_counts if ref == "*"]) > 0:
+        # reads without a position cannot be queried by region
+        th_logp("\tWarning: alignments without a position, not splitting %s.bam by chromosome" % accepted_hits)
+        merge_bam_parts(params, sam_header_filename, accepted_hits, sorted_bam_parts)
+        for bam_part in sorted_bam_parts:
+            if os.path.exists(bam_part + ".bai"):
+                os.remove(bam_part + ".bai")
+        return
+    groups = split_ref_groups(ref_counts)
+    # the refs of a group of small contigs can be too many for a single
+    # command line, merge_ref_group() then merges them in chunks
+    group_procs = merge_ref_group_procs(len(sorted_bam_parts), params.report_params.index_bam)
+    merge_jobs = TokenScheduler(params.system_params.num_threads)
+    for g in range(len(groups)):
+        tag, refs, count = groups[g]
+        merge_jobs.add(group_procs, merge_ref_group, sam_header_filename, sorted_bam_parts, refs,
+                       "%s.%s.bam" % (accepted_hits, tag), logging_dir + "reports.merge_bam.log%d" % g,
+                       params.report_params.index_bam)
+    merge_jobs.run()
+    manifest = open(accepted_hits + ".manifest", "w")
+    print >> manifest, "#file	reads	references"
+    for tag, refs, count in groups:
+        print >> manifest, "%s	%d	%s" % (os.path.basename("%s.%s.bam" % (accepted_hits, tag)),
+                                           count, ",".join(refs))
+    manifest.close()
+    for bam_part in sorted_bam_parts:
+        os.remove(bam_part)
+        os.remove(bam_part + ".bai")
+
+def sort_bam_part(bamsort_cmd, bam_part, log_fname):
+    print >> run_log, " ".join(bamsort_cmd)
+    ret = tracked_call(bamsort_cmd, pipeline="sort " + os.path.basename(bam_part),
+                          stderr=open(log_fname, "w"))
+    if ret != 0:
+        die(fail_str+"Error executing: "+" ".join(bamsort_cmd)+"\n"+log_tail(log_fname))
+    os.remove(bam_part)
+
+# Merges the (sorted) tophat_reports parts into accepted_hits.bam, or into
+# accepted_hits.sam if BAM output was not requested
+def merge_bam_parts(params, sam_header_filename, accepted_hits, bam_parts, remove_parts=True):
+    pipeline_name = "merge " + os.path.basename(accepted_hits)
+    if len(bam_parts) > 1:
+        if params.report_params.sort_bam:
+           bammerge_cmd = [samtools_path,
+                "merge","-f","-h", sam_header_filename]
+           if not params.report_params.convert_bam:
+                bammerge_cmd += ["-u"]
+        else: #not sorted, so just raw merge
+           bammerge_cmd = [prog_path("bam_merge"), "-Q",
+                 "--sam-header", sam_header_filename]
+
+        if params.report_params.convert_bam and params.report_params.sort_bam and \
+               params.report_params.index_bam:
+           bammerge_cmd += ["-"]
+           bammerge_cmd += bam_parts
+           write_indexed_bam(bammerge_cmd, accepted_hits + ".bam", pipeline_name,
+                             logging_dir + "reports.merge_bam.log")
+        elif params.report_params.convert_bam:
+           merge_out = None
+           if params.report_params.output_stream:
+              bammerge_cmd += ["-"]
+              merge_out = open_output_stream(params)
+           else:
+              bammerge_cmd += ["%s.bam" % accepted_hits]
+           bammerge_cmd += bam_parts
+           print >> run_log, " ".join(bammerge_cmd)
+           ret = tracked_call(bammerge_cmd, pipeline=pipeline_name, stdout=merge_out,
+                  stderr=open(logging_dir + "reports.merge_bam.log", "w"))
+           if ret != 0:
+             die(fail_str+"Error executing: "+" ".join(bammerge_cmd)+"\n"+log_tail(logging_dir + "reports.merge_bam.log"))
+        else: #make .sam
+           bammerge_cmd += ["-"]
+           bammerge_cmd += bam_parts
+           merge_proc = TrackedPopen(bammerge_cmd, pipeline=pipeline_name,
+                        stdout=subprocess.PIPE,
+                        stderr=open(logging_dir + "reports.merge_bam.log", "w"))
+           bam2sam_cmd = [samtools_path, "view", "-h", "-"]
+           sam_proc = TrackedPopen(bam2sam_cmd, pipeline=pipeline_name,
+                          stdin=merge_proc.stdout,
+                          stdout=open_output_stream(params, accepted_hits + ".sam"),
+                          stderr=open(logging_dir + "accepted_hits_bam_to_sam.log", "w"))
+           merge_proc.stdout.close()
+           shellcmd = " ".join(bammerge_cmd) + " | " + " ".join(bam2sam_cmd)
+           print >> run_log, shellcmd
+           sam_proc.communicate()
+           retcode = sam_proc.returncode
+           if retcode:
+             die(fail_str+"Error running:\n"+shellcmd)
+        if remove_parts:
+            for bam_part in bam_parts:
+                os.remove(bam_part)
+    else: # only one file
+        if params.report_params.output_stream and params.report_params.convert_bam:
+           hits_out = open_output_stream(params)
+           copyfileobj(open(bam_parts[0], "rb"), hits_out, PIPE_BUFSIZE)
+           hits_out.close()
+           os.remove(bam_parts[0])
+           return
+        move(bam_parts[0], accepted_hits+".bam")
+        if params.report_params.convert_bam and params.report_params.sort_bam and \
+               params.report_params.index_bam:
+           index_bam_part(accepted_hits + ".bam", logging_dir + "reports.samtools_index.log")
+           write_idxstats(accepted_hits + ".bam")
+        if not params.report_params.convert_bam:
+           #just convert to .sam
+           bam2sam_cmd = [samtools_path, "view", "-h", accepted_hits+".bam"]
+           shellcmd = " ".join(bam2sam_cmd) + " > " + accepted_hits + ".sam"
+           print >> run_log, shellcmd
+           r = tracked_call(bam2sam_cmd, pipeline=pipeline_name,
+                          stdout=open_output_stream(params, accepted_hits + ".sam"),
+                          stderr=open(logging_dir + "accepted_hits_bam_to_sam.log", "w"))
+           if r != 0:
+              die(fail_str+"Error running: "+shellcmd)
+           os.remove(accepted_hits+".bam")
+
+# the destination of the final alignments: the --output-stream file, named
+# pipe or the original stdout, otherwise out_fname (if given)
+def open_output_stream(params, out_fname=None):
+    stream = params.report_params.output_stream
+    if not stream:
+        return open(out_fname, "wb")
+    if stream == "-":
+        return os.fdopen(os.dup(params.report_params.stdout_fd), "wb")
+    return open(stream, "wb")
+
+# Writes the sorted BAM stream of cmd into bam_file through tee, so that
+# samtools index builds bam_file.bai from the same stream instead of
+# reading the BAM file again; the per reference read counts from the
+# index go to a .idxstats file next to the BAM file
+def write_indexed_bam(cmd, bam_file, pipeline_name, log_fname, log=None, idxstats=True):
+    if log is None:
+        log = open(log_fname, "w")
+    tee_cmd = ["tee", bam_file]
+    index_cmd = [samtools_path, "index", "/dev/stdin", bam_file + ".bai"]
+    if os.path.exists(bam_file + ".bai"):
+        os.remove(bam_file + ".bai") # from an earlier run
+    shellcmd = " | ".join([" ".join(cmd), " ".join(tee_cmd), " ".join(index_cmd)])
+    print >> run_log, shellcmd
+    out_proc = TrackedPopen(cmd, pipeline=pipeline_name,
+                            stdout=subprocess.PIPE, stderr=log)
+    tee_proc = TrackedPopen(tee_cmd, pipeline=pipeline_name,
+                            stdin=out_proc.stdout, stdout=subprocess.PIPE, stderr=log)
+    out_proc.stdout.close()
+    index_proc = TrackedPopen(index_cmd, pipeline=pipeline_name,
+                              stdin=tee_proc.stdout, stderr=log)
+    tee_proc.stdout.close()
+    if [p for p in (index_proc, tee_proc, out_proc) if p.wait() != 0]:
+        die(fail_str+"Error running: "+shellcmd+"\n"+log_tail(log_fname))
+    # samtools index exits with 0 even when it gives up on a BAM file
+    if not os.path.exists(bam_file + ".bai") or os.path.getsize(bam_file + ".bai") == 0:
+        die(fail_str+"Error: samtools index did not write "+bam_file+".bai\n"+log_tail(log_fname))
+    if idxstats:
+        write_idxstats(bam_file)
+
+# samtools idxstats of an indexed BAM file, which only reads the index
+def write_idxstats(bam_file):
+    stats_file = bam_file[:-4] + ".idxstats"
+    idxstats_cmd = [samtools_path, "idxstats", bam_file]
+    print >> run_log, " ".join(idxstats_cmd) + " > " + stats_file
+    ret = tracked_call(idxstats_cmd, stdout=open(stats_file, "w"), stderr=tophat_log)
+    if ret != 0:
+        die(fail_str+"Error executing: "+" ".join(idxstats_cmd))
+
+def merge_unmapped_parts(params, sam_header_filename, um_parts, um_merged):
+    if len(um_parts)==1:
+      move(um_parts[0], um_merged)
+    else:
+      merge_cmd=[prog_path("bam_merge"), "-Q",
+        "--sam-header", sam_header_filename, um_merged]
+      merge_cmd += um_parts
+      print >> run_log, " ".join(merge_cmd)
+      ret = tracked_call( merge_cmd,
+                             stderr=open(logging_dir + "bam_merge_um.log", "w") )
+      if ret != 0:
+          die(fail_str+"Error executing: "+" ".join(merge_cmd)+"\n"+log_tail(logging_dir+"bam_merge_um.log"))
+      for um_part in um_parts:
+          os.remove(um_part)
+    if params.report_params.index_unmapped:
+      # samtools index exits with 0 even when it gives up on a BAM file
+      index_log = logging_dir + "samtools_index_um.log"
+      index_cmd = [samtools_path, "index", um_merged]
+      print >> run_log, " ".join(index_cmd)
+      tracked_call(index_cmd, stderr=open(index_log, "w"))
+      if fileExists(um_merged + ".bai"):
+          write_idxstats(um_merged)
+      else:
+          th_logp("\tWarning: could not index %s, see %s" % (um_merged, index_log))
 
 
 # Split up each read in a FASTQ file into multiple segments. Creates a FASTQ file
 # for each segment  This function needs to be fixed to support mixed read length
 # inputs
-def open_output_files(prefix, num_files_prev, num_files, out_segf, extension, params):
+def open_output_files(prefix, num_files_prev, num_files, out_segf, extension, params, seg_fifos=None):
        i = num_files_prev + 1
        while i <= num_files:
           segfname=prefix+("_seg%d" % i)+extension
-          out_segf.append(ZWriter(segfname,params.system_params))
+          zf = ZWriter(segfname,params.system_params)
+          if seg_fifos and i <= len(seg_fifos):
+              zf = TeeWriter(zf, seg_fifos[i-1])
+          out_segf.append(zf)
           i += 1
 
+# split_reads() reads its input in blocks of about this size, and segments
+# the blocks in up to SPLIT_MAX_PROCS processes (within -p); beyond a few
+# processes the reading and writing of the blocks is the bottleneck
+SPLIT_BLOCK_SIZE = 4 * 1024 * 1024
+SPLIT_MAX_PROCS = 4
+
+# the valid colors; color_base_at() deletes them with str.translate() to
+# find any invalid ones
+COLOR_DIGITS = "0123"
+
+BLANK_LINE = re.compile(r"^\s*$", re.M)
+
+# Yields the non-blank lines of f in blocks of whole records (rec_lines lines
+# each); an incomplete last record is dropped. The lines are not stripped.
+def read_blocks(f, rec_lines, block_size=SPLIT_BLOCK_SIZE):
+    partial_line = ""
+    lines = []
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = partial_line + data
+        cut = data.rfind("\n")
+        partial_line = data[cut+1:]
+        if cut < 0:
+            continue
+        data = data[:cut]
+        if BLANK_LINE.search(data):
+            lines.extend([l for l in data.split("\n") if l.strip()])
+        else:
+            lines.extend(data.split("\n"))
+        n = len(lines) - len(lines) % rec_lines
+        if n:
+            yield lines[:n]
+            lines = lines[n:]
+    if partial_line.strip():
+        lines.append(partial_line)
+    n = len(lines) - len(lines) % rec_lines
+    if n:
+        yield lines[:n]
+
+# Returns the base at position pos of a colorspace read (primer base followed
+# by colors); bases after an invalid color or primer are 'N'.
+# Each base is the XOR of the primer base with the colors before it, so only
+# the parity of the colors with bit 0 (1,3) and bit 1 (2,3) set is needed.
+def color_base_at(color_seq, pos):
+    if pos == 0:
+        return color_seq[0]
+    colors = color_seq[1:pos+1]
+    if color_seq[0] not in "ACGT" or colors.translate(None, COLOR_DIGITS):
+        return 'N'
+    bits = (colors.count('1') + colors.count('3')) % 2
+    bits |= ((colors.count('2') + colors.count('3')) % 2) << 1
+    return "ACGT"["ACGT".index(color_seq[0]) ^ bits]
+
+# Segments a block of reads: the lines of whole FASTA/FASTQ records, as a
+# list or joined by newlines, or BAM records (see bam_record_blocks()).
+# The segments of each segment number are collected in one buffer, or all
+# segments in a single buffer for a multiplexed segment file.
+#--> returns (num_reads, max_segments, [segment buffer])
+def segment_block(job):
+    (lines, segment_length, fasta, color, multiplex, bam_input) = job
+    if bam_input:
+        lines = decode_bam_records(lines)
+    elif isinstance(lines, str):
+        lines = lines.split("\n")
+    if fasta:
+        rec_lines = 2
+    else:
+        rec_lines = 4
+    if color:
+        color_offset = 1
+    else:
+        color_offset = 0
+    # Bowtie's minimum read length here is 20bp, so if the last segment
+    # is between 20 and segment_length bp long, go ahead and write it out
+    min_last_seg = min(segment_length - 2, 20)
+    seg_bufs = [[]]
+    max_segments = 0
+    for r in xrange(0, len(lines), rec_lines):
+        read_name = lines[r].strip()
+        read_seq = lines[r+1].strip()
+        read_length = len(read_seq)
+        num_segments = read_length / segment_length
+        if read_length % segment_length >= min_last_seg:
+            num_segments += 1
+        if num_segments == 0:
+            continue
+        starts = range(0, num_segments * segment_length, segment_length)
+        ends = starts[1:] + [read_length]
+        if color and [o for o in starts[1:] if read_seq[o+1] not in COLOR_DIGITS]:
+            continue
+        if num_segments > max_segments:
+            max_segments = num_segments
+            if not multiplex:
+                while len(seg_bufs) < max_segments:
+                    seg_bufs.append([])
+        for seg_num in xrange(num_segments):
+            start = starts[seg_num]
+            end = ends[seg_num]
+            seg_seq = read_seq[start+color_offset:end+color_offset]
+            if color:
+                seg_seq = color_base_at(read_seq, start) + seg_seq
+            if multiplex:
+                buf = seg_bufs[0]
+            else:
+                buf = seg_bufs[seg_num]
+            if fasta:
+                buf.append("%s|%d:%d:%d\n%s\n" % (read_name, start, seg_num, num_segments, seg_seq))
+            else:
+                buf.append("%s|%d:%d:%d\n%s\n+\n%s\n" % (read_name, start, seg_num, num_segments,
+                                                          seg_seq, lines[r+3].strip()[start:end]))
+    return (len(lines) / rec_lines, max_segments, ["".join(buf) for buf in seg_bufs])
+
+# BAM decoding for split_reads(), which reads the unmapped reads BAM written by
+# fix_map_ordering directly instead of through "bam2fastx --all"
+BAM_MAGIC = "BAM\1"
+BAM_RECORD_CORE = struct.Struct("<8xB3xHHi") # l_read_name, n_cigar_op, flag, l_seq
+BAM_INT = struct.Struct("<i")
+BAM_FREVERSE, BAM_FREAD1, BAM_FREAD2, BAM_FQCFAIL = 0x10, 0x40, 0x80, 0x200
+# 4-bit bases, from their hex digits
+BAM_SEQ_CODES = string.maketrans("0123456789abcdef", "=ACMGRSVTWYHKDBN")
+# the complement table of bam2fastx (samtools), which also swaps S and W
+BAM_SEQ_COMPLEMENT = string.maketrans("=ACMGRSVTWYHKDBN", "=TGKCYWBASRDMHVN")
+BAM_QUAL_CODES = "".join([chr((q + 33) & 0xFF) for q in range(255)]) + 'I'
+BAM_AUX_SIZES = { 'A':1, 'c':1, 'C':1, 's':2, 'S':2, 'i':4, 'I':4, 'f':4 }
+
+#--> returns the length of the BAM header at the start of buf, or None if
+# buf does not hold all of it yet
+def bam_header_size(buf):
+    if len(buf) < 8:
+        return None
+    if buf[:4] != BAM_MAGIC:
+        raise ValueError("not a BAM file")
+    p = 8 + BAM_INT.unpack_from(buf, 4)[0]
+    if len(buf) < p + 4:
+        return None
+    n_ref = BAM_INT.unpack_from(buf, p)[0]
+    p += 4
+    for i in xrange(n_ref):
+        if len(buf) < p + 4:
+            return None
+        p += 8 + BAM_INT.unpack_from(buf, p)[0]
+    if len(buf) < p:
+        return None
+    return p
+
+#--> returns the value of a Z type tag in the auxiliary data of a BAM record
+def bam_aux_string(aux, tag):
+    p = 0
+    while p + 3 <= len(aux):
+        aux_tag, aux_type = aux[p:p+2], aux[p+2]
+        p += 3
+        if aux_type in "ZH":
+            end = aux.index("\0", p)
+            if aux_tag == tag and aux_type == 'Z':
+                return aux[p:end]
+            p = end + 1
+        elif aux_type in BAM_AUX_SIZES:
+            p += BAM_AUX_SIZES[aux_type]
+        elif aux_type == 'B' and aux[p] in BAM_AUX_SIZES:
+            p += 5 + BAM_INT.unpack_from(aux, p+1)[0] * BAM_AUX_SIZES[aux[p]]
+        else:
+            break
+    return None
+
+#--> returns the read name of the BAM record at buf[p:]
+def bam_record_name(buf, p):
+    return buf[p+36:p+35+ord(buf[p+12])]
+
+# Yields the alignment records of a BAM file (each with its block_size field)
+# in blocks of about block_size compressed bytes; the records of a read name
+# are never split between blocks, so each block can be decoded on its own
+def bam_record_blocks(f, block_size=SPLIT_BLOCK_SIZE):
+    buf = ""
+    header_size = None
+    unpack_int = BAM_INT.unpack_from
+    for chunk in gunzip_chunks(f, block_size):
+        buf += chunk
+        if header_size is None:
+            header_size = bam_header_size(buf)
+            if header_size is None:
+                continue
+            buf = buf[header_size:]
+        starts = []
+        p = 0
+        buf_len = len(buf)
+        while p + 4 <= buf_len:
+            rec_end = p + 4 + unpack_int(buf, p)[0]
+            if rec_end > buf_len:
+                break
+            starts.append(p)
+            p = rec_end
+        if not starts:
+            continue
+        # hold back the records of the last read name, more may follow
+        i = len(starts) - 1
+        last_name = bam_record_name(buf, starts[i])
+        while i > 0 and bam_record_name(buf, starts[i-1]) == last_name:
+            i -= 1
+        if starts[i] > 0:
+            yield buf[:starts[i]]
+            buf = buf[starts[i]:]
+    if header_size is None:
+        raise ValueError("truncated BAM file")
+    p = 0
+    while p + 4 <= len(buf):
+        p += 4 + unpack_int(buf, p)[0]
+    if p != len(buf):
+        raise ValueError("truncated BAM file")
+    if buf:
+        yield buf
+
+# Decodes a block of BAM records into FASTQ lines, the same reads
+# "bam2fastx --all" writes: QC failed reads and reads without a sequence are
+# skipped, the OQ qualities are used when present, reverse strand reads are
+# reverse complemented and a read is written once per mate
+def decode_bam_records(buf):
+    lines = []
+    last_name = None
+    written = 0 # mates of last_name written: 1, 2 or 4 (unpaired)
+    unpack_int = BAM_INT.unpack_from
+    unpack_core = BAM_RECORD_CORE.unpack_from
+    hexlify = binascii.hexlify
+    p = 0
+    buf_len = len(buf)
+    while p < buf_len:
+        rec_end = p + 4 + unpack_int(buf, p)[0]
+        (l_read_name, n_cigar, flag, l_seq) = unpack_core(buf, p + 4)
+        rec = p + 36
+        p = rec_end
+        if flag & BAM_FQCFAIL or l_seq <= 0:
+            continue
+        name = buf[rec:rec+l_read_name-1]
+        rec += l_read_name + 4 * n_cigar
+        seq_end = rec + (l_seq + 1) / 2
+        seq = hexlify(buf[rec:seq_end])[:l_seq].translate(BAM_SEQ_CODES)
+        qual = None
+        if buf.find("OQZ", seq_end + l_seq, rec_end) >= 0:
+            qual = bam_aux_string(buf[seq_end+l_seq:rec_end], "OQ")
+        if qual is None:
+            qual = buf[seq_end:seq_end+l_seq].translate(BAM_QUAL_CODES)
+        if flag & BAM_FREVERSE:
+            seq = seq.translate(BAM_SEQ_COMPLEMENT)[::-1]
+            qual = qual[::-1]
+        if name != last_name:
+            last_name = name
+            written = 0
+        if flag & BAM_FREAD1:
+            mate = 1
+        elif flag & BAM_FREAD2:
+            mate = 2
+        else:
+            mate = 4
+        if mate & written:
+            continue
+        written |= mate
+        lines += ("@" + name, seq, "+", qual)
+    return lines
+
+# With seg_fifos (--stream-segments) each segment is also written into the
+# named pipe seg_fifos[seg_num-1]; all the pipes are closed at the end, even
+# those of segments no read was long enough to have.
+# When num_threads is given it overrides -p for the segmenting processes.
 def split_reads(reads_filename,
                 prefix,
                 fasta,
                 params,
-                segment_length):
+                segment_length,
+                seg_fifos=None,
+                num_threads=None):
     #reads_file = open(reads_filename)
     out_segfiles = []
     if fasta:
@@ -2887,128 +5012,99 @@ def split_reads(reads_filename,
     else:
         extension = ".fq"
     if use_zpacker: extension += ".z"
-    existing_seg_files = glob.glob(prefix+"_seg*"+extension)
-    if resumeStage > currentStage and len(existing_seg_files)>0:
+    multiplex = params.multiplex_segments
+    if multiplex:
+        existing_seg_files = glob.glob(prefix+".segmux*"+extension)
+    else:
+        existing_seg_files = glob.glob(prefix+"_seg*"+extension)
+    if len(existing_seg_files)>0 and (resumeStage > currentStage or
+                                      not os.path.exists(reads_filename)):
          #skip this, we are going to return the existing files
+         #(the IUM reads of a --stream-segments run were never written out)
          return existing_seg_files
-    zreads = ZReader(reads_filename, params, False)
-
-    def convert_color_to_bp(color_seq):
-        decode_dic = { 'A0':'A', 'A1':'C', 'A2':'G', 'A3':'T', 'A4':'N', 'A.':'N', 'AN':'N',
-                       'C0':'C', 'C1':'A', 'C2':'T', 'C3':'G', 'C4':'N', 'C.':'N', 'CN':'N',
-                       'G0':'G', 'G1':'T', 'G2':'A', 'G3':'C', 'G4':'N', 'G.':'N', 'GN':'N',
-                       'T0':'T', 'T1':'G', 'T2':'C', 'T3':'A', 'T4':'N', 'T.':'N', 'TN':'N',
-                       'N0':'N', 'N1':'N', 'N2':'N', 'N3':'N', 'N4':'N', 'N.':'N', 'NN':'N',
-                       '.0':'N', '.1':'N', '.2':'N', '.3':'N', '.4':'N', '..':'N', '.N':'N' }
-
-        base = color_seq[0]
-        bp_seq = base
-        for ch in color_seq[1:]:
-            base = decode_dic[base+ch]
-            bp_seq += base
-        return bp_seq
-
-    def convert_bp_to_color(bp_seq):
-        encode_dic = { 'AA':'0', 'CC':'0', 'GG':'0', 'TT':'0',
-                       'AC':'1', 'CA':'1', 'GT':'1', 'TG':'1',
-                       'AG':'2', 'CT':'2', 'GA':'2', 'TC':'2',
-                       'AT':'3', 'CG':'3', 'GC':'3', 'TA':'3',
-                       'A.':'4', 'C.':'4', 'G.':'4', 'T.':'4',
-                       '.A':'4', '.C':'4', '.G':'4', '.T':'4',
-                       '.N':'4', 'AN':'4', 'CN':'4', 'GN':'4',
-                       'TN':'4', 'NA':'4', 'NC':'4', 'NG':'4',
-                       'NT':'4', 'NN':'4', 'N.':'4', '..':'4' }
-
-        base = bp_seq[0]
-        color_seq = base
-        for ch in bp_seq[1:]:
-            color_seq += encode_dic[base + ch]
-            base = ch
-
-        return color_seq
-
-    def split_record(read_name, read_seq, read_qual, out_segf, offsets, color):
-        if color:
-            color_offset = 1
-            read_seq_temp = convert_color_to_bp(read_seq)
-
-            seg_num = 1
-            while seg_num + 1 < len(offsets):
-                if read_seq[offsets[seg_num]+1] not in ['0', '1', '2', '3']:
-                    return
-                seg_num += 1
-        else:
-            color_offset = 0
-
-        seg_num = 0
-        last_seq_offset = 0
-        while seg_num + 1 < len(offsets):
-            f = out_segf[seg_num].file
-            seg_seq = read_seq[last_seq_offset+color_offset:offsets[seg_num + 1]+color_offset]
-            print >> f, "%s|%d:%d:%d" % (read_name,last_seq_offset,seg_num, len(offsets) - 1)
-            if color:
-                print >> f, "%s%s" % (read_seq_temp[last_seq_offset], seg_seq)
-            else:
-                print >> f, seg_seq
-            if not fasta:
-                seg_qual = read_qual[last_seq_offset:offsets[seg_num + 1]]
-                print >> f, "+"
-                print >> f, seg_qual
-            seg_num += 1
-            last_seq_offset = offsets[seg_num]
-
-    line_state = 0
-    read_name = ""
-    read_seq = ""
-    read_quals = ""
+    color = params.read_params.color
+    if fasta:
+        rec_lines = 2
+    else:
+        rec_lines = 4
+    if not num_threads:
+        num_threads = params.system_params.num_threads
+    num_procs = min(num_threads, SPLIT_MAX_PROCS)
+    # the BAM records are decoded by the segmenting processes, with a single
+    # process bam2fastx (running next to it) is faster
+    bam_input = reads_filename.lower().endswith(".bam") and num_procs > 1 and \
+                not (fasta or color)
+    if bam_input:
+        zreads = open(reads_filename, "rb")
+        read_blocks_iter = bam_record_blocks(zreads)
+    else:
+        zreads = ZReader(reads_filename, params, False)
+        read_blocks_iter = read_blocks(zreads.file, rec_lines)
+    mux_segf = None
+    if multiplex:
+        # all segments go into a single file, its final name will also
+        # carry the number of segments (see segmux_count())
+        mux_segf = ZWriter(prefix + ".segmux" + extension, params.system_params)
+
+    start_time = time.time()
+    num_reads = 0
     num_segments = 0
-    offsets = []
-    for line in zreads.file:
-        if line.strip() == "":
-            continue
-        if line_state == 0:
-            read_name = line.strip()
-        elif line_state == 1:
-            read_seq = line.strip()
-
-            read_length = len(read_seq)
-            tmp_num_segments = read_length / segment_length
-            offsets = [segment_length * i for i in range(0, tmp_num_segments + 1)]
-
-            # Bowtie's minimum read length here is 20bp, so if the last segment
-            # is between 20 and segment_length bp long, go ahead and write it out
-            if read_length % segment_length >= min(segment_length - 2, 20):
-                offsets.append(read_length)
-                tmp_num_segments += 1
-            else:
-                offsets[-1] = read_length
-
-            if tmp_num_segments == 1:
-                offsets = [0, read_length]
-
-            if tmp_num_segments > num_segments:
-                open_output_files(prefix, num_segments, tmp_num_segments, out_segfiles, extension, params)
-                num_segments = tmp_num_segments
-
-            if fasta:
-                split_record(read_name, read_seq, None, out_segfiles, offsets, params.read_params.color)
-        elif line_state == 2:
-            line = line.strip()
-        else:
-            read_quals = line.strip()
-            if not fasta:
-                split_record(read_name, read_seq, read_quals, out_segfiles, offsets, params.read_params.color)
+    pool = None
+    if num_procs > 1:
+        pool = multiprocessing.Pool(num_procs)
+
+    # segmented blocks, in input order; with a pool a few blocks are
+    # segmented ahead of the one being written
+    def segmented_blocks():
+        pending = []
+        for block in read_blocks_iter:
+            job = (block, segment_length, fasta, color, multiplex, bam_input)
+            if pool is None:
+                yield segment_block(job)
+                continue
+            if not bam_input:
+                # a single string is much cheaper to send than a list of lines
+                job = ("\n".join(block),) + job[1:]
+            pending.append(pool.apply_async(segment_block, (job,)))
+            if len(pending) > 2 * num_procs:
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
 
-        line_state += 1
-        if fasta:
-            line_state %= 2
-        else:
-            line_state %= 4
+    try:
+        for (block_reads, block_segments, seg_bufs) in segmented_blocks():
+            if block_segments > num_segments:
+                if multiplex:
+                    out_segfiles.extend([mux_segf] * (block_segments - num_segments))
+                else:
+                    open_output_files(prefix, num_segments, block_segments, out_segfiles, extension, params, seg_fifos)
+                num_segments = block_segments
+            for i in range(len(seg_bufs)):
+                if seg_bufs[i]:
+                    out_segfiles[i].file.write(seg_bufs[i])
+            num_reads += block_reads
+    except (ValueError, zlib.error), e:
+        die(fail_str+"Error reading "+reads_filename+": "+str(e))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     zreads.close()
+    elapsed = time.time() - start_time
+    th_logp("\tsplit %d reads into %d segments in %.1fs (%.0f reads/sec)" %
+            (num_reads, num_segments, elapsed, num_reads / max(elapsed, 0.001)))
+    if multiplex:
+        mux_segf.close()
+        mux_fname = prefix + (".segmux%d" % num_segments) + extension
+        os.rename(mux_segf.fname, mux_fname)
+        return [mux_fname]
     out_fnames=[]
     for zf in out_segfiles:
         zf.close()
         out_fnames.append(zf.fname)
+    if seg_fifos:
+        for seg_fifo in seg_fifos[num_segments:]:
+            open(seg_fifo, "w").close()
     #return [o.fname for o in out_segfiles]
     return out_fnames
 
@@ -3050,7 +5146,7 @@ def junctions_from_closures(params,
                       right_maps])
     try:
         print >> run_log, ' '.join(juncs_cmd)
-        retcode = subprocess.call(juncs_cmd,
+        retcode = tracked_call(juncs_cmd,
                                  stderr=juncs_log)
 
         # spanning_reads returned an error
@@ -3107,12 +5203,18 @@ def junctions_from_segments(params,
                      left_reads,
                      left_reads_map,
                      left_maps])
+    segj_inputs = [left_reads, left_reads_map] + left_seg_maps + unmapped_reads
     if right_seg_maps:
         right_maps = ','.join(right_seg_maps)
         segj_cmd.extend([right_reads, right_reads_map, right_maps])
+        segj_inputs += [right_reads, right_reads_map] + right_seg_maps
+    segj_outputs = [juncs_out, insertions_out, deletions_out, fusions_out]
+    if checkpoint_valid(segj_cmd, segj_inputs):
+        th_logp("\t(outputs of a previous run are up to date, skipping)")
+        return segj_outputs
     try:
         print >> run_log, " ".join(segj_cmd)
-        retcode = subprocess.call(segj_cmd,
+        retcode = tracked_call(segj_cmd,
                                  preexec_fn=subprocess_setup,
                                  stderr=segj_log)
 
@@ -3126,7 +5228,8 @@ def junctions_from_segments(params,
            th_logp(fail_str + "Error: segment_juncs not found on this system")
         die(str(o))
 
-    return [juncs_out, insertions_out, deletions_out, fusions_out]
+    write_checkpoint(segj_cmd, segj_inputs, segj_outputs)
+    return segj_outputs
 
 # Joins mapped segments into full-length read alignments via the executable
 # long_spanning_reads
@@ -3142,6 +5245,8 @@ def join_mapped_segments(params,
                          spliced_seg_maps,
                          alignments_out_name):
     rn=""
+    align_inputs = [reads] + possible_juncs + possible_insertions + possible_deletions + \
+                   possible_fusions + contig_seg_maps + (spliced_seg_maps or [])
     contig_seg_maps = ','.join(contig_seg_maps)
 
     possible_juncs = ','.join(possible_juncs)
@@ -3190,14 +5295,20 @@ def join_mapped_segments(params,
         spliced_seg_maps = ','.join(spliced_seg_maps)
         align_cmd.append(spliced_seg_maps)
 
+    if checkpoint_valid(align_cmd, align_inputs):
+        th_logp("\t(outputs of a previous run are up to date, skipping)")
+        return
     try:
         print >> run_log, " ".join(align_cmd)
-        ret = subprocess.call(align_cmd,
+        ret = tracked_call(align_cmd,
                                   stderr=align_log)
         if ret:
           die(fail_str+"Error running 'long_spanning_reads':"+log_tail(log_fname))
     except OSError, o:
         die(fail_str+"Error: "+str(o))
+    # the alignments are written in one file per thread when -p is given
+    align_outputs = [alignments_out_name] + glob.glob(alignments_out_name[:-4] + "[0-9]*.bam")
+    write_checkpoint(align_cmd, align_inputs, align_outputs)
 
 # This class collects spliced and unspliced alignments for each of the
 # left and right read files provided by the user.
@@ -3235,7 +5346,7 @@ def m2g_convert_coords(params, sam_header_filename, gtf_fname, reads, out_fname)
     try:
         th_log("Converting " + fbasename + " to genomic coordinates (map2gtf)")
         print >> run_log, " ".join(m2g_cmd) + " > " + m2g_log
-        ret = subprocess.call(m2g_cmd,
+        ret = tracked_call(m2g_cmd,
                               stdout=open(m2g_log, "w"),
                               stderr=open(m2g_err, "w"))
         if ret != 0:
@@ -3270,7 +5381,7 @@ def gtf_to_fasta(params, trans_gtf, genome, out_basename):
 
     try:
         print >> run_log, " ".join(g2f_cmd)+" > " + g2f_log
-        ret = subprocess.call(g2f_cmd,
+        ret = tracked_call(g2f_cmd,
                               stdout = open(g2f_log, "w"),
                               stderr = open(g2f_err, "w"))
         if ret != 0:
@@ -3279,11 +5390,73 @@ def gtf_to_fasta(params, trans_gtf, genome, out_basename):
         err_msg = fail_str + str(o)
         die(err_msg + "\n")
     fver = open(out_fver, "w", 0)
-    print >> fver, "%d %d %d" % (GFF_T_VER, os.path.getsize(trans_gtf), os.path.getsize(out_fname))
+    ver_line = "%d %d %d" % (GFF_T_VER, os.path.getsize(trans_gtf), os.path.getsize(out_fname))
+    if params.transcriptome_key:
+        ver_line += " " + params.transcriptome_key
+    print >> fver, ver_line
     fver.close()
     return out_fname
 
-def map2gtf(params, genome_sam_header_filename, ref_fasta, left_reads, right_reads):
+# Builds the transcriptome sequences and their Bowtie index from the
+# annotation, returns the transcriptome index prefix
+def build_transcriptome(params, ref_fasta, num_threads = None):
+    if not num_threads:
+      num_threads = params.system_params.num_threads
+    gtf_name = getFileBaseName(params.gff_annotation)
+    if not params.transcriptome_outdir:
+      t_out_dir = tmp_dir
+      th_log("Building transcriptome data files "+t_out_dir+gtf_name)
+      m2g_ref_name  = t_out_dir + gtf_name
+      m2g_ref_fasta = gtf_to_fasta(params, params.gff_annotation, ref_fasta, m2g_ref_name)
+      return build_idx_from_fa(params.bowtie2, m2g_ref_fasta, t_out_dir, params.read_params.color, num_threads)
+
+    # --transcriptome-index location, possibly shared with concurrent runs:
+    # only one run builds the files (in a private staging directory) while
+    # the others wait for it and then use them
+    t_out_dir = params.transcriptome_outdir + "/"
+    lockf = lock_file(params.transcriptome_index + ".lock", "building transcriptome data files "+t_out_dir+gtf_name)
+    try:
+      if validate_transcriptome(params):
+        th_log("Using transcriptome data files built by another run in "+t_out_dir)
+        return params.transcriptome_index
+      th_log("Building transcriptome data files "+t_out_dir+gtf_name)
+      stage_dir = t_out_dir + ".%s.build.%d/" % (gtf_name, os.getpid())
+      if os.path.exists(stage_dir):
+        rmtree(stage_dir, True)
+      os.makedirs(stage_dir)
+      m2g_ref_fasta = gtf_to_fasta(params, params.gff_annotation, ref_fasta, stage_dir + gtf_name)
+      build_idx_from_fa(params.bowtie2, m2g_ref_fasta, stage_dir, params.read_params.color, num_threads)
+      # publish the files; the .ver file validates the others so it is
+      # removed first and moved into place last
+      ver_fname = gtf_name + ".ver"
+      if os.path.exists(t_out_dir + ver_fname):
+        os.remove(t_out_dir + ver_fname)
+      for fname in os.listdir(stage_dir):
+        if fname != ver_fname:
+          os.rename(stage_dir + fname, t_out_dir + fname)
+      os.rename(stage_dir + ver_fname, t_out_dir + ver_fname)
+      os.rmdir(stage_dir)
+    finally:
+      unlock_file(lockf)
+    return t_out_dir + gtf_name
+
+# Content hash of the transcriptome data inputs: the annotation file, the
+# genome index and the version of the annotation parser
+def transcriptome_key(params, bwt_idx_prefix):
+    gtf_md5 = hashlib.md5()
+    gtf = open(params.gff_annotation, "rb")
+    while True:
+        buf = gtf.read(1024*1024)
+        if not buf:
+            break
+        gtf_md5.update(buf)
+    gtf.close()
+    idx_files = bowtie_index_files(bwt_idx_prefix, params.bowtie2)
+    t_key = hashlib.sha1("%d\t%s\t%s\t%s\t%s" % (GFF_T_VER, gtf_md5.hexdigest(), index_fingerprint(idx_files),
+                                               params.bowtie2, params.read_params.color))
+    return t_key.hexdigest()
+
+def map2gtf(params, genome_sam_header_filename, ref_fasta, left_reads, right_reads, built_index=None):
     """ Main GTF mapping function
 
     Arguments:
@@ -3291,6 +5464,8 @@ def map2gtf(params, genome_sam_header_filename, ref_fasta, left_reads, right_rea
     - `ref_fasta`: The reference genome.
     - `left_reads`: A list of reads.
     - `right_reads`: A list of reads (empty if single-end).
+    - `built_index`: The transcriptome index if it was already built
+      (while the reads were being prepared).
 
     """
     test_input_file(params.gff_annotation)
@@ -3298,19 +5473,15 @@ def map2gtf(params, genome_sam_header_filename, ref_fasta, left_reads, right_rea
     # th_log("Reading in GTF file: " + params.gff_annotation)
     # transcripts = gtf_to_transcripts(params.gff_annotation)
 
-    gtf_name = getFileBaseName(params.gff_annotation)
     m2g_bwt_idx = None
-    t_out_dir = tmp_dir
-    if currentStage < resumeStage or (params.transcriptome_index and not params.transcriptome_outdir):
+    if built_index:
+       m2g_bwt_idx = built_index
+       params.transcriptome_index = m2g_bwt_idx
+    elif currentStage < resumeStage or (params.transcriptome_index and not params.transcriptome_outdir):
        m2g_bwt_idx = params.transcriptome_index
        th_log("Using pre-built transcriptome data..")
     else:
-       if params.transcriptome_outdir:
-         t_out_dir=params.transcriptome_outdir+"/"
-       th_log("Building transcriptome data files "+t_out_dir+gtf_name)
-       m2g_ref_name  = t_out_dir + gtf_name
-       m2g_ref_fasta = gtf_to_fasta(params, params.gff_annotation, ref_fasta, m2g_ref_name)
-       m2g_bwt_idx = build_idx_from_fa(params.bowtie2, m2g_ref_fasta, t_out_dir, params.read_params.color)
+       m2g_bwt_idx = build_transcriptome(params, ref_fasta)
        params.transcriptome_index = m2g_bwt_idx
     if params.transcriptome_buildonly:
        return
@@ -3393,23 +5564,23 @@ def get_preflt_data(params, ri, target_reads, out_mappings, out_unmapped):
  try:
      print >> run_log, shell_cmd
      if do_use_zpacker:
-         prep_proc = subprocess.Popen(prep_cmd,
+         prep_proc = TrackedPopen(prep_cmd, pipeline="prep_reads " + sides[ri],
                                stdout=subprocess.PIPE,
                                stderr=filter_log)
-         zip_proc = subprocess.Popen(zip_cmd,
+         zip_proc = TrackedPopen(zip_cmd, pipeline="prep_reads " + sides[ri],
                                preexec_fn=subprocess_setup,
                                stdin=prep_proc.stdout,
                                stderr=tophat_log, stdout=um_reads)
          prep_proc.stdout.close() #as per http://bugs.python.org/issue7678
          zip_proc.communicate()
-         retcode=prep_proc.poll()
+         retcode=prep_proc.wait()
          if retcode==0:
-           retcode=zip_proc.poll()
+           retcode=zip_proc.wait()
      else:
          if out_bam:
-             retcode = subprocess.call(prep_cmd, stderr=filter_log)
+             retcode = tracked_call(prep_cmd, pipeline="prep_reads " + sides[ri], stderr=filter_log)
          else:
-             retcode = subprocess.call(prep_cmd, stdout=um_reads,
+             retcode = tracked_call(prep_cmd, pipeline="prep_reads " + sides[ri], stdout=um_reads,
                               stderr=filter_log)
      if retcode:
          die(fail_str+"Error running 'prep_reads'\n"+log_tail(log_fname))
@@ -3422,6 +5593,339 @@ def get_preflt_data(params, ri, target_reads, out_mappings, out_unmapped):
  return (out_mappings, out_unmapped)
 
 
+# returns the number of segments in a file written by split_reads() with
+# --multiplex-segments, or 0 for a regular (single segment) file
+def segmux_count(fname):
+    r = re.search(r'\.segmux(\d+)\.f[aq]', os.path.basename(fname))
+    if r:
+        return int(r.group(1))
+    return 0
+
+# Maps a list of read segment files with Bowtie, one bowtie run per segment
+# file. With --parallel-segments the runs are executed concurrently by a
+# TokenScheduler, each job holding CPU tokens for its bowtie threads plus its
+# helper processes (fix_map_ordering and the decompressor, if any).
+#--> returns a list of (seg_map, unmapped_seg) tuples, one for each segment
+def map_segments(params,
+                 bwt_idx_prefix,
+                 sam_header_filename,
+                 segs,
+                 out_suffix,
+                 keep_unmapped,
+                 mapping_type):
+    if len(segs) == 1 and segmux_count(segs[0]):
+        # a single bowtie run maps all the segments and its hits are
+        # demultiplexed into the same files the per-segment runs would write
+        mux_seg = segs[0]
+        fbasename = getFileBaseName(mux_seg)
+        seg_prefix = tmp_dir + fbasename[:fbasename.rfind(".segmux")]
+        seg_demux = []
+        for i in range(segmux_count(mux_seg)):
+            seg_out = seg_prefix + ("_seg%d" % (i+1))
+            unmapped_seg = None
+            if keep_unmapped:
+                unmapped_seg = seg_out + "_unmapped"
+            seg_demux.append((seg_out + out_suffix, unmapped_seg))
+        return bowtie(params,
+                      bwt_idx_prefix,
+                      sam_header_filename,
+                      [mux_seg],
+                      params.segment_mismatches,
+                      params.segment_mismatches,
+                      params.segment_mismatches,
+                      params.segment_mismatches,
+                      tmp_dir + fbasename + out_suffix,
+                      None,
+                      "(multiplexed)",
+                      mapping_type,
+                      None,
+                      None,
+                      seg_demux)
+
+    jobs = []
+    for i in range(len(segs)):
+        seg = segs[i]
+        fbasename = getFileBaseName(seg)
+        seg_out = tmp_dir + fbasename + out_suffix
+        unmapped_seg = None
+        if keep_unmapped:
+            unmapped_seg = tmp_dir + fbasename + "_unmapped"
+        extra_output = "(%d/%d)" % (i+1, len(segs))
+        jobs.append([params,
+                     bwt_idx_prefix,
+                     sam_header_filename,
+                     [seg],
+                     params.segment_mismatches,
+                     params.segment_mismatches,
+                     params.segment_mismatches,
+                     params.segment_mismatches,
+                     seg_out,
+                     unmapped_seg,
+                     extra_output,
+                     mapping_type])
+
+    num_tokens = params.system_params.num_threads
+    num_helpers = 1 # fix_map_ordering
+    if len(segs) > 0 and (segs[0].endswith(".z") or segs[0].endswith(".bam")):
+        num_helpers += 1
+    num_parallel = min(len(segs), num_tokens / (num_helpers + 1))
+    if not params.system_params.parallel_segments or num_parallel < 2 or \
+           resumeStage > currentStage:
+        return [bowtie(*job) for job in jobs]
+
+    bwt_threads = max(1, num_tokens / num_parallel - num_helpers)
+    th_log("Running %d segment mapping jobs, up to %d at a time (%d bowtie threads each)" %
+           (len(jobs), num_parallel, bwt_threads))
+    scheduler = TokenScheduler(num_tokens)
+    for job in jobs:
+        job += [None, bwt_threads] # multihits_out, num_threads
+        scheduler.add(bwt_threads + num_helpers, bowtie, *job)
+    return scheduler.run()
+
+# split_reads() blocks in opening a FIFO of stream_segments() until the worker
+# at the other end opens it too, forever if that worker has died. The process
+# forked here opens the FIFO of a worker that has exited in its place, until
+# it is terminated; split_reads() then sees an empty or a broken pipe:
+# - the FIFO of a reader (a segment run, flags os.O_RDONLY) is held open until
+#   split_reads() has opened it and written into it or closed it
+# - the FIFO of the writer (the initial run, os.O_WRONLY) is opened and closed
+#   as soon as split_reads() is reading it, which is the only time it needs
+#   to be polled for
+# The FIFOs of the workers that exit normally are done with by then.
+#--> returns the pid of the watching process
+def watch_fifos(workers_fifos):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        running = dict([(job.fileno(), (fifo, flags)) for (job, fifo, flags) in workers_fifos])
+        held = [] # FIFOs opened in place of their reader
+        no_reader = [] # FIFOs to open in place of their writer
+        while running or held or no_reader:
+            timeout = None
+            if no_reader:
+                timeout = 0.2
+            # a worker's pipe becomes readable only when it is done
+            ready, w, x = select.select(running.keys() + held, [], [], timeout)
+            for fd in ready:
+                if fd in running:
+                    fifo, flags = running.pop(fd)
+                    if flags == os.O_RDONLY:
+                        held.append(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                    else:
+                        no_reader.append(fifo)
+                else:
+                    # written into or closed by split_reads()
+                    held.remove(fd)
+                    os.close(fd)
+            for fifo in no_reader[:]:
+                try:
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                    no_reader.remove(fifo)
+                except OSError:
+                    pass # split_reads() has not got to it yet (ENXIO)
+    finally:
+        os._exit(0)
+
+# --stream-segments: the initial Bowtie mapping of one side, the splitting of
+# its IUM reads and the mapping of the segments all run at the same time,
+# connected by named pipes. The IUM reads are never written to disk; the
+# segment files still are (later stages need them), but each segment's Bowtie
+# run maps its segments while split_reads() is writing them.
+# The initial mapping gets half of the threads, split_reads() and the segment
+# runs (which only see the IUM reads) share the other half.
+#--> returns (unspliced_sam, unmapped_reads, read_segments, seg_results)
+def stream_segments(params,
+                    reads,
+                    bwt_idx_prefix,
+                    sam_header_filename,
+                    num_segs,
+                    segment_len,
+                    unspliced_out,
+                    unmapped_unspliced):
+    fbasename = getFileBaseName(reads)
+    seg_prefix = tmp_dir + fbasename
+    ium_fifo = unmapped_unspliced + ".bam"
+    seg_fifos = [seg_prefix + ("_seg%d.fifo" % (i+1)) for i in range(num_segs)]
+    for fifo in [ium_fifo] + seg_fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        try:
+            os.mkfifo(fifo)
+        except OSError, o:
+            die(fail_str+"Error at mkfifo("+fifo+'). '+str(o))
+
+    th_log("Streaming the IUM reads of %s into %d segment mappings" % (fbasename, num_segs))
+    num_threads = params.system_params.num_threads
+    initial_threads = max(1, num_threads / 2)
+    stream_threads = split_threads(max(1, num_threads - initial_threads), num_segs + 1)
+    split_procs = stream_threads[0]
+    seg_threads = stream_threads[1:]
+    initial_job = ForkedCall(bowtie, params, bwt_idx_prefix, sam_header_filename,
+                             [reads],
+                             params.read_mismatches,
+                             params.read_gap_length,
+                             params.read_edit_dist,
+                             params.read_realign_edit_dist,
+                             unspliced_out,
+                             unmapped_unspliced,
+                             "",
+                             _reads_vs_G,
+                             None,
+                             initial_threads)
+    seg_jobs = []
+    for i in range(num_segs):
+        seg_out = seg_prefix + ("_seg%d" % (i+1))
+        seg_jobs.append(ForkedCall(bowtie, params, bwt_idx_prefix, sam_header_filename,
+                                   [seg_fifos[i]],
+                                   params.segment_mismatches,
+                                   params.segment_mismatches,
+                                   params.segment_mismatches,
+                                   params.segment_mismatches,
+                                   seg_out,
+                                   seg_out + "_unmapped",
+                                   "(%d/%d, streamed)" % (i+1, num_segs),
+                                   _segs_vs_G,
+                                   None,
+                                   seg_threads[i]))
+    watch_pid = watch_fifos([(initial_job, ium_fifo, os.O_WRONLY)] +
+                            [(seg_jobs[i], seg_fifos[i], os.O_RDONLY) for i in range(num_segs)])
+    streamed = False
+    try:
+        try:
+            read_segments = split_reads(ium_fifo, seg_prefix, False, params,
+                                        segment_len, seg_fifos, split_procs)
+        except IOError, e:
+            die(fail_str+"Error streaming the segments of "+fbasename+": "+str(e))
+        finally:
+            os.kill(watch_pid, signal.SIGTERM)
+            os.waitpid(watch_pid, 0)
+        (unspliced_sam, unmapped_reads) = initial_job.result()
+        seg_results = [job.result() for job in seg_jobs]
+        streamed = True
+    finally:
+        if not streamed:
+            # the segment runs may still be waiting for their input
+            for job in [initial_job] + seg_jobs:
+                if job in live_workers:
+                    job.terminate()
+        for fifo in [ium_fifo] + seg_fifos:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+
+    # no read was long enough for the last segment runs
+    for (seg_map, unmapped_seg) in seg_results[len(read_segments):]:
+        removeFileWithIndex(seg_map)
+        removeFileWithIndex(unmapped_seg)
+    seg_results = seg_results[:len(read_segments)]
+    if len(read_segments) > num_segs:
+        seg_results += map_segments(params,
+                                    bwt_idx_prefix,
+                                    sam_header_filename,
+                                    read_segments[num_segs:],
+                                    "",
+                                    True,
+                                    _segs_vs_G)
+    if not read_segments:
+        # no IUM reads, leave an empty BAM file in their place
+        bam_cmd = [samtools_path, "view", "-bS", "-o", unmapped_reads, sam_header_filename]
+        print >> run_log, " ".join(bam_cmd)
+        ret = tracked_call(bam_cmd, stderr=tophat_log)
+        if ret != 0:
+            die(fail_str+"Error executing: "+" ".join(bam_cmd))
+    return (unspliced_sam, unmapped_reads, read_segments, seg_results)
+
+# Maps one side (left or right) of the prepared reads: the initial Bowtie
+# mapping of the full length reads, then the splitting of the IUM reads into
+# segments which are mapped independently to the genome.
+# When num_threads is given it overrides -p for this side (this is used when
+# both sides are processed concurrently by --parallel-mates).
+#--> returns a tuple (Maps, have_IUM)
+def map_read_side(params,
+                  ri,
+                  reads,
+                  bwt_idx_prefix,
+                  sam_header_filename,
+                  num_segs,
+                  segment_len,
+                  num_threads=None):
+    if num_threads:
+        params.system_params.num_threads = num_threads
+    fbasename=getFileBaseName(reads)
+    unspliced_out = tmp_dir + fbasename + ".mapped"
+    unspliced_sam = None
+    unmapped_reads = None
+    #if use_zpacker: unspliced_out+=".z"
+    unmapped_unspliced = tmp_dir + fbasename + "_unmapped"
+    seg_results = None
+    if params.system_params.stream_segments and num_segs > 1 and \
+           not params.prefilter_multi and not params.multiplex_segments and \
+           not params.read_params.color and resumeStage <= currentStage:
+      (unspliced_sam, unmapped_reads, read_segments, seg_results) = \
+          stream_segments(params, reads, bwt_idx_prefix, sam_header_filename,
+                          num_segs, segment_len, unspliced_out, unmapped_unspliced)
+    elif params.prefilter_multi:
+      #unmapped_unspliced += ".z"
+      (unspliced_sam, unmapped_reads) = get_preflt_data(params, ri, reads, unspliced_out, unmapped_unspliced)
+    else:
+    # Perform the initial Bowtie mapping of the full length reads
+      (unspliced_sam, unmapped_reads) = bowtie(params,
+                                               bwt_idx_prefix,
+                                               sam_header_filename,
+                                               [reads],
+                                               params.read_mismatches,
+                                               params.read_gap_length,
+                                               params.read_edit_dist,
+                                               params.read_realign_edit_dist,
+                                               unspliced_out,
+                                               unmapped_unspliced,
+                                               "",
+                                               _reads_vs_G)
+
+    seg_maps = []
+    unmapped_segs = []
+    segs = []
+
+    if seg_results is not None:
+        have_IUM = len(read_segments) > 0
+    else:
+        have_IUM = nonzeroFile(unmapped_reads)
+        if not have_IUM and resumeStage > currentStage and \
+               unmapped_reads and not os.path.exists(unmapped_reads):
+            # the IUM reads of a --stream-segments run only exist as segments
+            have_IUM = len(glob.glob(tmp_dir + fbasename + "_seg*")) > 0
+    setRunStage(_stage_map_segments)
+    if num_segs > 1 and have_IUM:
+        if seg_results is None:
+            # split up the IUM reads into segments
+            # unmapped_reads can be in BAM format
+            read_segments = split_reads(unmapped_reads,
+                                        tmp_dir + fbasename,
+                                        False,
+                                        params,
+                                        segment_len)
+
+            # Map each segment file independently with Bowtie
+            seg_results = map_segments(params,
+                                       bwt_idx_prefix,
+                                       sam_header_filename,
+                                       read_segments,
+                                       "",
+                                       True,
+                                       _segs_vs_G)
+        for (seg_map, unmapped) in seg_results:
+            seg_maps.append(seg_map)
+            unmapped_segs.append(unmapped)
+        segs = read_segments
+
+        # Collect the segment maps for left and right reads together
+        return (Maps(unspliced_sam, seg_maps, unmapped_segs, segs), have_IUM)
+    # if there's only one segment, just collect the initial map as the only
+    # map to be used downstream for coverage-based junction discovery
+    return (Maps(unspliced_sam, [unspliced_sam], [unmapped_reads], [unmapped_reads]), have_IUM)
+
 # The main aligment routine of TopHat.  This function executes most of the
 # workflow producing a set of candidate alignments for each cDNA fragment in a
 # pair of SAM alignment files (for paired end reads).
@@ -3434,7 +5938,8 @@ def spliced_alignment(params,
                       prepared_reads,
                       user_supplied_junctions,
                       user_supplied_insertions,
-                      user_supplied_deletions):
+                      user_supplied_deletions,
+                      transcriptome_built=None):
 
     possible_juncs = []
     possible_juncs.extend(user_supplied_junctions)
@@ -3455,7 +5960,8 @@ def spliced_alignment(params,
 
     if params.gff_annotation:
         (mapped_gtf_list, unmapped_gtf_list) = \
-            map2gtf(params, sam_header_filename, ref_fasta, left_reads, right_reads)
+            map2gtf(params, sam_header_filename, ref_fasta, left_reads, right_reads,
+                    transcriptome_built)
 
         m2g_left_maps, m2g_right_maps = mapped_gtf_list
         m2g_maps = [m2g_left_maps, m2g_right_maps]
@@ -3516,83 +6022,34 @@ def spliced_alignment(params,
 
     # Perform the first part of the TopHat work flow on the left and right
     # reads of paired ends separately - we'll use the pairing information later
-    have_left_IUM = False
+    sides = []
     for ri in (0,1):
         reads=initial_reads[ri]
         if reads == None or not nonzeroFile(reads):
             continue
+        sides.append(ri)
 
-        fbasename=getFileBaseName(reads)
-        unspliced_out = tmp_dir + fbasename + ".mapped"
-        unspliced_sam = None
-        unmapped_reads = None
-        #if use_zpacker: unspliced_out+=".z"
-        unmapped_unspliced = tmp_dir + fbasename + "_unmapped"
-        if params.prefilter_multi:
-          #unmapped_unspliced += ".z"
-          (unspliced_sam, unmapped_reads) = get_preflt_data(params, ri, reads, unspliced_out, unmapped_unspliced)
-        else:
-        # Perform the initial Bowtie mapping of the full length reads
-          (unspliced_sam, unmapped_reads) = bowtie(params,
-                                                   bwt_idx_prefix,
-                                                   sam_header_filename,
-                                                   [reads],
-                                                   params.read_mismatches,
-                                                   params.read_gap_length,
-                                                   params.read_edit_dist,
-                                                   params.read_realign_edit_dist,
-                                                   unspliced_out,
-                                                   unmapped_unspliced,
-                                                   "",
-                                                   _reads_vs_G)
-
-        seg_maps = []
-        unmapped_segs = []
-        segs = []
-
-        have_IUM = nonzeroFile(unmapped_reads)
-        if ri==0 and have_IUM:
-           have_left_IUM = True
+    have_IUM = [False, False]
+    if params.system_params.parallel_mates and len(sides) > 1:
+        side_threads = split_threads(params.system_params.num_threads, len(sides))
+        if currentStage >= resumeStage:
+            th_log("Mapping left and right reads concurrently (%s threads)" %
+                   "+".join([str(n) for n in side_threads]))
+        workers = []
+        for i in range(len(sides)):
+            ri = sides[i]
+            workers.append(ForkedCall(map_read_side, params, ri, initial_reads[ri],
+                                      bwt_idx_prefix, sam_header_filename,
+                                      num_segs, segment_len, side_threads[i]))
+        for i in range(len(sides)):
+            maps[sides[i]], have_IUM[sides[i]] = workers[i].result()
         setRunStage(_stage_map_segments)
-        if num_segs > 1 and have_IUM:
-            # split up the IUM reads into segments
-            # unmapped_reads can be in BAM format
-            read_segments = split_reads(unmapped_reads,
-                                        tmp_dir + fbasename,
-                                        False,
-                                        params,
-                                        segment_len)
-
-            # Map each segment file independently with Bowtie
-            for i in range(len(read_segments)):
-                seg = read_segments[i]
-                fbasename=getFileBaseName(seg)
-                seg_out =  tmp_dir + fbasename
-                unmapped_seg = tmp_dir + fbasename + "_unmapped"
-                extra_output = "(%d/%d)" % (i+1, len(read_segments))
-                (seg_map, unmapped) = bowtie(params,
-                                             bwt_idx_prefix,
-                                             sam_header_filename,
-                                             [seg],
-                                             params.segment_mismatches,
-                                             params.segment_mismatches,
-                                             params.segment_mismatches,
-                                             params.segment_mismatches,
-                                             seg_out,
-                                             unmapped_seg,
-                                             extra_output,
-                                             _segs_vs_G)
-                seg_maps.append(seg_map)
-                unmapped_segs.append(unmapped)
-                segs.append(seg)
-
-            # Collect the segment maps for left and right reads together
-            maps[ri] = Maps(unspliced_sam, seg_maps, unmapped_segs, segs)
-        else:
-            # if there's only one segment, just collect the initial map as the only
-            # map to be used downstream for coverage-based junction discovery
-            read_segments = [reads]
-            maps[ri] = Maps(unspliced_sam, [unspliced_sam], [unmapped_reads], [unmapped_reads])
+    else:
+        for ri in sides:
+            maps[ri], have_IUM[ri] = map_read_side(params, ri, initial_reads[ri],
+                                                   bwt_idx_prefix, sam_header_filename,
+                                                   num_segs, segment_len)
+    have_left_IUM = have_IUM[0]
 
     # XXX: At this point if using M2G, have three sets of reads:
     # mapped to transcriptome, mapped to genome, and unmapped (potentially
@@ -3692,7 +6149,8 @@ def spliced_alignment(params,
                                           possible_deletions,
                                           possible_fusions,
                                           ref_fasta,
-                                          params.read_params.color)
+                                          params.read_params.color,
+                                          params.system_params.num_threads)
         juncs_bwt_samheader = get_index_sam_header(params, juncs_bwt_idx)
 
     # Now map read segments (or whole IUM reads, if num_segs == 1) to the splice
@@ -3720,26 +6178,16 @@ def spliced_alignment(params,
 
         if have_IUM:
             if junc_idx_prefix:
-                i = 0
-                for seg in maps[ri].segs:
-                    #search each segment
-                    fsegname = getFileBaseName(seg)
-                    seg_out = tmp_dir + fsegname + ".to_spliced"
-                    extra_output = "(%d/%d)" % (i+1, len(maps[ri].segs))
-                    (seg_map, unmapped) = bowtie(params,
-                                                 tmp_dir + junc_idx_prefix,
-                                                 juncs_bwt_samheader,
-                                                 [seg],
-                                                 params.segment_mismatches,
-                                                 params.segment_mismatches,
-                                                 params.segment_mismatches,
-                                                 params.segment_mismatches,
-                                                 seg_out,
-                                                 None,
-                                                 extra_output,
-                                                 _segs_vs_J)
+                #search each segment
+                seg_results = map_segments(params,
+                                           juncs_bwt_idx,
+                                           juncs_bwt_samheader,
+                                           maps[ri].segs,
+                                           ".to_spliced",
+                                           False,
+                                           _segs_vs_J)
+                for (seg_map, unmapped) in seg_results:
                     spliced_seg_maps.append(seg_map)
-                    i += 1
 
                 # Join the contigous and spliced segment hits into full length
                 #   read alignments
@@ -3835,7 +6283,10 @@ def validate_transcriptome(params):
      inf.close()
      dlst = fline.split()
      if len(dlst)>2:
-         tver, tgff_size, tfa_size = map(lambda f: int(f), dlst)
+         tver, tgff_size, tfa_size = map(lambda f: int(f), dlst[:3])
+     # files written by older versions have no content key
+     if len(dlst)>3 and params.transcriptome_key and dlst[3]!=params.transcriptome_key:
+         return False
    else:
      return False
    tlst=tfa+".tlst"
@@ -3860,6 +6311,11 @@ def main(argv=None):
             run_argv=doResume(params.resume_dir)
             args = params.parse_options(run_argv)
         params.check()
+        if params.report_params.output_stream == "-":
+            # only the alignments go to stdout, anything else printed by
+            # TopHat or the programs it runs goes to stderr
+            params.report_params.stdout_fd = os.dup(1)
+            os.dup2(2, 1)
 
         bwt_idx_prefix = args[0]
         left_reads_list = None
@@ -3901,6 +6357,8 @@ def main(argv=None):
         run_cmd = " ".join(run_argv)
         print >> run_log, run_cmd
 
+        set_tmp_compression(params, [left_reads_list, right_reads_list])
+
         check_bowtie(params)
         check_samtools()
 
@@ -3911,6 +6369,12 @@ def main(argv=None):
              die("Error: cannot find transcript file %s" % params.gff_annotation)
            if os.path.getsize(params.gff_annotation)<10:
              die("Error: invalid transcript file %s" % params.gff_annotation)
+           params.transcriptome_key = transcriptome_key(params, bwt_idx_prefix)
+           if cache_dir and not params.transcriptome_index and not params.transcriptome_buildonly:
+             # keep the transcriptome data in the cache, for other runs with
+             # the same annotation and genome
+             params.transcriptome_index = cache_dir + "transcriptome/" + params.transcriptome_key[:16] + "/" + \
+                                          getFileBaseName(params.gff_annotation)
 
         if params.transcriptome_index:
            if params.gff_annotation:
@@ -3933,9 +6397,17 @@ def main(argv=None):
            if params.transcriptome_outdir:
               #will create the transcriptome data files
               if not os.path.exists(params.transcriptome_outdir):
-                os.makedirs(params.transcriptome_outdir)
-              if params.gff_annotation:
-                   copy(params.gff_annotation, t_gff)
+                try:
+                  os.makedirs(params.transcriptome_outdir)
+                except OSError:
+                  # another run may have just created it
+                  if not os.path.isdir(params.transcriptome_outdir):
+                    raise
+              if params.gff_annotation and os.path.abspath(params.gff_annotation) != os.path.abspath(t_gff):
+                   # copied under a temporary name, concurrent runs may be reading t_gff
+                   tmp_gff = "%s.%d.tmp" % (t_gff, os.getpid())
+                   copy(params.gff_annotation, tmp_gff)
+                   os.rename(tmp_gff, t_gff)
            else:
               #try to use existing transcriptome data files
               #if validate_transcriptome(params):
@@ -3944,6 +6416,11 @@ def main(argv=None):
            #end @ transcriptome_index given
 
         (ref_fasta, ref_seq_dict) = check_index(bwt_idx_prefix, params.bowtie2)
+        if params.system_params.bowtie_mm and not params.transcriptome_buildonly and \
+               resumeStage < _stage_tophat_reports:
+            preload_bowtie_index(bwt_idx_prefix, params.bowtie2)
+            if params.transcriptome_index and not params.transcriptome_outdir:
+                preload_bowtie_index(params.transcriptome_index, params.bowtie2)
         if params.transcriptome_buildonly:
              map2gtf(params, "", ref_fasta, [], [])
              th_logp("-----------------------------------------------")
@@ -4030,14 +6507,30 @@ def main(argv=None):
         else:
              th_log("Prepared reads:")
         multihit_reads = []
+        transcriptome_built = None
         if params.preflt_data[0].multihit_reads:
            multihit_reads += [params.preflt_data[0].multihit_reads]
         if params.preflt_data[1].multihit_reads:
            multihit_reads += [params.preflt_data[1].multihit_reads]
-        prep_info= prep_reads(params,
-                         left_reads_list, left_quals_list,
-                         right_reads_list, right_quals_list,
-                         multihit_reads)
+        if params.gff_annotation and resumeStage <= _stage_map_start and \
+               not (params.transcriptome_index and not params.transcriptome_outdir):
+            # the transcriptome does not depend on the reads, so it is
+            # built while the reads are being prepared
+            prep_tasks = TaskGraph(params.system_params.num_threads)
+            prep_tasks.add_task(1, [], [], prep_reads, params,
+                                left_reads_list, left_quals_list,
+                                right_reads_list, right_quals_list,
+                                multihit_reads, 1)
+            # prep_reads keeps one thread, the index build gets the rest
+            build_threads = max(1, params.system_params.num_threads - 1)
+            prep_tasks.add_task(build_threads, [params.gff_annotation, ref_fasta], [],
+                                build_transcriptome, params, ref_fasta, build_threads)
+            prep_info, transcriptome_built = prep_tasks.run()
+        else:
+            prep_info= prep_reads(params,
+                             left_reads_list, left_quals_list,
+                             right_reads_list, right_quals_list,
+                             multihit_reads)
         if currentStage < resumeStage and not fileExists(prep_info.kept_reads[0],40):
              die("Error: prepared reads file missing, cannot resume!")
 
@@ -4070,7 +6563,8 @@ def main(argv=None):
                               input_reads,
                               user_supplied_juncs,
                               user_supplied_insertions,
-                              user_supplied_deletions)
+                              user_supplied_deletions,
+                              transcriptome_built)
         setRunStage(_stage_tophat_reports)
 
         compile_reports(params,
@@ -4094,6 +6588,9 @@ def main(argv=None):
 
 
         th_logp("-----------------------------------------------")
+        report_index_preload()
+        report_resources()
+        write_timeline()
         th_log("A summary of the alignment counts can be found in %salign_summary.txt" % output_dir)
         th_log("Run complete: %s elapsed" %  formatTD(duration))
 
@@ -4101,6 +6598,10 @@ def main(argv=None):
         th_logp(sys.argv[0].split("/")[-1] + ": " + str(err.msg))
         th_logp("    for detailed help see http://ccb.jhu.edu/software/tophat/manual.shtml")
         return 2
+    except KeyboardInterrupt:
+        # the workers are not in the terminal's process group
+        terminate_workers()
+        raise
 
 
 if __name__ == "__main__":
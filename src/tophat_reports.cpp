@@ -3029,6 +3029,8 @@ int main(int argc, char** argv)
   int parse_ret = parse_options(argc, argv, print_usage);
   if (parse_ret)
     return parse_ret;
+  // the unmapped reads parts written here can become the final unmapped.bam
+  bam_compression_level = -1;
   
   if(optind >= argc)
     {
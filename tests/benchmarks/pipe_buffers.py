@@ -0,0 +1,106 @@
+"""
+pipe_buffers.py
+
+Measures the throughput of the pipes to and from TopHat's helper programs,
+with Python 2's default unbuffered pipes (bufsize=0, 64 KB kernel pipes)
+against the I/O layer of tophat.py (TrackedPopen: PIPE_BUFSIZE buffers and
+PIPE_CAPACITY kernel pipes, see enlarge_pipe()).
+
+The write test prints FASTQ records line by line into "cat > /dev/null", as
+the segment writers do; the read test iterates over the lines of FASTQ data
+coming out of "cat", as the readers of the decompression pipes do, and the
+readline test reads them with readline() calls (one read() per byte on an
+unbuffered pipe, so it only reads a tenth of the records).
+
+usage: python pipe_buffers.py <path to tophat.py> [num_records]
+
+e.g.,
+
+python pipe_buffers.py ../../src/tophat.py 500000
+"""
+
+import sys
+import os
+import imp
+import time
+import fcntl
+import tempfile
+import subprocess
+
+def fastq_records(num_records):
+    seq = "ACGTTGCAAGGCTTAACCGGATCGATCGGCTAGCTAGGCTAACGTTAGCCGATCGAGCTAGCCGATCGATCGAT"
+    qual = "I" * len(seq)
+    for i in xrange(num_records):
+        yield ("@read%d/1" % i, seq, "+", qual)
+
+def pipe_capacity(pipe_file):
+    try:
+        return fcntl.fcntl(pipe_file.fileno(), 1032) # F_GETPIPE_SZ
+    except IOError:
+        return None
+
+def time_write(popen, num_records):
+    start = time.time()
+    proc = popen(["cat"], stdin=subprocess.PIPE, stdout=open(os.devnull, "w"))
+    capacity = pipe_capacity(proc.stdin)
+    for rec in fastq_records(num_records):
+        for line in rec:
+            print >> proc.stdin, line
+    proc.stdin.close()
+    proc.wait()
+    return time.time() - start, capacity
+
+def time_read(popen, fastq_file):
+    start = time.time()
+    proc = popen(["cat", fastq_file], stdout=subprocess.PIPE)
+    capacity = pipe_capacity(proc.stdout)
+    num_lines = 0
+    for line in proc.stdout:
+        num_lines += 1
+    proc.wait()
+    return time.time() - start, capacity
+
+def time_readline(popen, fastq_file, num_lines):
+    start = time.time()
+    # cat is stopped by a broken pipe
+    proc = popen(["cat", fastq_file], stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+    for i in xrange(num_lines):
+        proc.stdout.readline()
+    proc.stdout.close()
+    proc.wait()
+    return time.time() - start
+
+def best_of(runs, func, *args):
+    return min([func(*args) for i in range(runs)])
+
+def main(argv):
+    if len(argv) < 2:
+        print >> sys.stderr, __doc__
+        return 1
+    tophat = imp.load_source("tophat", argv[1])
+    num_records = 500000
+    if len(argv) > 2:
+        num_records = int(argv[2])
+
+    fd, fastq_file = tempfile.mkstemp(suffix=".fq")
+    fastq = os.fdopen(fd, "w")
+    for rec in fastq_records(num_records):
+        fastq.write("\n".join(rec) + "\n")
+    fastq.close()
+
+    def unbuffered(*args, **kwargs):
+        return subprocess.Popen(*args, **kwargs)
+    try:
+        print "%d FASTQ records (%d lines), best of 3" % (num_records, 4 * num_records)
+        for name, popen in (("bufsize=0", unbuffered), ("TrackedPopen", tophat.TrackedPopen)):
+            write_time, write_capacity = best_of(3, time_write, popen, num_records)
+            read_time, read_capacity = best_of(3, time_read, popen, fastq_file)
+            readline_time = best_of(3, time_readline, popen, fastq_file, 4 * num_records / 10)
+            print "%-14s write %6.2fs  read %6.2fs  readline %6.2fs  (kernel pipe: %s bytes)" % \
+                  (name, write_time, read_time, readline_time, write_capacity or "?")
+    finally:
+        os.remove(fastq_file)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,148 @@
+"""
+test_bam_reads.py
+
+Checks that split_reads() decodes the unmapped reads BAM file (through
+bam_record_blocks() and decode_bam_records()) into the same reads as
+"bam2fastx --all". The BAM files are written by samtools from SAM records
+covering mates, secondary alignments, reverse strand reads with IUPAC
+codes, OQ tags among other tags and QC failed reads.
+
+bam2fastx and samtools (or samtools_0.1.18) must be in the PATH, the tests
+are skipped otherwise.
+
+usage: python test_bam_reads.py [path to tophat.py]
+"""
+
+import unittest
+import sys
+import os
+import imp
+import random
+import shutil
+import tempfile
+import subprocess
+import zlib
+
+tophat_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "tophat.py")
+tophat = None
+
+def setUpModule():
+    global tophat
+    tophat = imp.load_source("tophat", tophat_path)
+
+def find_program(names):
+    for name in names:
+        for dirname in os.environ.get("PATH", "").split(os.pathsep):
+            path = os.path.join(dirname, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+SAM_HEADER = "@HD\tVN:1.0\tSO:queryname\n@SQ\tSN:chr1\tLN:100000\n"
+
+# flag, sequence, qualities and tags of the records of a few read names
+SAM_CASES = [
+    ("pair", [(77, "ACGTN", "IIII#", ""), (141, "ACGTT", "*", "")]),
+    ("rev_iupac", [(16, "ACMSWNRYKVHDB", "ABCDEFGHIJKLM", "XA:i:3\tXB:B:c,1,2\tXH:H:1AE3\tOQ:Z:MLKJIHGFEDCBA")]),
+    ("no_seq", [(4, "*", "*", "")]),
+    ("qc_failed", [(516, "ACGT", "IIII", ""), (4, "ACGA", "IIII", "")]),
+    ("secondary", [(67, "ACGTA", "IIIII", "OQ:Z:#####"), (323, "ACGTA", "IIIII", ""),
+                   (147, "TTGCA", "IIIII", "XS:A:+\tXF:f:1.5"), (403, "TTGCA", "IIIII", "")]),
+    ("unpaired_twice", [(0, "GGGAC", "IIIII", ""), (256, "GGGAC", "IIIII", "")]),
+    ("mate2_only", [(133, "CAGT", "!!!!", "")]),
+]
+
+def sam_line(name, flag, seq, qual, tags):
+    if flag & 4:
+        fields = [name, str(flag), "*", "0", "0", "*", "*", "0", "0", seq, qual]
+    else:
+        cigar = seq == "*" and "*" or "%dM" % len(seq)
+        fields = [name, str(flag), "chr1", "100", "255", cigar, "*", "0", "0", seq, qual]
+    if tags:
+        fields.append(tags)
+    return "\t".join(fields) + "\n"
+
+def random_sam_records(rng, num_reads):
+    lines = []
+    for i in range(num_reads):
+        name = "read%05d" % i
+        if rng.random() < 0.5:
+            flags = [rng.choice([77, 73, 89, 83, 99]), rng.choice([141, 137, 153, 147, 163])]
+        else:
+            flags = [rng.choice([0, 4, 16, 512])]
+        if rng.random() < 0.2:
+            flags.insert(1, flags[0] | 256)
+        for flag in flags:
+            length = rng.randint(1, 120)
+            seq = "".join([rng.choice("ACGTACGTACGTN") for j in range(length)])
+            qual = "".join([chr(rng.randint(33, 73)) for j in range(length)])
+            tags = "NM:i:%d" % rng.randint(0, 3)
+            if rng.random() < 0.3:
+                tags += "\tOQ:Z:" + "".join([chr(rng.randint(33, 73)) for j in range(length)])
+            lines.append(sam_line(name, flag, seq, qual, tags))
+    return lines
+
+class TestBamReads(unittest.TestCase):
+    def setUp(self):
+        self.bam2fastx = find_program(["bam2fastx"])
+        self.samtools = find_program(["samtools_0.1.18", "samtools"])
+        if not self.bam2fastx or not self.samtools:
+            self.skipTest("bam2fastx and samtools are needed")
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_bam(self, lines):
+        sam_fname = os.path.join(self.work_dir, "reads.sam")
+        bam_fname = os.path.join(self.work_dir, "reads.bam")
+        sam_file = open(sam_fname, "w")
+        sam_file.write(SAM_HEADER + "".join(lines))
+        sam_file.close()
+        subprocess.check_call([self.samtools, "view", "-bS", "-o", bam_fname, sam_fname],
+                              stderr=open(os.devnull, "w"))
+        return bam_fname
+
+    def check_reads(self, bam_fname, block_size):
+        expected = subprocess.Popen([self.bam2fastx, "--all", bam_fname],
+                                    stdout=subprocess.PIPE).communicate()[0]
+        bam_file = open(bam_fname, "rb")
+        decoded = []
+        for block in tophat.bam_record_blocks(bam_file, block_size):
+            decoded += tophat.decode_bam_records(block)
+        bam_file.close()
+        self.assertTrue(decoded)
+        self.assertEqual("".join([l + "\n" for l in decoded]), expected)
+
+    def test_cases(self):
+        lines = []
+        for (name, recs) in SAM_CASES:
+            lines += [sam_line(name, flag, seq, qual, tags) for (flag, seq, qual, tags) in recs]
+        bam_fname = self.write_bam(lines)
+        for block_size in (1, 100, 1024 * 1024):
+            self.check_reads(bam_fname, block_size)
+
+    def test_random_reads(self):
+        rng = random.Random(16)
+        bam_fname = self.write_bam(random_sam_records(rng, 3000))
+        # blocks of a few BGZF blocks, and a single block for the whole file
+        for block_size in (20000, 64 * 1024 * 1024):
+            self.check_reads(bam_fname, block_size)
+
+    def test_truncated(self):
+        rng = random.Random(17)
+        bam_fname = self.write_bam(random_sam_records(rng, 500))
+        data = open(bam_fname, "rb").read()
+        trunc_fname = os.path.join(self.work_dir, "truncated.bam")
+        trunc_file = open(trunc_fname, "wb")
+        trunc_file.write(data[:len(data) / 2])
+        trunc_file.close()
+        def decode_all():
+            for block in tophat.bam_record_blocks(open(trunc_fname, "rb")):
+                tophat.decode_bam_records(block)
+        self.assertRaises((ValueError, zlib.error), decode_all)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+        tophat_path = sys.argv.pop(1)
+    unittest.main()
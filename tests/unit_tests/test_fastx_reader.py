@@ -0,0 +1,271 @@
+"""
+test_fastx_reader.py
+
+Checks that the block-buffered FastxReader returns the same records as the
+readline() based reader it replaced (kept below as ReferenceReader), for
+FASTQ and FASTA files with wrapped lines, blank lines, header lines, CRLF
+line ends, no final newline and colorspace reads, read from a regular file
+(mmap) and from a pipe, with large and tiny blocks.
+
+usage: python test_fastx_reader.py [path to tophat.py]
+"""
+
+import unittest
+import sys
+import os
+import imp
+import random
+import shutil
+import tempfile
+import subprocess
+
+tophat_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "tophat.py")
+tophat = None
+
+def setUpModule():
+    global tophat
+    tophat = imp.load_source("tophat", tophat_path)
+
+#
+# The FastxReader of TopHat before the block-buffered one (errors raise
+# ValueError instead of calling die())
+#
+class ReferenceReader:
+  def __init__(self, i_file, is_color=0):
+    self.bufline=None
+    self.ifile=i_file
+    self.eof=None
+    self.lastline=None
+    self.numrecords=0
+    self.isColor=0
+    if is_color : self.isColor=1
+    hlines=10 # allow maximum 10 header lines
+    self.lastline=" "
+    while hlines>0 and self.lastline[0] not in "@>" :
+       self.lastline=self.ifile.readline()
+       hlines-=1
+    if self.lastline[0] == '@':
+      self.nextRecord=self.nextFastq
+    elif self.lastline[0] == '>':
+      self.nextRecord=self.nextFasta
+    else:
+      raise ValueError("cannot determine record type")
+    self.bufline=self.lastline
+    self.lastline=None
+
+  def nextFastq(self):
+    seqid,seqstr,qstr,seq_len='','','',0
+    if self.eof: return (seqid, seqstr, seq_len, qstr)
+    fline=self.getLine
+    line=fline()
+    if not line : return (seqid, seqstr, seq_len, qstr)
+    while len(line.rstrip())==0: # skip empty lines
+      line=fline()
+      if not line : return (seqid, seqstr,seq_len, qstr)
+    if line[0] != "@":
+        raise ValueError("Records in Fastq files should start with '@' character")
+    seqid = line[1:].rstrip()
+    seqstr = fline().rstrip()
+    while True:
+        line = fline()
+        if not line:
+           raise ValueError("Premature end of file (missing quality values for "+seqid+")")
+        if line[0] == "+":
+           break
+        seqstr += line.rstrip()
+    seq_len = len(seqstr)
+    qstrlen=0
+    while True:
+        line=fline()
+        if not line : break #end of file
+        qstr += line.rstrip()
+        qstrlen=len(qstr)
+        if qstrlen + self.isColor >= seq_len :
+             break
+    if self.isColor:
+         if qstrlen==seq_len:
+           qstr = qstr[1:]
+           qstrlen -= 1
+         if qstrlen!=seq_len-1:
+           raise ValueError("Length mismatch between sequence and quality strings")
+    else:
+         if seq_len != qstrlen :
+            raise ValueError("Length mismatch between sequence and quality strings")
+    self.numrecords+=1
+    if self.isColor :
+        seq_len-=1
+        seqstr = seqstr[1:]
+    return (seqid, seqstr, seq_len, qstr)
+
+  def nextFasta(self):
+    seqid,seqstr,seq_len='','',0
+    fline=self.getLine
+    line=fline()
+    if not line : return (seqid, seqstr, seq_len, None)
+    while len(line.rstrip())==0: # skip empty lines
+      line=fline()
+      if not line : return (seqid, seqstr, seq_len, None)
+    if line[0] != ">":
+       raise ValueError("Records in Fasta files must start with '>' character")
+    seqid = line[1:].split()[0]
+    while True:
+       line = fline()
+       if not line: break
+       if line[0] == '>':
+          self.ungetLine()
+          break
+       seqstr += line.rstrip()
+    seq_len = len(seqstr)
+    if seq_len < 3:
+       raise ValueError("Read %s too short (%i)." % (seqid, seq_len))
+    self.numrecords+=1
+    if self.isColor :
+        seq_len-=1
+        seqstr=seqstr[1:]
+    return (seqid, seqstr, seq_len, None)
+
+  def getLine(self):
+      if self.bufline:
+         r=self.bufline
+         self.bufline=None
+         return r
+      else:
+         if self.eof: return None
+         self.lastline=self.ifile.readline()
+         if not self.lastline:
+            self.eof=1
+            return None
+         return self.lastline
+  def ungetLine(self):
+      self.bufline=self.lastline
+      self.lastline=None
+
+def wrap(s, rng):
+    if len(s) < 2 or rng.random() < 0.7:
+        return [s]
+    cut = rng.randint(1, len(s) - 1)
+    return [s[:cut], s[cut:]]
+
+def random_fastq(rng, num_reads, color):
+    lines = []
+    if rng.random() < 0.5:
+        lines.append("# a header line")
+    for i in range(num_reads):
+        length = rng.randint(3, 80)
+        if color:
+            seq = rng.choice("ACGT") + "".join([rng.choice("0123.") for j in range(length)])
+            qlen = length + rng.choice([0, 1]) # with or without the dummy qv
+        else:
+            seq = "".join([rng.choice("ACGTN") for j in range(length)])
+            qlen = length
+        # qualities can start with '@' or '+'
+        qual = "".join([chr(rng.randint(33, 73)) for j in range(qlen)])
+        lines.append("@read%d/%d extra" % (i, rng.randint(1, 2)))
+        lines += wrap(seq, rng)
+        lines.append(rng.choice(["+", "+read%d" % i]))
+        if qlen > length:
+            # a wrapped line would be read as the end of the qualities
+            lines.append(qual)
+        else:
+            lines += wrap(qual, rng)
+        if rng.random() < 0.05:
+            lines.append("")
+    return lines
+
+def random_fasta(rng, num_reads, color):
+    lines = []
+    for i in range(num_reads):
+        length = rng.randint(3, 80)
+        if color:
+            seq = rng.choice("ACGT") + "".join([rng.choice("0123.") for j in range(length)])
+        else:
+            seq = "".join([rng.choice("ACGTN") for j in range(length)])
+        lines.append(">read%d some description" % i)
+        lines += wrap(seq, rng)
+        if rng.random() < 0.05:
+            lines.append("  ")
+    return lines
+
+class TestFastxReader(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.block_size = tophat.FASTX_BLOCK_SIZE
+
+    def tearDown(self):
+        tophat.FASTX_BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.work_dir)
+
+    def write_reads(self, lines, line_end="\n", final_newline=True):
+        fname = os.path.join(self.work_dir, "reads")
+        f = open(fname, "wb")
+        f.write(line_end.join(lines))
+        if final_newline:
+            f.write(line_end)
+        f.close()
+        return fname
+
+    def reference_records(self, fname, color):
+        f = open(fname, "rb")
+        reader = ReferenceReader(f, color)
+        records = []
+        while True:
+            rec = reader.nextRecord()
+            if not rec[0]: break
+            records.append(rec)
+        f.close()
+        return records
+
+    def check_reader(self, fname, color):
+        expected = self.reference_records(fname, color)
+        self.assertTrue(expected)
+        for block_size in (self.block_size, 5):
+            tophat.FASTX_BLOCK_SIZE = block_size
+            # mmap of a regular file
+            f = open(fname, "rb")
+            reader = tophat.FastxReader(f, color, fname)
+            self.assertTrue(reader.mmap is not None)
+            self.assertEqual(list(reader), expected)
+            self.assertEqual(reader.numrecords, len(expected))
+            f.close()
+            # blocks read from a pipe, in batches
+            cat = subprocess.Popen(["cat", fname], stdout=subprocess.PIPE)
+            reader = tophat.FastxReader(cat.stdout, color, fname)
+            self.assertTrue(reader.mmap is None)
+            records = []
+            while True:
+                batch = reader.next_batch(7)
+                if not batch: break
+                self.assertTrue(len(batch) <= 7)
+                records += batch
+            self.assertEqual(records, expected)
+            cat.stdout.close()
+            cat.wait()
+
+    def test_fastq(self):
+        for seed in range(10):
+            rng = random.Random(seed)
+            self.check_reader(self.write_reads(random_fastq(rng, 200, False)), False)
+
+    def test_color_fastq(self):
+        for seed in range(10):
+            rng = random.Random(seed)
+            self.check_reader(self.write_reads(random_fastq(rng, 200, True)), True)
+
+    def test_fasta(self):
+        for seed in range(10):
+            rng = random.Random(seed)
+            self.check_reader(self.write_reads(random_fasta(rng, 200, False)), False)
+            self.check_reader(self.write_reads(random_fasta(rng, 200, True)), True)
+
+    def test_line_ends(self):
+        rng = random.Random(17)
+        lines = random_fastq(rng, 100, False)
+        self.check_reader(self.write_reads(lines, "\r\n"), False)
+        self.check_reader(self.write_reads(lines, "\n", False), False)
+        lines = random_fasta(rng, 100, False)
+        self.check_reader(self.write_reads(lines, "\n", False), False)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+        tophat_path = sys.argv.pop(1)
+    unittest.main()
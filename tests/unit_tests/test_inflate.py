@@ -0,0 +1,140 @@
+"""
+test_inflate.py
+
+Checks the in-process decompression of gzip inputs (gunzip_chunks(),
+bgzf_chunks() and InflateReader) on single and multi-member gzip files and
+BGZF files, with zero padding after the last member, trailing garbage and
+truncated files.
+
+usage: python test_inflate.py [path to tophat.py]
+"""
+
+import unittest
+import sys
+import os
+import imp
+import gzip
+import zlib
+import struct
+import random
+import StringIO
+import multiprocessing.pool
+
+tophat_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "tophat.py")
+tophat = None
+
+def setUpModule():
+    global tophat
+    tophat = imp.load_source("tophat", tophat_path)
+
+def fastq_data(num_reads, seed):
+    rng = random.Random(seed)
+    recs = []
+    for i in range(num_reads):
+        seq = "".join([rng.choice("ACGT") for j in range(rng.randint(20, 100))])
+        qual = "".join([chr(rng.randint(35, 74)) for j in range(len(seq))])
+        recs.append("@read%d\n%s\n+\n%s\n" % (i, seq, qual))
+    return "".join(recs)
+
+def gzip_member(data, level=6):
+    out = StringIO.StringIO()
+    gz = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=level, mtime=0)
+    gz.write(data)
+    gz.close()
+    return out.getvalue()
+
+# a BGZF block, as written by bgzip and samtools
+def bgzf_block(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(data) + c.flush()
+    bsize = 12 + 6 + len(cdata) + 8
+    return "\x1f\x8b\x08\x04\0\0\0\0\0\xff" + struct.pack("<H", 6) + "BC" + \
+           struct.pack("<HH", 2, bsize - 1) + cdata + \
+           struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+def bgzf_file(data, block_size=65280):
+    blocks = [bgzf_block(data[i:i+block_size]) for i in xrange(0, len(data), block_size)]
+    return "".join(blocks) + bgzf_block("") # the EOF marker block
+
+class TestInflate(unittest.TestCase):
+    def setUp(self):
+        self.data = fastq_data(1000, 18)
+        self.pool = multiprocessing.pool.ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def gunzip(self, gz_data, chunk_size, head_size=0):
+        f = StringIO.StringIO(gz_data)
+        head = f.read(head_size)
+        return "".join(tophat.gunzip_chunks(f, chunk_size, head))
+
+    def bgzf_inflate(self, gz_data, chunk_size, head_size=0):
+        f = StringIO.StringIO(gz_data)
+        head = f.read(head_size)
+        return "".join(tophat.bgzf_chunks(f, self.pool, chunk_size, head))
+
+    def check_both(self, gz_data, expected):
+        for chunk_size in (7, 1000, 1024 * 1024):
+            for head_size in (0, 18):
+                self.assertEqual(self.gunzip(gz_data, chunk_size, head_size), expected)
+                self.assertEqual(self.bgzf_inflate(gz_data, chunk_size, head_size), expected)
+
+    def test_gzip(self):
+        gz_data = gzip_member(self.data)
+        for chunk_size in (7, 1000, 1024 * 1024):
+            self.assertEqual(self.gunzip(gz_data, chunk_size), self.data)
+        # not BGZF
+        self.assertRaises(ValueError, self.bgzf_inflate, gz_data, 1000)
+
+    def test_multi_member_gzip(self):
+        third = len(self.data) / 3
+        parts = [self.data[:third], "", self.data[third:2*third], self.data[2*third:]]
+        gz_data = "".join([gzip_member(part, level) for (part, level) in zip(parts, (1, 6, 9, 6))])
+        for chunk_size in (7, 1000, 1024 * 1024):
+            self.assertEqual(self.gunzip(gz_data, chunk_size), self.data)
+
+    def test_bgzf(self):
+        self.check_both(bgzf_file(self.data), self.data)
+        # small blocks, many in each chunk
+        self.check_both(bgzf_file(self.data, 1000), self.data)
+
+    def test_zero_padding(self):
+        for padding in (1, 511, 70000):
+            self.check_both(bgzf_file(self.data) + "\0" * padding, self.data)
+            self.assertEqual(self.gunzip(gzip_member(self.data) + "\0" * padding, 1000), self.data)
+
+    def test_trailing_garbage(self):
+        for gz_data in (bgzf_file(self.data) + "\0\0garbage", bgzf_file(self.data) + "garbage"):
+            self.assertRaises((ValueError, zlib.error), self.gunzip, gz_data, 1000)
+            self.assertRaises(ValueError, self.bgzf_inflate, gz_data, 1000)
+
+    def test_truncated(self):
+        gz_data = bgzf_file(self.data, 10000)
+        # within a block, at the end of a block and before the EOF block
+        block_end = len(bgzf_block(self.data[:10000]))
+        for size in (len(gz_data) / 2, block_end - 1, block_end + 5, len(gz_data) - 29):
+            for chunk_size in (1000, 1024 * 1024):
+                self.assertRaises((ValueError, zlib.error), self.gunzip, gz_data[:size], chunk_size)
+                self.assertRaises(ValueError, self.bgzf_inflate, gz_data[:size], chunk_size)
+        gz_data = gzip_member(self.data)
+        for size in (10, len(gz_data) / 2, len(gz_data) - 4):
+            self.assertRaises((ValueError, zlib.error), self.gunzip, gz_data[:size], 1000)
+
+    def test_inflate_reader(self):
+        lines = self.data.splitlines(True)
+        for gz_data in (gzip_member(self.data), bgzf_file(self.data, 5000)):
+            for num_threads in (1, 2):
+                reader = tophat.InflateReader(StringIO.StringIO(gz_data), "reads.fq.gz",
+                                              num_threads, 1000)
+                self.assertEqual(reader.read(3), self.data[:3])
+                self.assertEqual(reader.readline(), lines[0][3:])
+                self.assertEqual(list(reader), lines[1:])
+                self.assertEqual(reader.read(), "")
+                reader.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+        tophat_path = sys.argv.pop(1)
+    unittest.main()
@@ -0,0 +1,191 @@
+"""
+test_split_reads.py
+
+Checks the block segmenter of split_reads() (read_blocks(), segment_block()
+and color_base_at()) against the record by record segmenter it replaced,
+which is kept below as split_record_reference().
+
+usage: python test_split_reads.py [path to tophat.py]
+"""
+
+import unittest
+import sys
+import os
+import imp
+import random
+import StringIO
+
+tophat_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "tophat.py")
+tophat = None
+
+def setUpModule():
+    global tophat
+    tophat = imp.load_source("tophat", tophat_path)
+
+#
+# The segmenting code of split_reads() before the block segmenter: the
+# records of each segment number go to seg_outs[seg_num], all the records
+# also go to mux_out in the order they were written
+#
+def convert_color_to_bp(color_seq):
+    decode_dic = { 'A0':'A', 'A1':'C', 'A2':'G', 'A3':'T', 'A4':'N', 'A.':'N', 'AN':'N',
+                   'C0':'C', 'C1':'A', 'C2':'T', 'C3':'G', 'C4':'N', 'C.':'N', 'CN':'N',
+                   'G0':'G', 'G1':'T', 'G2':'A', 'G3':'C', 'G4':'N', 'G.':'N', 'GN':'N',
+                   'T0':'T', 'T1':'G', 'T2':'C', 'T3':'A', 'T4':'N', 'T.':'N', 'TN':'N',
+                   'N0':'N', 'N1':'N', 'N2':'N', 'N3':'N', 'N4':'N', 'N.':'N', 'NN':'N',
+                   '.0':'N', '.1':'N', '.2':'N', '.3':'N', '.4':'N', '..':'N', '.N':'N' }
+    base = color_seq[0]
+    bp_seq = base
+    for ch in color_seq[1:]:
+        base = decode_dic[base+ch]
+        bp_seq += base
+    return bp_seq
+
+def split_record_reference(read_name, read_seq, read_qual, seg_outs, mux_out, offsets, fasta, color):
+    if color:
+        color_offset = 1
+        read_seq_temp = convert_color_to_bp(read_seq)
+        seg_num = 1
+        while seg_num + 1 < len(offsets):
+            if read_seq[offsets[seg_num]+1] not in ['0', '1', '2', '3']:
+                return
+            seg_num += 1
+    else:
+        color_offset = 0
+    seg_num = 0
+    last_seq_offset = 0
+    while seg_num + 1 < len(offsets):
+        rec = "%s|%d:%d:%d\n" % (read_name, last_seq_offset, seg_num, len(offsets) - 1)
+        seg_seq = read_seq[last_seq_offset+color_offset:offsets[seg_num + 1]+color_offset]
+        if color:
+            rec += "%s%s\n" % (read_seq_temp[last_seq_offset], seg_seq)
+        else:
+            rec += seg_seq + "\n"
+        if not fasta:
+            rec += "+\n" + read_qual[last_seq_offset:offsets[seg_num + 1]] + "\n"
+        while len(seg_outs) <= seg_num:
+            seg_outs.append([])
+        seg_outs[seg_num].append(rec)
+        mux_out.append(rec)
+        seg_num += 1
+        last_seq_offset = offsets[seg_num]
+
+#--> returns ([segment buffer], multiplexed buffer) for FASTA/FASTQ text
+def split_reference(text, segment_length, fasta, color):
+    seg_outs = []
+    mux_out = []
+    line_state = 0
+    for line in text.split("\n"):
+        if line.strip() == "":
+            continue
+        if line_state == 0:
+            read_name = line.strip()
+        elif line_state == 1:
+            read_seq = line.strip()
+            read_length = len(read_seq)
+            tmp_num_segments = read_length / segment_length
+            offsets = [segment_length * i for i in range(0, tmp_num_segments + 1)]
+            if read_length % segment_length >= min(segment_length - 2, 20):
+                offsets.append(read_length)
+                tmp_num_segments += 1
+            else:
+                offsets[-1] = read_length
+            if tmp_num_segments == 1:
+                offsets = [0, read_length]
+            if fasta:
+                split_record_reference(read_name, read_seq, None, seg_outs, mux_out, offsets, fasta, color)
+        elif line_state == 3:
+            split_record_reference(read_name, read_seq, line.strip(), seg_outs, mux_out, offsets, fasta, color)
+        line_state += 1
+        if fasta:
+            line_state %= 2
+        else:
+            line_state %= 4
+    return (["".join(out) for out in seg_outs], "".join(mux_out))
+
+def random_reads(rng, num_reads, fasta, color, max_length=130):
+    recs = []
+    for i in range(num_reads):
+        length = rng.choice([rng.randint(1, max_length), 25, 50, 74, 75, 76, 100])
+        if color:
+            seq = rng.choice("ACGTACGTN.") + "".join([rng.choice("0123012301234.") for j in range(length)])
+        else:
+            seq = "".join([rng.choice("ACGTACGTN") for j in range(length)])
+        if fasta:
+            recs.append(">read%d\n%s\n" % (i, seq))
+        else:
+            qual = "".join([chr(rng.randint(35, 74)) for j in range(len(seq))])
+            recs.append("@read%d\n%s\n+\n%s\n" % (i, seq, qual))
+        if rng.random() < 0.05:
+            recs.append("\n  \n")
+    return "".join(recs)
+
+class TestSplitReads(unittest.TestCase):
+    def check_segments(self, seed, fasta, color, segment_length=25):
+        rng = random.Random(seed)
+        text = random_reads(rng, 300, fasta, color)
+        if fasta:
+            rec_lines = 2
+        else:
+            rec_lines = 4
+        seg_outs, mux_out = split_reference(text, segment_length, fasta, color)
+        # small blocks, so records and lines are split between reads
+        blocks = list(tophat.read_blocks(StringIO.StringIO(text), rec_lines, 97))
+        self.assertTrue(len(blocks) > 1)
+        for block in blocks:
+            self.assertEqual(len(block) % rec_lines, 0)
+        seg_bufs = []
+        mux_bufs = []
+        for block in blocks:
+            # segmented in the main process (list) and in the pool (string)
+            for lines in (block, "\n".join(block)):
+                res = tophat.segment_block((lines, segment_length, fasta, color, False, False))
+                self.assertEqual(res[0], len(block) / rec_lines)
+                self.assertEqual(res[1], len([b for b in res[2] if b]))
+            for i in range(len(res[2])):
+                while len(seg_bufs) <= i:
+                    seg_bufs.append("")
+                seg_bufs[i] += res[2][i]
+            mux = tophat.segment_block((block, segment_length, fasta, color, True, False))
+            self.assertEqual(len(mux[2]), 1)
+            mux_bufs.append(mux[2][0])
+        self.assertEqual(seg_bufs, seg_outs)
+        self.assertEqual("".join(mux_bufs), mux_out)
+
+    def test_fastq(self):
+        for seed in range(5):
+            self.check_segments(seed, False, False)
+
+    def test_fasta(self):
+        for seed in range(5):
+            self.check_segments(seed, True, False)
+
+    def test_color_fastq(self):
+        for seed in range(5):
+            self.check_segments(seed, False, True)
+
+    def test_color_fasta(self):
+        for seed in range(5):
+            self.check_segments(seed, True, True, 20)
+
+    def test_color_base_at(self):
+        rng = random.Random(7)
+        for i in range(2000):
+            seq = rng.choice("ACGTN.") + "".join([rng.choice("012301230123.4") for j in range(rng.randint(0, 40))])
+            bp_seq = convert_color_to_bp(seq)
+            for pos in range(len(seq)):
+                self.assertEqual(tophat.color_base_at(seq, pos), bp_seq[pos], (seq, pos))
+
+    def test_read_blocks(self):
+        text = "@r1\nACGT\n+\nIIII\n\n@r2\nAC\n+\nII\n@r3\nAAA\n+"
+        for block_size in (1, 3, 5, 1000):
+            blocks = list(tophat.read_blocks(StringIO.StringIO(text), 4, block_size))
+            self.assertEqual(sum(blocks, []), ["@r1", "ACGT", "+", "IIII", "@r2", "AC", "+", "II"])
+        # no newline at the end of the last record
+        blocks = list(tophat.read_blocks(StringIO.StringIO(">r1\nACGT\n>r2\nCA"), 2, 4))
+        self.assertEqual(sum(blocks, []), [">r1", "ACGT", ">r2", "CA"])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+        tophat_path = sys.argv.pop(1)
+    unittest.main()